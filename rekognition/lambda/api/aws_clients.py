@@ -0,0 +1,70 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import threading
+
+# botocore and boto3 are imported on first use, importing boto3 pulls in
+# s3transfer and is the largest part of the module import time
+_session = None
+_clients = {}
+_lock = threading.RLock()
+
+
+def get_session():
+    """
+    botocore session shared by every client, so the service models,
+    endpoint data and credentials are loaded once per container
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                import botocore.session
+
+                _session = botocore.session.get_session()
+    return _session
+
+
+def get_client(service_name, config=None):
+    """
+    botocore clients are thread safe, one per service and config (keyword
+    arguments of botocore.config.Config) is shared by all threads
+    """
+    key = (service_name, repr(config))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client_config = None
+                if config is not None:
+                    from botocore.config import Config
+
+                    client_config = Config(**config)
+                client = get_session().create_client(service_name, config=client_config)
+                _clients[key] = client
+    return client
+
+
+def get_resource(service_name):
+    """
+    creates a boto3 resource on the shared session.  Resources are not thread
+    safe, callers keep one per thread
+    """
+    with _lock:
+        import boto3.session
+
+        session = boto3.session.Session(botocore_session=get_session())
+        return session.resource(service_name)
+
+
+class LazyClient:
+    """
+    Stands in for a client at module level and creates it on first use
+    """
+
+    def __init__(self, service_name, config=None):
+        self.service_name = service_name
+        self.config = config
+
+    def __getattr__(self, name):
+        return getattr(get_client(self.service_name, self.config), name)
@@ -0,0 +1,65 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Thread safe, size bounded LRU cache for warm lambda containers.
+    Entries older than ttl seconds are not returned by get, but are kept until
+    they are evicted so callers can still serve them stale with get_entry.
+    A ttl of 0 disables caching.
+    """
+
+    def __init__(self, maxsize=128, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_entry(self, key):
+        """
+        returns (value, age in seconds) whether or not the entry has expired,
+        or None if the key is not cached
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            value, stored_at = self._entries[key]
+            self._entries.move_to_end(key)
+            return value, self.clock() - stored_at
+
+    def get(self, key, default=None):
+        entry = self.get_entry(key)
+        if entry is None or entry[1] >= self.ttl:
+            return default
+        return entry[0]
+
+    def set(self, key, value):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, self.clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_MISSING = object()
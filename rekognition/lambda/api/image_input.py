@@ -0,0 +1,71 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import io
+import base64
+import binascii
+
+# Rekognition limit for images passed as bytes
+MAX_IMAGE_BYTES = 4 * 1024 * 1024
+SUPPORTED_FORMATS = {"JPEG", "PNG"}
+
+
+def decode_image_bytes(image_b64):
+    """
+    decodes a base64 image from the request payload
+    """
+    try:
+        return base64.b64decode(image_b64, validate=True)
+    except (binascii.Error, TypeError) as e:
+        raise ValueError(f"image_bytes is not valid base64: {e}")
+
+
+def normalize_image(image_bytes, max_dimension, quality):
+    """
+    Downscales the image so neither side exceeds max_dimension and re-encodes
+    it as JPEG when it is too big, in a format Rekognition does not read, or
+    over the byte limit.  Images that are already small JPEGs or PNGs are
+    returned untouched.
+    Pillow comes from the lambda's layer, without it the bytes are only
+    checked against the limit.
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return check_size(image_bytes)
+
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image_format = image.format
+        width, height = image.size
+    except Exception as e:
+        raise ValueError(f"image_bytes is not a readable image: {e}")
+
+    if (
+        image_format in SUPPORTED_FORMATS
+        and max(width, height) <= max_dimension
+        and len(image_bytes) <= MAX_IMAGE_BYTES
+    ):
+        return image_bytes
+
+    # lets the JPEG decoder skip straight to a reduced resolution
+    image.draft("RGB", (max_dimension, max_dimension))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_dimension, max_dimension))
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True)
+    return check_size(output.getvalue())
+
+
+def check_size(image_bytes):
+    if len(image_bytes) > MAX_IMAGE_BYTES:
+        raise ValueError(
+            f"image is {len(image_bytes)} bytes, the limit is {MAX_IMAGE_BYTES} bytes"
+        )
+    return image_bytes
+
+
+def prepare_image_bytes(image_b64, max_dimension, quality):
+    return normalize_image(decode_image_bytes(image_b64), max_dimension, quality)
@@ -0,0 +1,125 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import struct
+
+# Rekognition Custom Labels limits for images in s3
+MAX_S3_IMAGE_BYTES = 15 * 1024 * 1024
+MIN_IMAGE_DIMENSION = 64  # pixels
+MAX_IMAGE_DIMENSION = 4096  # pixels
+# bytes read from the start of an object, enough for the dimensions of most
+# JPEGs (EXIF data can push them further) and every PNG
+HEADER_BYTES = 16 * 1024
+# bytes at the end of an inline image checked for the end marker, a PNG IEND
+# chunk
+TAIL_BYTES = 12
+
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+JPEG_END = b"\xff\xd9"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_END = b"IEND\xaeB`\x82"
+# start of frame markers, which hold the dimensions, all but DHT, JPG and DAC
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# markers without a length
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD9)}
+
+# verdict codes, returned in predict responses as error_code
+UNSUPPORTED_FORMAT = "UNSUPPORTED_FORMAT"
+IMAGE_TOO_LARGE = "IMAGE_TOO_LARGE"
+IMAGE_TOO_SMALL = "IMAGE_TOO_SMALL"
+IMAGE_TRUNCATED = "IMAGE_TRUNCATED"
+IMAGE_NOT_FOUND = "IMAGE_NOT_FOUND"
+
+
+def sniff_format(header):
+    if header.startswith(JPEG_SIGNATURE):
+        return "JPEG"
+    if header.startswith(PNG_SIGNATURE):
+        return "PNG"
+    return None
+
+
+def png_dimensions(header):
+    # the IHDR chunk always comes first
+    if len(header) < 24 or header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+
+def jpeg_dimensions(header):
+    """
+    walks the JPEG markers up to the first start of frame, returns None if
+    it is not in the header
+    """
+    i = 2
+    while i + 4 <= len(header):
+        if header[i] != 0xFF:
+            return None
+        marker = header[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            i += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            if i + 9 > len(header):
+                return None
+            height, width = struct.unpack(">HH", header[i + 5 : i + 9])
+            return width, height
+        (length,) = struct.unpack(">H", header[i + 2 : i + 4])
+        i += 2 + length
+    return None
+
+
+def missing_end_marker(header, tail):
+    """
+    whether the end of a JPEG or PNG image is not its end marker.  This is
+    not a verdict: some encoders and editors append data after it, so it is
+    only counted.
+    """
+    image_format = sniff_format(header)
+    if image_format is None:
+        return False
+    end = JPEG_END if image_format == "JPEG" else PNG_END
+    # some encoders pad JPEGs after the end of image marker
+    return end not in tail.rstrip(b"\x00")
+
+
+def check_image(header, size, max_bytes=MAX_S3_IMAGE_BYTES):
+    """
+    checks the start of an image against what Rekognition accepts without
+    decoding it.
+    Returns None for an image that looks valid, otherwise (code, message).
+    Dimensions that are not in the header are not checked, unless the header
+    is the whole image, which is then truncated.
+    """
+    if size == 0:
+        return IMAGE_TRUNCATED, "image is empty"
+    if size > max_bytes:
+        return IMAGE_TOO_LARGE, f"image is {size} bytes, the limit is {max_bytes}"
+
+    image_format = sniff_format(header)
+    if image_format is None:
+        return UNSUPPORTED_FORMAT, "image is not a JPEG or PNG"
+
+    if image_format == "JPEG":
+        dimensions = jpeg_dimensions(header)
+    else:
+        dimensions = png_dimensions(header)
+    if dimensions is None:
+        if size <= len(header):
+            return IMAGE_TRUNCATED, f"{image_format} image is truncated"
+        return None
+    width, height = dimensions
+    if min(width, height) < MIN_IMAGE_DIMENSION:
+        return (
+            IMAGE_TOO_SMALL,
+            f"image is {width}x{height}, the minimum is {MIN_IMAGE_DIMENSION} pixels",
+        )
+    if max(width, height) > MAX_IMAGE_DIMENSION:
+        return (
+            IMAGE_TOO_LARGE,
+            f"image is {width}x{height}, the maximum is {MAX_IMAGE_DIMENSION} pixels",
+        )
+    return None
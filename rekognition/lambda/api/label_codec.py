@@ -0,0 +1,88 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import json
+
+# separates test name from ids in labels, must match separator in
+# scripts/create_animal_manifest.py
+SEPARATOR = "||"
+# label name prefix -> kind of label
+LABEL_PREFIXES = {"species-": "species", "breed-": "breed"}
+KINDS = tuple(LABEL_PREFIXES.values())
+# labels outside the model's label set that are remembered
+MAX_UNKNOWN_LABELS = 4096
+
+
+def split_name_id(label):
+    """
+    Parses text label and id if one is present
+    convention for labels is:
+    breed-<BreedName>||<BreedId>
+    e.g.
+    breed-Tiger||137
+    if no id is present, returns an empty string
+    """
+    tup = label.split(SEPARATOR)
+    return tup + [""] * max(0, 2 - len(tup))
+
+
+def parse_label(raw_label):
+    """
+    returns (kind, name, id) of a raw label name, kind is None for labels
+    that are neither species nor breed
+    """
+    for prefix, kind in LABEL_PREFIXES.items():
+        if raw_label.startswith(prefix):
+            name, label_id = split_name_id(raw_label[len(prefix) :])[:2]
+            return kind, name, label_id
+    return None, raw_label, ""
+
+
+def manifest_labels(manifest_lines):
+    """
+    yields the class names of a Ground Truth manifest, the raw label names
+    of a model trained on it
+    """
+    for line in manifest_lines:
+        if isinstance(line, str):
+            line = json.loads(line)
+        for key, value in line.items():
+            if key.endswith("-metadata") and "class-name" in value:
+                yield value["class-name"]
+
+
+class LabelCodec:
+    """
+    Decodes Rekognition label names with a lookup table of raw label ->
+    (kind, name, id) compiled from a model's label set.  Labels outside the
+    set are parsed once and remembered, so a codec without a label set
+    compiles itself from the responses it sees.
+    """
+
+    def __init__(self, labels=()):
+        self._table = {raw_label: parse_label(raw_label) for raw_label in labels}
+        self._known = len(self._table)
+
+    @classmethod
+    def from_manifest(cls, manifest_lines):
+        return cls(manifest_labels(manifest_lines))
+
+    def decode(self, raw_label):
+        entry = self._table.get(raw_label)
+        if entry is None:
+            entry = parse_label(raw_label)
+            if len(self._table) < self._known + MAX_UNKNOWN_LABELS:
+                self._table[raw_label] = entry
+        return entry
+
+    def partition(self, label_list):
+        """
+        splits Rekognition labels into {"breed": [...], "species": [...]} with
+        the prefix and id split off the name into copies of the labels, the
+        response is left as is
+        """
+        labels = {kind: [] for kind in KINDS}
+        for label in label_list:
+            kind, name, label_id = self.decode(label["Name"])
+            if kind is not None:
+                labels[kind].append({**label, "Name": name, "Id": label_id})
+        return labels
@@ -0,0 +1,168 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# histogram bucket upper bounds in ms, each 10% above the last, from 0.1ms to
+# about 2 minutes, so percentiles are within 10% of the recorded value
+BUCKET_GROWTH = 1.1
+BUCKET_BOUNDS = [0.1 * BUCKET_GROWTH**i for i in range(150)]
+PERCENTILES = (50, 90, 99)
+
+
+class LatencyHistogram:
+    """
+    Fixed size log scale histogram of latencies in ms
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, elapsed_ms, error=False):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, elapsed_ms)] += 1
+        self.count += 1
+        self.errors += int(error)
+        self.total += elapsed_ms
+        self.max = max(self.max, elapsed_ms)
+
+    def percentile(self, percent):
+        """
+        upper bound of the bucket holding the percentile, capped at the
+        largest value recorded
+        """
+        if self.count == 0:
+            return None
+        rank = percent / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                bound = BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        summary = {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": round(self.total / self.count, 2) if self.count else None,
+            "max_ms": round(self.max, 2),
+        }
+        for percent in PERCENTILES:
+            value = self.percentile(percent)
+            summary[f"p{percent}_ms"] = round(value, 2) if value is not None else None
+        return summary
+
+
+class LatencyRecorder:
+    """
+    Times the stages of a prediction into in-process histograms, per stage and
+    per stage and model arn, and writes them out as one structured log line
+    every export_interval seconds.  The histograms are reset on export so each
+    line covers one interval.
+    The stages of the current request are also kept so they can be returned
+    with the response; a container serves one invocation at a time.
+    """
+
+    def __init__(self, export_interval=60, write=print, clock=time.monotonic):
+        self.export_interval = export_interval
+        self.write = write
+        self.clock = clock
+        self._histograms = {}
+        self._request_timings = {}
+        self._window_start = clock()
+        self._lock = threading.Lock()
+
+    def record(self, stage, elapsed_ms, model_arn=None, error=False):
+        with self._lock:
+            keys = [(stage, None)]
+            if model_arn is not None:
+                keys.append((stage, model_arn))
+            for key in keys:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = LatencyHistogram()
+                histogram.record(elapsed_ms, error)
+            # stages repeated within a request, e.g. in batch mode, are summed
+            self._request_timings[stage] = (
+                self._request_timings.get(stage, 0.0) + elapsed_ms
+            )
+
+    @contextmanager
+    def timer(self, stage, model_arn=None):
+        """
+        records the time spent in the with block under stage, counting an
+        exception as an error of the stage
+        """
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.record(stage, elapsed_ms, model_arn=model_arn, error=error)
+
+    def start_request(self):
+        with self._lock:
+            self._request_timings = {}
+
+    def request_timings(self):
+        """
+        ms spent in each stage since start_request
+        """
+        with self._lock:
+            return {
+                stage: round(elapsed_ms, 2)
+                for stage, elapsed_ms in self._request_timings.items()
+            }
+
+    def snapshot(self):
+        with self._lock:
+            return summarize(self._histograms)
+
+    def maybe_export(self):
+        """
+        exports the histograms when the export interval has passed
+        """
+        if self.clock() - self._window_start >= self.export_interval:
+            return self.export()
+        return 0
+
+    def export(self):
+        """
+        writes the histograms as one json log line and starts a new interval,
+        returning the number of histograms written
+        """
+        now = self.clock()
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+            window_seconds = now - self._window_start
+            self._window_start = now
+        if not histograms:
+            return 0
+        self.write(
+            json.dumps(
+                {
+                    "LatencyHistograms": summarize(histograms),
+                    "window_seconds": round(window_seconds, 3),
+                }
+            )
+        )
+        return len(histograms)
+
+
+def summarize(histograms):
+    return [
+        {"stage": stage, "model_arn": model_arn, **histogram.summary()}
+        for (stage, model_arn), histogram in histograms.items()
+    ]
@@ -0,0 +1,95 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import json
+import time
+import threading
+
+# must match the namespace read by stepfunctions/stop_previous_model_inference.py
+NAMESPACE = "Petfinder/Rekognition/Model/DetectCustomLabels"
+# most metric data PutMetricData accepts in one request
+MAX_METRIC_DATA = 1000
+
+
+class MetricsRecorder:
+    """
+    Aggregates metric values in process and writes them out as CloudWatch
+    Embedded Metric Format log lines on flush.  Lambda ships the log lines to
+    CloudWatch asynchronously, so recording a metric never blocks on, or fails
+    because of, a CloudWatch API call.
+    """
+
+    def __init__(self, namespace=NAMESPACE, write=print):
+        self.namespace = namespace
+        self.write = write
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, dimensions=None, value=1.0, unit="Count"):
+        """
+        adds value to the metric, summed with any other values recorded for
+        the same name, dimensions and unit since the last flush
+        """
+        key = (name, tuple(sorted((dimensions or {}).items())), unit)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def _take(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def flush(self):
+        """
+        writes one EMF document per set of dimension values
+        """
+        values = self._take()
+
+        documents = {}
+        for (name, dimensions, unit), value in values.items():
+            document = documents.get(dimensions)
+            if document is None:
+                document = {
+                    "_aws": {
+                        "Timestamp": int(time.time() * 1000),
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": self.namespace,
+                                "Dimensions": [[k for k, v in dimensions]],
+                                "Metrics": [],
+                            }
+                        ],
+                    },
+                    **dict(dimensions),
+                }
+                documents[dimensions] = document
+            document["_aws"]["CloudWatchMetrics"][0]["Metrics"].append(
+                {"Name": name, "Unit": unit}
+            )
+            document[name] = value
+
+        for document in documents.values():
+            self.write(json.dumps(document))
+        return len(documents)
+
+    def publish(self, cloudwatch):
+        """
+        sends the values recorded since the last flush with PutMetricData, for
+        processes outside Lambda whose EMF log lines nothing ingests
+        """
+        timestamp = time.time()
+        metric_data = [
+            {
+                "MetricName": name,
+                "Dimensions": [{"Name": k, "Value": v} for k, v in dimensions],
+                "Timestamp": timestamp,
+                "Value": value,
+                "Unit": unit,
+            }
+            for (name, dimensions, unit), value in self._take().items()
+        ]
+        for i in range(0, len(metric_data), MAX_METRIC_DATA):
+            cloudwatch.put_metric_data(
+                Namespace=self.namespace,
+                MetricData=metric_data[i : i + MAX_METRIC_DATA],
+            )
+        return len(metric_data)
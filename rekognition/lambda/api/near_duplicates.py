@@ -0,0 +1,196 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import io
+import random
+import threading
+from functools import lru_cache
+
+# dHash of a 9x8 thumbnail, 64 bits
+HASH_SIZE = 8
+DEFAULT_MAX_DISTANCE = 4  # bits
+DEFAULT_MAX_ENTRIES = 10000  # per model arn and minimum confidence
+DEFAULT_VERIFY_RATE = 0.05
+
+
+@lru_cache(maxsize=None)
+def can_hash():
+    """
+    whether Pillow is installed, without it dhash always returns None
+    """
+    try:
+        import PIL
+    except ImportError:
+        return False
+    return True
+
+
+def dhash(image_bytes, hash_size=HASH_SIZE):
+    """
+    difference hash of an image: one bit per pair of horizontally adjacent
+    pixels of a grayscale thumbnail, set when the left one is brighter.
+    Re-encoding, resizing and small edits flip few bits.
+    Returns None when Pillow is not installed or the image can't be read.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        # lets the JPEG decoder skip straight to a reduced resolution
+        image.draft("L", (hash_size * 8, hash_size * 8))
+        image = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    except Exception as e:
+        print(e)
+        return None
+    pixels = image.tobytes()
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            value = (value << 1) | (left > pixels[row * (hash_size + 1) + col + 1])
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of hashes under Hamming distance.  A search only
+    visits children whose edge distance is within max_distance of the
+    distance to their parent, which by the triangle inequality holds every
+    possible match.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, image_hash, value):
+        node = [image_hash, value, {}]
+        if self.root is None:
+            self.root = node
+            self.size = 1
+            return
+        current = self.root
+        while True:
+            distance = hamming(image_hash, current[0])
+            if distance == 0:
+                current[1] = value
+                return
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                self.size += 1
+                return
+            current = child
+
+    def nearest(self, image_hash, max_distance):
+        """
+        returns (distance, hash, value) of the closest hash within
+        max_distance, or None
+        """
+        best = None
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_hash, value, children = stack.pop()
+            distance = hamming(image_hash, node_hash)
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, node_hash, value)
+                if distance == 0:
+                    break
+            limit = best[0] if best is not None else max_distance
+            for edge, child in children.items():
+                if distance - limit <= edge <= distance + limit:
+                    stack.append(child)
+        return best
+
+    def __len__(self):
+        return self.size
+
+
+class NearDuplicateCache:
+    """
+    Reuses the Rekognition response of a previous image whose perceptual hash
+    is within max_distance bits, e.g. a re-crop or re-compression of the same
+    photo with a different etag.  Each model arn and minimum confidence has
+    its own BK-tree of at most max_entries hashes, the oldest half is dropped
+    when it is full.
+    A verify_rate fraction of hits is still predicted by the model and
+    compared with the reused response, counted as NearDuplicateFalseMatches
+    when the top label differs.
+    """
+
+    def __init__(
+        self,
+        max_distance=DEFAULT_MAX_DISTANCE,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        verify_rate=DEFAULT_VERIFY_RATE,
+        metrics=None,
+        random=random.random,
+    ):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.verify_rate = verify_rate
+        self.metrics = metrics
+        self.random = random
+        self._trees = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, dimensions=None):
+        if self.metrics is not None:
+            self.metrics.increment(name, dimensions or {})
+
+    def get(self, model_arn, min_confidence, image_hash):
+        """
+        returns (response, distance) of the nearest duplicate or None
+        """
+        with self._lock:
+            tree = self._trees.get((model_arn, min_confidence))
+            match = tree.nearest(image_hash, self.max_distance) if tree else None
+        if match is None:
+            self.record("NearDuplicateMisses")
+            return None
+        self.record("NearDuplicateHits", {"Distance": str(match[0])})
+        return match[2], match[0]
+
+    def set(self, model_arn, min_confidence, image_hash, response):
+        response = {"CustomLabels": response.get("CustomLabels", [])}
+        key = (model_arn, min_confidence)
+        with self._lock:
+            entries = self._entries.setdefault(key, {})
+            entries.pop(image_hash, None)
+            entries[image_hash] = response
+            tree = self._trees.get(key)
+            if tree is None or len(entries) > self.max_entries:
+                # BK-trees can't remove nodes, so rebuild from the newest half
+                if len(entries) > self.max_entries:
+                    newest = list(entries.items())[len(entries) // 2 :]
+                    entries = self._entries[key] = dict(newest)
+                tree = self._trees[key] = BKTree()
+                for entry_hash, entry_response in entries.items():
+                    tree.add(entry_hash, entry_response)
+            else:
+                tree.add(image_hash, response)
+
+    def should_verify(self):
+        return self.random() < self.verify_rate
+
+    def verify(self, cached, fresh):
+        """
+        compares a reused response with the model's, returns True when they
+        agree on the top label
+        """
+        agree = top_label(cached) == top_label(fresh)
+        self.record("NearDuplicateVerified" if agree else "NearDuplicateFalseMatches")
+        return agree
+
+
+def top_label(response):
+    labels = response.get("CustomLabels", [])
+    if not labels:
+        return None
+    return max(labels, key=lambda label: label["Confidence"])["Name"]
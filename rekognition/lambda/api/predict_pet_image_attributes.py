@@ -6,107 +6,818 @@
 # }
 ## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 ## SPDX-License-Identifier: MIT-0
-import io
 import os
-import json
-import csv
-import boto3
-import base64
-from boto3.dynamodb.conditions import Key
+import math
+import hashlib
+import time
+import threading
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from botocore.exceptions import BotoCoreError, ClientError
 
+from aws_clients import LazyClient, get_resource
+from caching import TTLCache
+from image_input import MAX_IMAGE_BYTES, prepare_image_bytes
+from image_validation import (
+    HEADER_BYTES,
+    IMAGE_NOT_FOUND,
+    IMAGE_TRUNCATED,
+    TAIL_BYTES,
+    check_image,
+    missing_end_marker,
+)
+from label_codec import LabelCodec
+from latency import LatencyRecorder
+from metrics import MetricsRecorder
+from near_duplicates import (
+    DEFAULT_MAX_DISTANCE,
+    DEFAULT_MAX_ENTRIES,
+    DEFAULT_VERIFY_RATE,
+    NearDuplicateCache,
+    can_hash,
+    dhash,
+)
+from prediction_cache import PredictionCache
+from resilience import (
+    GUARDED_CLIENT_RETRIES,
+    PredictionError,
+    RekognitionGuard,
+    prediction_error_code,
+)
+from single_flight import SingleFlight
 
 DEFAULT_TOP_N = 3
-SEPARATOR = "||"
-# separates test name from ids in labels, must match separator in
-# scripts/create_animal_manifest.py
-attributes_to_send = os.environ["ATTRIBUTES_TO_SEND"]
-minimum_confidence = os.environ["MINIMUM_CONFIDENCE"]
-rekognition_client = boto3.client("rekognition")
-ssm = boto3.client("ssm")
-cloudwatch = boto3.client("cloudwatch")
-s3 = boto3.client("s3")
+# the lambda is always deployed with these, the defaults let scripts import it
+DEFAULT_ATTRIBUTES_TO_SEND = "attribute_1,attribute_2,attribute_3"
+DEFAULT_MINIMUM_CONFIDENCE = 5
+DEFAULT_BATCH_MAX_WORKERS = 8
+DEFAULT_BATCH_ACQUIRE_TIMEOUT = 60  # seconds
+DEFAULT_MODEL_ARN_CACHE_TTL = 60  # seconds
+DEFAULT_MODEL_ARN_STALE_TTL = 300  # seconds
+# Rekognition errors meaning the cached model arn is out of date, e.g. the
+# model was replaced by update_model_ssm.py and then deleted
+STALE_MODEL_ERROR_CODES = {"ResourceNotFoundException", "InvalidParameterException"}
+DEFAULT_BREED_CACHE_SIZE = 256
+DEFAULT_BREED_CACHE_TTL = 3600  # seconds
+DEFAULT_BREED_NEGATIVE_CACHE_TTL = 300  # seconds
+BATCH_GET_MAX_KEYS = 100  # dynamodb limit per BatchGetItem request
+BATCH_GET_MAX_ATTEMPTS = 5
+DEFAULT_PREDICTION_CACHE_SIZE = 1024
+DEFAULT_PREDICTION_CACHE_TTL = 86400  # seconds
+DEFAULT_MAX_IMAGE_DIMENSION = 1280  # pixels
+DEFAULT_IMAGE_JPEG_QUALITY = 90
+PIPELINE_MAX_WORKERS = 4
+DEFAULT_LATENCY_EXPORT_INTERVAL = 60  # seconds
+DEFAULT_INFERENCE_UNITS = 1
+# detect_custom_labels calls per second a container sends to one inference unit
+DEFAULT_DETECT_TPS_PER_INFERENCE_UNIT = 5
+DEFAULT_DETECT_MAX_ATTEMPTS = 4
+DEFAULT_CIRCUIT_FAILURE_THRESHOLD = 5
+DEFAULT_CIRCUIT_RESET_TIMEOUT = 30  # seconds
+# animal_type that predicts with every model and keeps the species found
+AUTO_ANIMAL_TYPE = "auto"
+DEFAULT_ANIMAL_TYPES = "cat,dog"
+DEFAULT_AUTO_ROUTE_MIN_SPECIES_CONFIDENCE = 90
+DEFAULT_VALIDATION_CACHE_SIZE = 4096
+DEFAULT_VALIDATION_CACHE_TTL = 86400  # seconds
+attributes_to_send = os.environ.get("ATTRIBUTES_TO_SEND", DEFAULT_ATTRIBUTES_TO_SEND)
+minimum_confidence = os.environ.get("MINIMUM_CONFIDENCE", DEFAULT_MINIMUM_CONFIDENCE)
+batch_max_workers = int(os.environ.get("BATCH_MAX_WORKERS", DEFAULT_BATCH_MAX_WORKERS))
+# seconds the calls of a batch wait for the rate limiter, a single image fails
+# fast instead
+batch_acquire_timeout = float(
+    os.environ.get("BATCH_ACQUIRE_TIMEOUT", DEFAULT_BATCH_ACQUIRE_TIMEOUT)
+)
+model_arn_cache_ttl = float(
+    os.environ.get("MODEL_ARN_CACHE_TTL", DEFAULT_MODEL_ARN_CACHE_TTL)
+)
+model_arn_stale_ttl = float(
+    os.environ.get("MODEL_ARN_STALE_TTL", DEFAULT_MODEL_ARN_STALE_TTL)
+)
+max_image_dimension = int(
+    os.environ.get("MAX_IMAGE_DIMENSION", DEFAULT_MAX_IMAGE_DIMENSION)
+)
+image_jpeg_quality = int(
+    os.environ.get("IMAGE_JPEG_QUALITY", DEFAULT_IMAGE_JPEG_QUALITY)
+)
+# run independent lookups of a prediction concurrently instead of one by one
+overlap_io = os.environ.get("OVERLAP_IO", "true").lower() == "true"
+# adds the time spent in each stage of the request to the response
+debug_timings = os.environ.get("DEBUG_TIMINGS", "false").lower() == "true"
+# models tried when the animal type is not given, and the species label
+# confidence at which the first answer wins
+animal_types = os.environ.get("ANIMAL_TYPES", DEFAULT_ANIMAL_TYPES).split(",")
+auto_route_min_species_confidence = float(
+    os.environ.get(
+        "AUTO_ROUTE_MIN_SPECIES_CONFIDENCE", DEFAULT_AUTO_ROUTE_MIN_SPECIES_CONFIDENCE
+    )
+)
+# check images in s3 are ones Rekognition can read before calling the model
+validate_images = os.environ.get("VALIDATE_IMAGES", "true").lower() == "true"
+# reuse predictions of perceptually near identical images, see near_duplicates.py
+near_duplicate_cache_enabled = (
+    os.environ.get("NEAR_DUPLICATE_CACHE", "false").lower() == "true"
+)
+# clients are created on first use, not at import, to keep cold starts short
+rekognition_client = LazyClient(
+    "rekognition", config={"retries": GUARDED_CLIENT_RETRIES}
+)
+ssm = LazyClient("ssm")
+s3 = LazyClient("s3")
+# boto3 resources are not thread safe, so each thread gets its own
+dynamo_resources = threading.local()
+metrics = MetricsRecorder()
+# label names are decoded once per container, the models share a label format
+label_codec = LabelCodec()
+latency = LatencyRecorder(
+    export_interval=float(
+        os.environ.get("LATENCY_EXPORT_INTERVAL", DEFAULT_LATENCY_EXPORT_INTERVAL)
+    )
+)
+pipeline_pool = ThreadPoolExecutor(max_workers=PIPELINE_MAX_WORKERS)
+# one prediction per model for each image being auto routed
+auto_route_pool = ThreadPoolExecutor(
+    max_workers=len(animal_types) * max(1, batch_max_workers)
+)
+
+# limits, retries and fails fast detect_custom_labels calls per model arn
+inference_units = int(os.environ.get("INFERENCE_UNITS", DEFAULT_INFERENCE_UNITS))
+detect_rate = inference_units * float(
+    os.environ.get(
+        "DETECT_TPS_PER_INFERENCE_UNIT", DEFAULT_DETECT_TPS_PER_INFERENCE_UNIT
+    )
+)
+rekognition_guard = RekognitionGuard(
+    rate=detect_rate,
+    capacity=max(1.0, detect_rate),
+    max_attempts=int(
+        os.environ.get("DETECT_MAX_ATTEMPTS", DEFAULT_DETECT_MAX_ATTEMPTS)
+    ),
+    failure_threshold=int(
+        os.environ.get("CIRCUIT_FAILURE_THRESHOLD", DEFAULT_CIRCUIT_FAILURE_THRESHOLD)
+    ),
+    reset_timeout=float(
+        os.environ.get("CIRCUIT_RESET_TIMEOUT", DEFAULT_CIRCUIT_RESET_TIMEOUT)
+    ),
+)
+# set by get_batch_inferred_attributes for the calls of its images
+detect_acquire_timeout = contextvars.ContextVar("detect_acquire_timeout", default=None)
+
+# per container cache of animal type -> model arn
+model_arn_cache = TTLCache(maxsize=16, ttl=model_arn_cache_ttl)
+model_arn_refreshes = set()
+model_arn_refresh_lock = threading.Lock()
+
+# per container cache of breed name -> breed attribute row, plus the breeds
+# that are known not to be in the table
+breed_data_cache = TTLCache(
+    maxsize=int(os.environ.get("BREED_CACHE_SIZE", DEFAULT_BREED_CACHE_SIZE)),
+    ttl=float(os.environ.get("BREED_CACHE_TTL", DEFAULT_BREED_CACHE_TTL)),
+)
+missing_breed_cache = TTLCache(
+    maxsize=int(os.environ.get("BREED_CACHE_SIZE", DEFAULT_BREED_CACHE_SIZE)),
+    ttl=float(
+        os.environ.get("BREED_NEGATIVE_CACHE_TTL", DEFAULT_BREED_NEGATIVE_CACHE_TTL)
+    ),
+)
+breed_cache_warm_until = 0.0
+breed_cache_warmup = None
+breed_cache_warmup_lock = threading.Lock()
+
+# per container cache of (bucket, key) -> (etag, check_image verdict)
+validation_cache = TTLCache(
+    maxsize=int(os.environ.get("VALIDATION_CACHE_SIZE", DEFAULT_VALIDATION_CACHE_SIZE)),
+    ttl=float(os.environ.get("VALIDATION_CACHE_TTL", DEFAULT_VALIDATION_CACHE_TTL)),
+)
+
+
+def get_dynamo_resource():
+    if not hasattr(dynamo_resources, "resource"):
+        dynamo_resources.resource = get_resource("dynamodb")
+    return dynamo_resources.resource
+
+
+# concurrent identical lookups in a container, e.g. the same image twice in a
+# batch or the models of an auto routed request, share one call
+model_arn_flights = SingleFlight("ssm_get_parameter", metrics=metrics)
+breed_labels_flights = SingleFlight("detect_custom_labels", metrics=metrics)
+breed_attributes_flights = SingleFlight("breed_attributes", metrics=metrics)
+
+# Rekognition responses keyed by model arn and s3 object version, in process
+# and in the shared PREDICTION_CACHE_DDB_TBL table when one is configured
+prediction_cache = PredictionCache(
+    TTLCache(
+        maxsize=int(
+            os.environ.get("PREDICTION_CACHE_SIZE", DEFAULT_PREDICTION_CACHE_SIZE)
+        ),
+        ttl=float(os.environ.get("PREDICTION_CACHE_TTL", DEFAULT_PREDICTION_CACHE_TTL)),
+    ),
+    table_name=os.environ.get("PREDICTION_CACHE_DDB_TBL"),
+    get_dynamo_resource=get_dynamo_resource,
+    metrics=metrics,
+    executor=pipeline_pool if overlap_io else None,
+)
+
+# Rekognition responses keyed by model arn and perceptual hash of the image
+near_duplicate_cache = NearDuplicateCache(
+    max_distance=int(
+        os.environ.get("NEAR_DUPLICATE_MAX_DISTANCE", DEFAULT_MAX_DISTANCE)
+    ),
+    max_entries=int(os.environ.get("NEAR_DUPLICATE_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+    verify_rate=float(
+        os.environ.get("NEAR_DUPLICATE_VERIFY_RATE", DEFAULT_VERIFY_RATE)
+    ),
+    metrics=metrics,
+)
+
+
+def batch_get_breed_items(breed_names):
+    """
+    reads breed attribute rows with BatchGetItem, retrying unprocessed keys
+    """
+    table_name = os.environ["ANIMAL_ATTRIBUTES_DDB_TBL"]
+    items = []
+    for i in range(0, len(breed_names), BATCH_GET_MAX_KEYS):
+        request_items = {
+            table_name: {
+                "Keys": [
+                    {"uuid": name} for name in breed_names[i : i + BATCH_GET_MAX_KEYS]
+                ]
+            }
+        }
+        for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+            with latency.timer("dynamodb_batch_get"):
+                response = get_dynamo_resource().batch_get_item(
+                    RequestItems=request_items
+                )
+            items.extend(response.get("Responses", {}).get(table_name, []))
+            request_items = response.get("UnprocessedKeys")
+            if not request_items:
+                break
+            time.sleep(0.05 * 2**attempt)
+        else:
+            raise Exception(f"Unprocessed breed keys after retries: {request_items}")
+    return items
+
+
+def get_breeds_data(breed_names):
+    """
+    returns {breed name: attribute row or None} for the breeds, reading the
+    ones not already cached in a single BatchGetItem round trip
+    """
+    breeds_data = {}
+    to_fetch = []
+    for name in dict.fromkeys(breed_names):
+        item = breed_data_cache.get(name)
+        if item is not None:
+            breeds_data[name] = item
+        elif name in missing_breed_cache:
+            breeds_data[name] = None
+        else:
+            to_fetch.append(name)
+
+    if to_fetch:
+        fetched = {
+            item["uuid"]: item
+            for item in breed_attributes_flights.do(
+                tuple(to_fetch), lambda: batch_get_breed_items(to_fetch)
+            )
+        }
+        for name in to_fetch:
+            item = fetched.get(name)
+            if item is None:
+                missing_breed_cache.set(name, True)
+            else:
+                breed_data_cache.set(name, item)
+            breeds_data[name] = item
+    return breeds_data
+
+
+def warm_breed_cache():
+    """
+    loads the whole breed attribute table (a few dozen rows) into the cache
+    """
+    global breed_cache_warm_until
+    table = get_dynamo_resource().Table(os.environ["ANIMAL_ATTRIBUTES_DDB_TBL"])
+    scan_kwargs = {}
+    while True:
+        with latency.timer("dynamodb_scan"):
+            response = table.scan(**scan_kwargs)
+        for item in response.get("Items", []):
+            breed_data_cache.set(item["uuid"], item)
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    breed_cache_warm_until = time.monotonic() + breed_data_cache.ttl
+
+
+def start_breed_cache_warmup():
+    """
+    starts warm_breed_cache in the background unless the cache is already
+    warm, returning the future to wait on before reading attributes
+    """
+    global breed_cache_warmup
+    if breed_data_cache.ttl <= 0 or time.monotonic() < breed_cache_warm_until:
+        return None
+    with breed_cache_warmup_lock:
+        if breed_cache_warmup is None or breed_cache_warmup.done():
+            breed_cache_warmup = pipeline_pool.submit(warm_breed_cache)
+        return breed_cache_warmup
+
+
+def wait_for_warmup(future):
+    """
+    waits for a background warmup, which only ever speeds up later lookups,
+    so its errors are logged rather than raised
+    """
+    if future is None:
+        return
+    try:
+        future.result()
+    except Exception as e:
+        print(e)
+
+
+def get_breed_data(pf_breed_name, prefetch_breed_names=()):
+    """
+    retrieve breed attributes from dynamodb table, in the same shape as a
+    table query response.  Any prefetch_breed_names not already cached are
+    read in the same round trip so later lookups are served from the cache.
+    """
+    breeds_data = get_breeds_data([pf_breed_name, *prefetch_breed_names])
+    item = breeds_data[pf_breed_name]
+    return {"Items": [item] if item is not None else []}
+
+
+def fetch_model_arn(animal_type):
+    """
+    looks up the arn of the promoted model for the animal type in ssm
+    and caches it, concurrent lookups share one ssm call
+    """
+
+    def fetch():
+        with latency.timer("ssm_get_parameter"):
+            parameter = ssm.get_parameter(
+                Name=f"/animal-rekognition/{animal_type}/model/model-arn"
+            )
+        model_arn = str(parameter["Parameter"]["Value"])
+        model_arn_cache.set(animal_type, model_arn)
+        return model_arn
+
+    return model_arn_flights.do(animal_type, fetch)
+
+
+def refresh_model_arn_in_background(animal_type):
+    with model_arn_refresh_lock:
+        if animal_type in model_arn_refreshes:
+            return
+        model_arn_refreshes.add(animal_type)
+
+    def refresh():
+        try:
+            fetch_model_arn(animal_type)
+        except Exception as e:
+            print(e)
+        finally:
+            with model_arn_refresh_lock:
+                model_arn_refreshes.discard(animal_type)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def get_model_arn(animal_type, force_refresh=False):
+    """
+    returns the model arn for the animal type from the container cache.
+    Entries younger than MODEL_ARN_CACHE_TTL are used as is, entries younger
+    than MODEL_ARN_STALE_TTL are used while ssm is re-read in the background,
+    anything older is re-read before returning.
+    """
+    if not force_refresh:
+        entry = model_arn_cache.get_entry(animal_type)
+        if entry is not None:
+            model_arn, age = entry
+            if age < model_arn_cache_ttl:
+                return model_arn
+            if age < model_arn_stale_ttl:
+                refresh_model_arn_in_background(animal_type)
+                return model_arn
+    return fetch_model_arn(animal_type)
+
+
+def is_stale_model_error(e):
+    return (
+        isinstance(e, ClientError)
+        and e.response.get("Error", {}).get("Code") in STALE_MODEL_ERROR_CODES
+    )
+
+
+_UNSET = object()
+
+
+def s3_image(bucket, prefix):
+    return {"S3Object": {"Bucket": bucket, "Name": prefix}}
+
+
+def bytes_image(image_bytes):
+    return {"Bytes": image_bytes}
+
+
+def detect_breed_labels(model_arn, image, min_confidence):
+    """
+    runs the Rekognition custom labels model against an image (the Image
+    argument of detect_custom_labels, see s3_image and bytes_image) and records
+    the call so that connections can be drained before the model is stopped.
+    Calls go through rekognition_guard, exceptions are left to the caller.
+    """
+
+    def detect():
+        with latency.timer("rekognition_detect_custom_labels", model_arn=model_arn):
+            return rekognition_client.detect_custom_labels(
+                Image=image,
+                MinConfidence=min_confidence,
+                ProjectVersionArn=model_arn,
+            )
+
+    result = rekognition_guard.call(
+        model_arn, detect, acquire_timeout=detect_acquire_timeout.get()
+    )
+    metrics.increment("RekognitionDetectCustomLabelsCalls", {"ModelArn": model_arn})
+    return result
+
+
+def detect_breed_labels_with_refresh(animal_type, model_arn, image, min_confidence):
+    """
+    calls detect_breed_labels, and if Rekognition rejects the cached model arn
+    re-reads it from ssm and retries once with the new arn.
+    Returns the response and the model arn that produced it.
+    """
+    try:
+        return detect_breed_labels(model_arn, image, min_confidence), model_arn
+    except ClientError as e:
+        if not is_stale_model_error(e):
+            raise
+        fresh_model_arn = get_model_arn(animal_type, force_refresh=True)
+        if fresh_model_arn == model_arn:
+            raise
+        result = detect_breed_labels(fresh_model_arn, image, min_confidence)
+        return result, fresh_model_arn
+
+
+def get_image_version(bucket, prefix):
+    """
+    returns (etag, version id) of the s3 object, or None if it can't be read
+    """
+    try:
+        with latency.timer("s3_head_object"):
+            head = s3.head_object(Bucket=bucket, Key=prefix)
+    except Exception as e:
+        print(e)
+        return None
+    return head.get("ETag"), head.get("VersionId")
+
+
+def get_image_cache_address(image):
+    """
+    returns (bucket, key, etag, version id) identifying the image content,
+    inline bytes are addressed by their sha256
+    """
+    if "Bytes" in image:
+        return None, None, hashlib.sha256(image["Bytes"]).hexdigest(), None
+    bucket = image["S3Object"]["Bucket"]
+    prefix = image["S3Object"]["Name"]
+    image_version = get_image_version(bucket, prefix)
+    if image_version is None:
+        return None
+    return (bucket, prefix, *image_version)
+
+
+def prediction_cache_enabled():
+    return prediction_cache.memory_cache.ttl > 0
+
+
+def image_key(image):
+    """
+    identifies the image of a request, the s3 object or the inline bytes
+    """
+    if "Bytes" in image:
+        return "bytes", hashlib.sha256(image["Bytes"]).hexdigest()
+    return "s3", image["S3Object"]["Bucket"], image["S3Object"]["Name"]
+
+
+def get_breed_labels(animal_type, model_arn, image, min_confidence, address=_UNSET):
+    """
+    returns the Rekognition response for an image, from the prediction cache
+    when the same image content was already predicted by the model.
+    address is the get_image_cache_address result when already looked up.
+    Concurrent calls for the same model and image share one cache lookup and
+    Rekognition call, so the response must not be modified.
+    """
+    return breed_labels_flights.do(
+        (model_arn, image_key(image), min_confidence),
+        lambda: predict_breed_labels(
+            animal_type, model_arn, image, min_confidence, address
+        ),
+    )
+
+
+def read_image_header(bucket, prefix, if_none_match=None):
+    """
+    ranged GET of the start of an s3 object, not read again when its etag is
+    if_none_match.
+    Returns (header, object size, etag)
+    """
+    kwargs = {"IfNoneMatch": if_none_match} if if_none_match else {}
+    head = s3.get_object(
+        Bucket=bucket, Key=prefix, Range=f"bytes=0-{HEADER_BYTES - 1}", **kwargs
+    )
+    size = int(head["ContentRange"].rsplit("/", 1)[1])
+    return head["Body"].read(), size, head.get("ETag")
+
+
+def count_missing_end_marker(header, tail, verdict):
+    """
+    the end marker is not checked, images without one are only counted
+    """
+    if verdict is None and missing_end_marker(header, tail):
+        metrics.increment("ImagesWithoutEndMarker")
+
+
+def validate_s3_image(bucket, prefix, etag=None):
+    """
+    returns the check_image verdict for an s3 object, cached by its etag:
+    the etag of the prediction cache address when given, otherwise the
+    header GET is made conditional on the cached etag.
+    Objects that can't be read for other reasons than not existing are let
+    through, Rekognition reports those itself.
+    """
+    cached = validation_cache.get((bucket, prefix))
+    if cached is not None and etag is not None and cached[0] == etag:
+        return cached[1]
+    try:
+        with latency.timer("s3_validate_image"):
+            header, size, etag = read_image_header(
+                bucket, prefix, cached[0] if cached is not None else None
+            )
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code == "304":
+            # not modified since it was validated
+            return cached[1]
+        if code in ("NoSuchKey", "404"):
+            return IMAGE_NOT_FOUND, f"s3://{bucket}/{prefix} does not exist"
+        if code == "InvalidRange":
+            return IMAGE_TRUNCATED, "image is empty"
+        print(e)
+        return None
+    except BotoCoreError as e:
+        # e.g. EndpointConnectionError
+        print(e)
+        return None
+    verdict = check_image(header, size)
+    if etag is not None:
+        validation_cache.set((bucket, prefix), (etag, verdict))
+    return verdict
+
+
+def validate_image(image, address=None):
+    """
+    raises a PredictionError with the verdict code when the image is not one
+    Rekognition can read
+    """
+    if not validate_images:
+        return
+    if "Bytes" in image:
+        image_bytes = image["Bytes"]
+        header = image_bytes[:HEADER_BYTES]
+        verdict = check_image(header, len(image_bytes), max_bytes=MAX_IMAGE_BYTES)
+        count_missing_end_marker(header, image_bytes[-TAIL_BYTES:], verdict)
+    else:
+        etag = address[2] if address else None
+        verdict = validate_s3_image(
+            image["S3Object"]["Bucket"], image["S3Object"]["Name"], etag
+        )
+    if verdict is not None:
+        metrics.increment("InvalidImages", {"ErrorCode": verdict[0]})
+        raise PredictionError(*verdict)
+
 
+def get_image_hash(image):
+    """
+    perceptual hash of the image, downloading it from s3 when needed.
+    Nothing is downloaded when the image can't be hashed.
+    """
+    if not can_hash():
+        return None
+    if "Bytes" in image:
+        image_bytes = image["Bytes"]
+    else:
+        try:
+            with latency.timer("s3_get_object"):
+                image_bytes = s3.get_object(
+                    Bucket=image["S3Object"]["Bucket"], Key=image["S3Object"]["Name"]
+                )["Body"].read()
+        except Exception as e:
+            print(e)
+            return None
+    with latency.timer("image_hash"):
+        return dhash(image_bytes)
 
-def get_breed_data(pf_breed_name):
+
+def detect_breed_labels_with_near_duplicates(
+    animal_type, model_arn, image, min_confidence
+):
     """
-    retrieve breed attributes from dynamodb table
+    detect_breed_labels_with_refresh, served from the near duplicate cache
+    when a similar enough image was predicted by the model before.
+    Returns the response and the model arn used
     """
-    dynamo_resource = boto3.resource("dynamodb")
-    table = os.environ["ANIMAL_ATTRIBUTES_DDB_TBL"]
-    table = dynamo_resource.Table(table)
-    response = table.query(KeyConditionExpression=Key("uuid").eq(pf_breed_name))
-    return response
+    if not near_duplicate_cache_enabled:
+        return detect_breed_labels_with_refresh(
+            animal_type, model_arn, image, min_confidence
+        )
+    image_hash = get_image_hash(image)
+    if image_hash is None:
+        return detect_breed_labels_with_refresh(
+            animal_type, model_arn, image, min_confidence
+        )
+
+    match = near_duplicate_cache.get(model_arn, min_confidence, image_hash)
+    if match is not None and not near_duplicate_cache.should_verify():
+        return match[0], model_arn
+    result, used_model_arn = detect_breed_labels_with_refresh(
+        animal_type, model_arn, image, min_confidence
+    )
+    if match is not None and used_model_arn == model_arn:
+        near_duplicate_cache.verify(match[0], result)
+    near_duplicate_cache.set(used_model_arn, min_confidence, image_hash, result)
+    return result, used_model_arn
+
+
+def predict_breed_labels(animal_type, model_arn, image, min_confidence, address):
+    if address is _UNSET:
+        address = get_image_cache_address(image) if prediction_cache_enabled() else None
+    if address is None:
+        validate_image(image)
+        return detect_breed_labels_with_near_duplicates(
+            animal_type, model_arn, image, min_confidence
+        )[0]
+
+    key = prediction_cache.make_key(model_arn, *address, min_confidence)
+    with latency.timer("prediction_cache_get", model_arn=model_arn):
+        result = prediction_cache.get(key)
+    if result is None:
+        validate_image(image, address)
+        result, used_model_arn = detect_breed_labels_with_near_duplicates(
+            animal_type, model_arn, image, min_confidence
+        )
+        if used_model_arn != model_arn:
+            key = prediction_cache.make_key(used_model_arn, *address, min_confidence)
+        prediction_cache.set(key, used_model_arn, result)
+    return result
+
+
+def is_auto_animal_type(animal_type):
+    return animal_type is None or animal_type == AUTO_ANIMAL_TYPE
+
+
+def species_confidences(breed_response):
+    """
+    returns {species: highest confidence} from the species- labels of a
+    Rekognition response, without changing the response
+    """
+    confidences = {}
+    for label in breed_response.get("CustomLabels", []):
+        kind, name, label_id = label_codec.decode(label["Name"])
+        if kind == "species":
+            species = name.lower()
+            confidences[species] = max(
+                confidences.get(species, 0.0), label["Confidence"]
+            )
+    return confidences
+
+
+def get_auto_breed_labels(image, min_confidence):
+    """
+    predicts the image with the model of every animal type at once and returns
+    (animal type, response) for the species the models agree on.
+    As soon as any response has a species label of at least
+    AUTO_ROUTE_MIN_SPECIES_CONFIDENCE that species' model wins, and calls to
+    the other models are cancelled if not started or otherwise ignored.
+    Without a confident species the response with the strongest label for
+    its own species is used.
+    """
+
+    def predict(animal_type):
+        return get_breed_labels(
+            animal_type, get_model_arn(animal_type), image, min_confidence
+        )
+
+    # the models are called with the acquire timeout of the request
+    predictions = {
+        animal_type: auto_route_pool.submit(
+            contextvars.copy_context().run, predict, animal_type
+        )
+        for animal_type in animal_types
+    }
+    futures = {future: animal_type for animal_type, future in predictions.items()}
+    responses = {}
+    errors = {}
+    votes = {}
+    winner = None
+    pending = set(futures)
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            animal_type = futures[future]
+            try:
+                responses[animal_type] = future.result()
+            except Exception as e:
+                print(e)
+                errors[animal_type] = e
+                continue
+            for species, confidence in species_confidences(
+                responses[animal_type]
+            ).items():
+                votes[species] = max(votes.get(species, 0.0), confidence)
+        confident = [
+            species
+            for species, confidence in votes.items()
+            if species in animal_types
+            and confidence >= auto_route_min_species_confidence
+        ]
+        if confident:
+            winner = max(confident, key=votes.get)
+
+    if winner is None:
+        if not responses:
+            raise next(iter(errors.values()))
+        # each model's response is scored by its own species label
+        winner = max(
+            responses,
+            key=lambda animal_type: species_confidences(responses[animal_type]).get(
+                animal_type, 0.0
+            ),
+        )
+    else:
+        for future in pending:
+            if futures[future] != winner:
+                future.cancel()
+        if winner in errors:
+            raise errors[winner]
+        if winner not in responses:
+            responses[winner] = predictions[winner].result()
+
+    metrics.increment("AutoRoutedPredictions", {"AnimalType": winner})
+    return winner, responses[winner]
 
 
 def get_breed_prediction(
-    animal_type, bucket, prefix, min_confidence=minimum_confidence
+    animal_type, bucket, prefix, min_confidence=minimum_confidence, image=None
 ):
     """
     gets predictions for an image in s3 using the Rekognition image classification endpoint
     for the animal type.  The endpoint returns classifications for breed, coat, and color.
     It is possible that any of these will have no predictions, in which case the list of
     candidates in the response will be empty.
+    image overrides bucket and prefix, e.g. for inline image bytes.
+    A failed prediction has no labels and an "Error" with the code and message.
+    An "auto" or missing animal type is routed by get_auto_breed_labels and the
+    chosen one is returned as "AnimalType".
     """
+    if image is None:
+        image = s3_image(bucket, prefix)
     try:
-        MODEL_REKOGNITION_ENDPOINT = str(
-            ssm.get_parameter(
-                Name=f"/animal-rekognition/{animal_type}/model/model-arn"
-            )["Parameter"]["Value"]
-        )
-        result = rekognition_client.detect_custom_labels(
-            Image={"S3Object": {"Bucket": bucket, "Name": prefix}},
-            MinConfidence=min_confidence,
-            ProjectVersionArn=MODEL_REKOGNITION_ENDPOINT,
-        )
-        write_logs = cloudwatch.put_metric_data(
-            Namespace="Petfinder/Rekognition/Model/DetectCustomLabels",
-            MetricData=[
-                {
-                    "MetricName": "RekognitionDetectCustomLabelsCalls",
-                    "Dimensions": [
-                        {"Name": "ModelArn", "Value": MODEL_REKOGNITION_ENDPOINT},
-                    ],
-                    "Value": 1.0,
-                    "Unit": "Count",
-                },
-            ],
+        if is_auto_animal_type(animal_type):
+            animal_type, result = get_auto_breed_labels(image, min_confidence)
+            return {**result, "AnimalType": animal_type}
+        if overlap_io and prediction_cache_enabled():
+            # the model arn and the image version are independent lookups
+            address = pipeline_pool.submit(get_image_cache_address, image)
+            model_arn = get_model_arn(animal_type)
+            address = address.result()
+        else:
+            model_arn = get_model_arn(animal_type)
+            address = _UNSET
+        result = get_breed_labels(
+            animal_type, model_arn, image, min_confidence, address=address
         )
     except Exception as e:
         print(e)
-        result = {}
+        result = {"CustomLabels": [], "Error": prediction_error(e)}
     return result
 
 
-def split_name_id(label):
-    """
-    Parses text label and id if one is present
-    convention for labels is:
-    breed-<BreedName>||<BreedId>
-    e.g.
-    breed-Tiger||137
-    if no id is present, returns an empty string
-    """
-    tup = label.split(SEPARATOR)
-    return tup + [""] * max(0, 2 - len(tup))
+def prediction_error(e):
+    code = prediction_error_code(e)
+    metrics.increment("PredictionErrors", {"ErrorCode": code})
+    return {"Code": code, "Message": str(e)}
 
 
 def partition_labels(label_list):
     """
     Parses Rekognition labels into separate lists
     """
-    labels = {"breed": [], "species": []}
-    for label_dict in label_list:
-        if label_dict["Name"].startswith("species-"):
-            species_name, species_id = split_name_id(label_dict["Name"][8:])
-            label_dict["Name"] = species_name
-            label_dict["Id"] = species_id
-            labels["species"].append(label_dict)
-        elif label_dict["Name"].startswith("breed-"):
-            breed_name, breed_id = split_name_id(label_dict["Name"][6:])
-            label_dict["Name"] = breed_name
-            label_dict["Id"] = breed_id
-            labels["breed"].append(label_dict)
-    return labels
+    return label_codec.partition(label_list)
 
 
 def int_cast(val):
@@ -116,31 +827,26 @@ def int_cast(val):
         return val
 
 
-def get_inferred_attributes(
-    bucket, image_prefix, animal_type, min_confidence=5, top_n=3
-):
-
-    breed_response = get_breed_prediction(
-        animal_type, bucket, image_prefix, min_confidence
-    )
-
+def get_labels(breed_response):
     try:
-        labels = partition_labels(breed_response["CustomLabels"])
-
+        return partition_labels(breed_response["CustomLabels"])
     except KeyError as e:
-        labels = {"breed": [], "species": []}
+        return {"breed": [], "species": []}
+
 
+def get_attributes(breed_data):
+    """
+    picks the attributes to send out of a get_breed_data response
+    """
     try:
-        breed_name = labels["breed"][0]["Name"]
-        breed_data = get_breed_data(breed_name)
         all_attrs = breed_data["Items"][0]
-        attributes = {
-            k: int_cast(v) for k, v in all_attrs.items() if k in attributes_to_send
-        }
+        return {k: int_cast(v) for k, v in all_attrs.items() if k in attributes_to_send}
     except (IndexError, KeyError) as e:
-        attributes = {"ERROR": str(e)}
+        return {"ERROR": str(e)}
+
 
-    ret_dict = {
+def format_inferred_attributes(labels, attributes, top_n):
+    return {
         "breed": labels["breed"][:top_n],
         "species": labels["species"][:top_n],
         "attribute_1": attributes.get("attribute_1", None),
@@ -148,18 +854,206 @@ def get_inferred_attributes(
         "attribute_3": attributes.get("attribute_3", None),
     }
 
-    return ret_dict
 
+def get_inferred_attributes(
+    bucket, image_prefix, animal_type, min_confidence=5, top_n=3, image=None
+):
 
-def lambda_handler(event, context):
-    animal_type = event["animal_type"]
-    path_chunks = event["image_path"].split("/")
+    # fill the breed attribute cache while Rekognition runs
+    warmup = start_breed_cache_warmup() if overlap_io else None
+
+    breed_response = get_breed_prediction(
+        animal_type, bucket, image_prefix, min_confidence, image=image
+    )
+    wait_for_warmup(warmup)
+
+    labels = get_labels(breed_response)
+
+    try:
+        breed_names = [label["Name"] for label in labels["breed"][:top_n]]
+        breed_data = get_breed_data(breed_names[0], breed_names[1:])
+        attributes = get_attributes(breed_data)
+    except (IndexError, KeyError) as e:
+        attributes = {"ERROR": str(e)}
+
+    inferred_attributes = format_inferred_attributes(labels, attributes, top_n)
+    if "AnimalType" in breed_response:
+        inferred_attributes["animal_type"] = breed_response["AnimalType"]
+    if "Error" in breed_response:
+        inferred_attributes["error_code"] = breed_response["Error"]["Code"]
+        inferred_attributes["error"] = breed_response["Error"]["Message"]
+    return inferred_attributes
+
+
+def get_batch_inferred_attributes(
+    images, min_confidence=5, top_n=3, max_workers=batch_max_workers
+):
+    """
+    predicts a batch of images, each a dict with "animal_type" and either
+    "image_path" or base64 "image_bytes".
+    Model arns are resolved once per animal type and breed attributes once per
+    breed, while the Rekognition calls are spread over a bounded thread pool.
+    Results are returned in input order; an image that fails gets an "error"
+    entry instead of failing the whole batch.
+    Images without an animal type, or "auto", are routed per image.
+    """
+    model_arns = {}
+    for animal_type in {image.get("animal_type") for image in images}:
+        if is_auto_animal_type(animal_type):
+            continue
+        try:
+            model_arns[animal_type] = get_model_arn(animal_type)
+        except Exception as e:
+            print(e)
+            model_arns[animal_type] = e
+
+    def predict(image):
+        animal_type = image.get("animal_type")
+        if is_auto_animal_type(animal_type):
+            animal_type, response = get_auto_breed_labels(
+                get_request_image(image), min_confidence
+            )
+            return {**response, "AnimalType": animal_type}
+        model_arn = model_arns[animal_type]
+        if isinstance(model_arn, Exception):
+            raise model_arn
+        return get_breed_labels(
+            animal_type, model_arn, get_request_image(image), min_confidence
+        )
+
+    def try_predict(image):
+        detect_acquire_timeout.set(batch_acquire_timeout)
+        try:
+            return predict(image), None
+        except Exception as e:
+            print(e)
+            return None, e
+
+    warmup = start_breed_cache_warmup() if overlap_io and images else None
+    # workers beyond the calls a model answers per second only wait for the
+    # limiter
+    if detect_rate > 0:
+        max_workers = min(max_workers, math.ceil(detect_rate))
+    if images:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(images))) as pool:
+            predictions = list(pool.map(try_predict, images))
+    else:
+        predictions = []
+    wait_for_warmup(warmup)
+
+    labels_list = [
+        get_labels(response) if error is None else None
+        for response, error in predictions
+    ]
+
+    breed_names = [
+        labels["breed"][0]["Name"]
+        for labels in labels_list
+        if labels and labels["breed"]
+    ]
+    breed_attributes = {
+        name: get_attributes({"Items": [item] if item is not None else []})
+        for name, item in get_breeds_data(breed_names).items()
+    }
+
+    results = []
+    for image, labels, (response, error) in zip(images, labels_list, predictions):
+        if error is not None:
+            results.append(
+                {
+                    "image_path": image.get("image_path"),
+                    "error": str(error),
+                    "error_code": prediction_error(error)["Code"],
+                }
+            )
+            continue
+        if labels["breed"]:
+            attributes = breed_attributes[labels["breed"][0]["Name"]]
+        else:
+            attributes = {"ERROR": "list index out of range"}
+        result = format_inferred_attributes(labels, attributes, top_n)
+        if "image_path" in image:
+            result["image_path"] = image["image_path"]
+        if "AnimalType" in response:
+            result["animal_type"] = response["AnimalType"]
+        results.append(result)
+    return results
+
+
+def parse_s3_path(image_path):
+    """
+    splits s3://bucket/key into bucket and key
+    """
+    path_chunks = image_path.split("/")
     bucket = path_chunks[2]
     prefix = os.path.join(*path_chunks[3:])
+    return bucket, prefix
+
+
+def get_request_image(request):
+    """
+    builds the Rekognition image for a request with either an "image_path" in
+    s3 or base64 "image_bytes", which are downscaled before being sent
+    """
+    if "image_bytes" in request:
+        with latency.timer("image_prepare"):
+            image_bytes = prepare_image_bytes(
+                request["image_bytes"], max_image_dimension, image_jpeg_quality
+            )
+        return bytes_image(image_bytes)
+    return s3_image(*parse_s3_path(request["image_path"]))
+
+
+def lambda_handler(event, context):
+    latency.start_request()
+    try:
+        with latency.timer("request"):
+            response = handle_event(event)
+        if debug_timings:
+            response["timings_ms"] = latency.request_timings()
+        return response
+    finally:
+        prediction_cache.wait_for_writes()
+        metrics.flush()
+        latency.maybe_export()
+
+
+def handle_event(event):
     top_n = event.get("top_n", DEFAULT_TOP_N)
 
+    # batch mode, either {"images": [{"image_path": ..., "animal_type": ...}]} or
+    # {"image_paths": [...], "animal_type": ...}
+    if "images" in event or "image_paths" in event:
+        if "images" in event:
+            images = event["images"]
+        else:
+            images = [{"image_path": image_path} for image_path in event["image_paths"]]
+        images = [
+            {"animal_type": event.get("animal_type"), **image} for image in images
+        ]
+        return {"results": get_batch_inferred_attributes(images, top_n=top_n)}
+
+    animal_type = event.get("animal_type", AUTO_ANIMAL_TYPE)
+    try:
+        image = get_request_image(event)
+    except ValueError as e:
+        # image_bytes that can't be decoded or are over the limit, reported
+        # like any other failed prediction
+        print(e)
+        return {
+            **format_inferred_attributes(get_labels({"CustomLabels": []}), {}, top_n),
+            "error_code": prediction_error(e)["Code"],
+            "error": str(e),
+        }
+    bucket = image.get("S3Object", {}).get("Bucket")
+    prefix = image.get("S3Object", {}).get("Name")
+
     inferred_attributes = get_inferred_attributes(
-        bucket=bucket, image_prefix=prefix, animal_type=animal_type, top_n=top_n
+        bucket=bucket,
+        image_prefix=prefix,
+        animal_type=animal_type,
+        top_n=top_n,
+        image=image,
     )
 
     return inferred_attributes
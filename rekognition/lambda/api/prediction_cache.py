@@ -0,0 +1,108 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import json
+import time
+import hashlib
+import threading
+
+
+class PredictionCache:
+    """
+    Two tier cache of Rekognition responses: an in-process TTLCache in front of
+    an optional DynamoDB table shared by all containers.  Keys include the model
+    arn, so promoting a new model starts a fresh set of entries and the old ones
+    expire through the table's TTL attribute.
+    Cache failures are logged and treated as misses, never as failed predictions.
+    Table writes are submitted to executor when one is given so they overlap
+    the rest of the request, and wait_for_writes waits for them before the
+    request returns, as the lambda may be frozen right after.
+    """
+
+    def __init__(
+        self,
+        memory_cache,
+        table_name=None,
+        get_dynamo_resource=None,
+        metrics=None,
+        executor=None,
+    ):
+        self.memory_cache = memory_cache
+        self.table_name = table_name
+        self.get_dynamo_resource = get_dynamo_resource
+        self.metrics = metrics
+        self.executor = executor
+        self._writes = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_arn, bucket, prefix, etag, version_id, min_confidence):
+        """
+        content address of a prediction, the s3 object is identified by its
+        etag and version so an overwritten image gets a new key
+        """
+        raw = "|".join(
+            str(part)
+            for part in (model_arn, bucket, prefix, etag, version_id, min_confidence)
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def table(self):
+        return self.get_dynamo_resource().Table(self.table_name)
+
+    def record(self, name, tier):
+        if self.metrics is not None:
+            self.metrics.increment(name, {"Tier": tier})
+
+    def get(self, key):
+        response = self.memory_cache.get(key)
+        if response is not None:
+            self.record("PredictionCacheHits", "memory")
+            return response
+
+        if self.table_name:
+            try:
+                item = self.table().get_item(Key={"cache_key": key}).get("Item")
+            except Exception as e:
+                print(e)
+                item = None
+            if item is not None and int(item["expires_at"]) > time.time():
+                response = json.loads(item["response"])
+                self.memory_cache.set(key, response)
+                self.record("PredictionCacheHits", "dynamodb")
+                return response
+
+        self.record("PredictionCacheMisses", "all")
+        return None
+
+    def set(self, key, model_arn, response):
+        response = {"CustomLabels": response.get("CustomLabels", [])}
+        self.memory_cache.set(key, response)
+        if self.table_name:
+            if self.executor is not None:
+                write = self.executor.submit(self.put_item, key, model_arn, response)
+                with self._lock:
+                    self._writes.append(write)
+            else:
+                self.put_item(key, model_arn, response)
+
+    def wait_for_writes(self):
+        """
+        waits for the table writes submitted so far
+        """
+        with self._lock:
+            writes, self._writes = self._writes, []
+        for write in writes:
+            write.result()
+
+    def put_item(self, key, model_arn, response):
+        try:
+            self.table().put_item(
+                Item={
+                    "cache_key": key,
+                    "model_arn": model_arn,
+                    "response": json.dumps(response),
+                    "expires_at": int(time.time() + self.memory_cache.ttl),
+                }
+            )
+        except Exception as e:
+            print(e)
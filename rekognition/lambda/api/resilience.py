@@ -0,0 +1,289 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import time
+import random
+import threading
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+THROTTLE_ERROR_CODES = {"ThrottlingException", "ProvisionedThroughputExceededException"}
+# the model is stopped, starting or stopping
+MODEL_NOT_RUNNING_ERROR_CODES = {"ResourceNotReadyException"}
+MODEL_NOT_FOUND_ERROR_CODES = {"ResourceNotFoundException", "InvalidParameterException"}
+INVALID_IMAGE_ERROR_CODES = {
+    "InvalidImageFormatException",
+    "ImageTooLargeException",
+    "InvalidS3ObjectException",
+}
+SERVER_ERROR_CODES = {"InternalServerError", "ServiceUnavailableException"}
+# botocore errors of a request that may succeed when sent again, e.g.
+# EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError
+TRANSIENT_ERRORS = (ConnectionError, HTTPClientError)
+# botocore retries of clients whose calls go through a RekognitionGuard, which
+# retries throttles, server and connection errors itself
+GUARDED_CLIENT_RETRIES = {"total_max_attempts": 1}
+
+# error codes returned in predict responses
+RATE_LIMITED = "RATE_LIMITED"
+THROTTLED = "THROTTLED"
+CIRCUIT_OPEN = "CIRCUIT_OPEN"
+MODEL_NOT_RUNNING = "MODEL_NOT_RUNNING"
+MODEL_NOT_FOUND = "MODEL_NOT_FOUND"
+INVALID_IMAGE = "INVALID_IMAGE"
+PREDICTION_FAILED = "PREDICTION_FAILED"
+
+
+class PredictionError(Exception):
+    """
+    a prediction that failed for a reason callers can act on, code is one of
+    the error codes above
+    """
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def client_error_code(e):
+    if isinstance(e, ClientError):
+        return e.response.get("Error", {}).get("Code")
+    return None
+
+
+def prediction_error_code(e):
+    """
+    maps an exception raised while predicting to the error code returned to
+    the caller
+    """
+    if isinstance(e, PredictionError):
+        return e.code
+    code = client_error_code(e)
+    if code in THROTTLE_ERROR_CODES:
+        return THROTTLED
+    if code in MODEL_NOT_RUNNING_ERROR_CODES:
+        return MODEL_NOT_RUNNING
+    if code in MODEL_NOT_FOUND_ERROR_CODES:
+        return MODEL_NOT_FOUND
+    if code in INVALID_IMAGE_ERROR_CODES or isinstance(e, ValueError):
+        return INVALID_IMAGE
+    return PREDICTION_FAILED
+
+
+class TokenBucket:
+    """
+    Allows rate calls per second on average with bursts of up to capacity
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """
+        takes a token if one is available, otherwise returns the seconds until
+        the next one is
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout):
+        """
+        waits up to timeout seconds for a token, returns False if none came
+        """
+        deadline = self.clock() + timeout
+        while True:
+            wait = self._take()
+            if wait == 0:
+                return True
+            if self.clock() + wait > deadline:
+                return False
+            self.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and fails calls fast
+    for reset_timeout seconds, then lets one trial call through and closes
+    again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_running or (
+                self.clock() - self._opened_at < self.reset_timeout
+            ):
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def cancel_trial(self):
+        """
+        gives up a trial call that was allowed but never made
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = self.clock()
+            self._trial_running = False
+
+
+class RekognitionGuard:
+    """
+    Wraps calls to a Rekognition model with a token bucket limiter, retries
+    of throttled calls, server errors and connection errors with full jitter
+    exponential backoff and a circuit breaker, each kept per model arn.
+    Errors that outlast the retries and a stopped model count towards
+    opening the breaker.
+    """
+
+    def __init__(
+        self,
+        rate,
+        capacity,
+        acquire_timeout=1.0,
+        max_attempts=4,
+        base_delay=0.05,
+        max_delay=1.0,
+        failure_threshold=5,
+        reset_timeout=30.0,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self.acquire_timeout = acquire_timeout
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.sleep = sleep
+        self._buckets = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, model_arn):
+        with self._lock:
+            if model_arn not in self._buckets:
+                self._buckets[model_arn] = TokenBucket(
+                    self.rate, self.capacity, clock=self.clock, sleep=self.sleep
+                )
+            return self._buckets[model_arn]
+
+    def breaker(self, model_arn):
+        with self._lock:
+            if model_arn not in self._breakers:
+                self._breakers[model_arn] = CircuitBreaker(
+                    self.failure_threshold, self.reset_timeout, clock=self.clock
+                )
+            return self._breakers[model_arn]
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def call(self, model_arn, fn, acquire_timeout=None):
+        """
+        calls fn(), raising PredictionError when the call is not made or
+        every attempt was throttled, and the last error when every attempt
+        failed with a server or connection error.
+        acquire_timeout overrides the guard's for this call.
+        """
+        if acquire_timeout is None:
+            acquire_timeout = self.acquire_timeout
+        breaker = self.breaker(model_arn)
+        if not breaker.allow():
+            raise PredictionError(
+                CIRCUIT_OPEN, f"{model_arn} is failing, not calling it for now"
+            )
+        for attempt in range(self.max_attempts):
+            if self.rate > 0 and not self.bucket(model_arn).acquire(acquire_timeout):
+                breaker.cancel_trial()
+                raise PredictionError(
+                    RATE_LIMITED, f"over the request rate of {model_arn}"
+                )
+            retries_left = attempt + 1 < self.max_attempts
+            try:
+                result = fn()
+            except ClientError as e:
+                code = client_error_code(e)
+                if code in THROTTLE_ERROR_CODES | SERVER_ERROR_CODES and retries_left:
+                    self.sleep(self.backoff(attempt))
+                    continue
+                if code in THROTTLE_ERROR_CODES:
+                    breaker.record_failure()
+                    raise PredictionError(
+                        THROTTLED,
+                        f"{model_arn} throttled {self.max_attempts} attempts: {e}",
+                    )
+                if code in MODEL_NOT_RUNNING_ERROR_CODES | SERVER_ERROR_CODES:
+                    breaker.record_failure()
+                else:
+                    # the model answered, e.g. a bad image
+                    breaker.record_success()
+                raise
+            except TRANSIENT_ERRORS:
+                if retries_left:
+                    self.sleep(self.backoff(attempt))
+                    continue
+                breaker.record_failure()
+                raise
+            except Exception:
+                breaker.record_failure()
+                raise
+            breaker.record_success()
+            return result
+
+
+def blocking_guard(rate, max_attempts):
+    """
+    a guard for the batch scripts, whose calls wait for the limiter rather
+    than fail after a second and whose breaker only opens when every worker
+    keeps failing
+    """
+    return RekognitionGuard(
+        rate=rate,
+        capacity=max(1.0, rate),
+        acquire_timeout=600.0,
+        max_attempts=max_attempts,
+        max_delay=20.0,
+        failure_threshold=50,
+    )
@@ -0,0 +1,43 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    call and the others wait for it and share its result or exception.
+    Nothing is kept once the call finishes, caching is left to the caller.
+    Coalesced calls are counted in a CoalescedCalls metric by Call name.
+    """
+
+    def __init__(self, name, metrics=None):
+        self.name = name
+        self.metrics = metrics
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            if self.metrics is not None:
+                self.metrics.increment("CoalescedCalls", {"Call": self.name})
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
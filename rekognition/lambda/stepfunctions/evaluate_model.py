@@ -84,7 +84,10 @@ def handler(event, context):
     accuracy = model_metrics["accuracy"]
 
     promote = True
-    if animal == "dog" and accuracy < dog_accuracy:
+    if "promotion" in model_metrics:
+        # decided by the sequential test of an early stopped evaluation
+        promote = model_metrics["promotion"]["decision"] == "promote"
+    elif animal == "dog" and accuracy < dog_accuracy:
         promote = False
     elif animal == "cat" and accuracy < cat_accuracy:
         promote = False
@@ -98,6 +101,7 @@ def handler(event, context):
             "version_name": version_name,
             "project_arn": project_arn,
             "accuracy": accuracy,
+            "uuid": uuid,
         }
     elif promote == True:
         return {
@@ -106,4 +110,5 @@ def handler(event, context):
             "version_name": version_name,
             "project_arn": project_arn,
             "accuracy": accuracy,
+            "uuid": uuid,
         }
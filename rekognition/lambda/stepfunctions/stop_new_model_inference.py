@@ -27,7 +27,9 @@ def handler(event, context):
             version_arn = version["ProjectVersionArn"]
             status = version["Status"]
 
-    if status == "STOPPED":
+    # TRAINING_COMPLETED when the model was evaluated from its training output
+    # and never started
+    if status in ("STOPPED", "TRAINING_COMPLETED"):
         ssm = boto3.client("ssm")
         topic_arn = ssm.get_parameter(Name="/animal-rekognition/sns/arn")["Parameter"][
             "Value"
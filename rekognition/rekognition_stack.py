@@ -32,12 +32,54 @@ from aws_cdk import (
 )
 
 import aws_cdk as cdk
+import os
 import json
+import subprocess
+import jsii
 from constructs import Construct
 from rekognition.utils.constants import *
 
 config = get_config()
 
+PILLOW_LAYER_PATH = "rekognition/lambda/layers/pillow"
+
+
+@jsii.implements(cdk.ILocalBundling)
+class PipLocalBundling:
+    """
+    installs a layer's requirements.txt with the local pip, as wheels for the
+    lambda's platform, falling back to the docker bundling image when that
+    fails
+    """
+
+    def __init__(self, source_path, python_version="3.9"):
+        self.source_path = source_path
+        self.python_version = python_version
+
+    def try_bundle(self, output_dir, *, image, **kwargs):
+        command = [
+            "pip3",
+            "install",
+            "--quiet",
+            "--platform",
+            "manylinux2014_x86_64",
+            "--only-binary=:all:",
+            "--python-version",
+            self.python_version,
+            "--implementation",
+            "cp",
+            "-r",
+            os.path.join(self.source_path, "requirements.txt"),
+            "-t",
+            os.path.join(output_dir, "python"),
+        ]
+        try:
+            subprocess.run(command, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"local bundling of {self.source_path} failed: {e}")
+            return False
+        return True
+
 
 class RekognitionStack(Stack):
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
@@ -250,62 +292,62 @@ class RekognitionStack(Stack):
         )
 
         # Create state machine definition
+        promote_model = self.update_model_ssm_job.next(
+            stepfunctions.Choice(
+                self,
+                "Stop Previous Model Inference",
+            )
+            .when(
+                stepfunctions.Condition.boolean_equals(
+                    "$.previous_model_running",
+                    True,
+                ),
+                self.wait_before_stop_previous_model.next(
+                    self.stop_previous_model_job.next(
+                        self.model_promote_and_previous_model_stopped
+                    )
+                ),
+            )
+            .when(
+                stepfunctions.Condition.boolean_equals(
+                    "$.previous_model_running",
+                    False,
+                ),
+                self.model_deployed,
+            )
+        )
+        start_model = self.start_model_inference_job.next(
+            self.describe_model_inference_job
+        )
+        if config["evaluationSource"] == "training":
+            # evaluate with the test set predictions of the training job and
+            # only start the model once it is promoted
+            promote_model = start_model.next(promote_model)
+        evaluate_model = self.create_evaluation_metrics_job.next(
+            self.evaluate_model_job.next(
+                stepfunctions.Choice(
+                    self,
+                    "Promote Project Model Choice",
+                )
+                .when(
+                    stepfunctions.Condition.boolean_equals("$.promote", False),
+                    self.skip_promotion_stop_model_job.next(self.do_not_promote),
+                )
+                .when(
+                    stepfunctions.Condition.boolean_equals("$.promote", True),
+                    promote_model,
+                )
+            )
+        )
+        if config["evaluationSource"] != "training":
+            evaluate_model = start_model.next(evaluate_model)
+
         self.state_machine_definition = self.create_uuid_job.next(
             self.create_manifest_job.next(
                 self.create_dataset_job.next(
                     self.describe_dataset_job.next(
                         self.train_model_job.next(
-                            self.describe_model_training_job.next(
-                                self.start_model_inference_job.next(
-                                    self.describe_model_inference_job.next(
-                                        self.create_evaluation_metrics_job.next(
-                                            self.evaluate_model_job.next(
-                                                stepfunctions.Choice(
-                                                    self,
-                                                    "Promote Project Model Choice",
-                                                )
-                                                .when(
-                                                    stepfunctions.Condition.boolean_equals(
-                                                        "$.promote", False
-                                                    ),
-                                                    self.skip_promotion_stop_model_job.next(
-                                                        self.do_not_promote
-                                                    ),
-                                                )
-                                                .when(
-                                                    stepfunctions.Condition.boolean_equals(
-                                                        "$.promote", True
-                                                    ),
-                                                    self.update_model_ssm_job.next(
-                                                        stepfunctions.Choice(
-                                                            self,
-                                                            "Stop Previous Model Inference",
-                                                        )
-                                                        .when(
-                                                            stepfunctions.Condition.boolean_equals(
-                                                                "$.previous_model_running",
-                                                                True,
-                                                            ),
-                                                            self.wait_before_stop_previous_model.next(
-                                                                self.stop_previous_model_job.next(
-                                                                    self.model_promote_and_previous_model_stopped
-                                                                )
-                                                            ),
-                                                        )
-                                                        .when(
-                                                            stepfunctions.Condition.boolean_equals(
-                                                                "$.previous_model_running",
-                                                                False,
-                                                            ),
-                                                            self.model_deployed,
-                                                        )
-                                                    ),
-                                                )
-                                            )
-                                        )
-                                    )
-                                )
-                            )
+                            self.describe_model_training_job.next(evaluate_model)
                         )
                     )
                 )
@@ -422,6 +464,35 @@ class RekognitionStack(Stack):
             ),
         )
 
+        # Create dynamo table for caching predictions across lambda containers
+        self.prediction_cache_table = dynamodb.CfnTable(
+            self,
+            resource_name(dynamodb.Table, "rekognition-prediction-cache-table"),
+            table_name=resource_name(
+                dynamodb.Table, "rekognition-prediction-cache-table"
+            ),
+            key_schema=[
+                dynamodb.CfnTable.KeySchemaProperty(
+                    attribute_name="cache_key", key_type="HASH"
+                ),
+            ],
+            attribute_definitions=[
+                dynamodb.CfnTable.AttributeDefinitionProperty(
+                    attribute_name="cache_key",
+                    attribute_type="S",
+                ),
+            ],
+            time_to_live_specification=dynamodb.CfnTable.TimeToLiveSpecificationProperty(
+                attribute_name="expires_at", enabled=True
+            ),
+            sse_specification=dynamodb.CfnTable.SSESpecificationProperty(
+                sse_enabled=True,
+                kms_master_key_id=self.kms_key.key_arn,
+                sse_type="KMS",
+            ),
+            billing_mode="PAY_PER_REQUEST",
+        )
+
     def seed_dynamo_table(self):
         # pass
         # Seed animal attributes table
@@ -593,6 +664,7 @@ class RekognitionStack(Stack):
                             ],
                             resources=[
                                 self.animal_attributes_table.attr_arn,
+                                self.prediction_cache_table.attr_arn,
                             ],
                         ),
                         iam.PolicyStatement(
@@ -729,6 +801,26 @@ class RekognitionStack(Stack):
             memory_size=1024,
         )
 
+        # Pillow, to downscale inline images and hash images for the near
+        # duplicate cache
+        self.pillow_layer = _lambda.LayerVersion(
+            self,
+            resource_name(_lambda.LayerVersion, "rekognition-pillow-layer"),
+            code=_lambda.Code.from_asset(
+                PILLOW_LAYER_PATH,
+                bundling=cdk.BundlingOptions(
+                    image=_lambda.Runtime.PYTHON_3_9.bundling_image,
+                    command=[
+                        "bash",
+                        "-c",
+                        "pip install -r requirements.txt -t /asset-output/python",
+                    ],
+                    local=PipLocalBundling(PILLOW_LAYER_PATH),
+                ),
+            ),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_9],
+        )
+
         atrributes_to_send = config["attributesToSend"]
         attributes_comma_delim = ",".join(atrributes_to_send)
         # predict attributes api lambda
@@ -741,6 +833,7 @@ class RekognitionStack(Stack):
             handler="predict_pet_image_attributes.lambda_handler",
             runtime=_lambda.Runtime.PYTHON_3_9,
             code=_lambda.Code.from_asset("rekognition/lambda/api"),
+            layers=[self.pillow_layer],
             role=self.predict_image_attributes_execution_role,
             timeout=Duration.minutes(15),
             environment_encryption=self.kms_key,
@@ -751,6 +844,31 @@ class RekognitionStack(Stack):
                 "ATTRIBUTES_TO_SEND": attributes_comma_delim,
                 "ANIMAL_ATTRIBUTES_DDB_TBL": self.animal_attributes_table.table_name,
                 "MINIMUM_CONFIDENCE": str(config["minConfidence"]),
+                "BATCH_MAX_WORKERS": str(config["batchMaxWorkers"]),
+                "BATCH_ACQUIRE_TIMEOUT": str(config["batchAcquireTimeout"]),
+                "MODEL_ARN_CACHE_TTL": str(config["modelArnCacheTtl"]),
+                "MODEL_ARN_STALE_TTL": str(config["modelArnStaleTtl"]),
+                "BREED_CACHE_TTL": str(config["breedCacheTtl"]),
+                "BREED_NEGATIVE_CACHE_TTL": str(config["breedNegativeCacheTtl"]),
+                "PREDICTION_CACHE_DDB_TBL": self.prediction_cache_table.table_name,
+                "PREDICTION_CACHE_TTL": str(config["predictionCacheTtl"]),
+                "MAX_IMAGE_DIMENSION": str(config["maxImageDimension"]),
+                "IMAGE_JPEG_QUALITY": str(config["imageJpegQuality"]),
+                "LATENCY_EXPORT_INTERVAL": str(config["latencyExportInterval"]),
+                "DEBUG_TIMINGS": str(config["debugTimings"]).lower(),
+                "INFERENCE_UNITS": str(config["minInferenceUnits"]),
+                "DETECT_TPS_PER_INFERENCE_UNIT": str(
+                    config["detectTpsPerInferenceUnit"]
+                ),
+                "CIRCUIT_FAILURE_THRESHOLD": str(config["circuitFailureThreshold"]),
+                "CIRCUIT_RESET_TIMEOUT": str(config["circuitResetTimeout"]),
+                "AUTO_ROUTE_MIN_SPECIES_CONFIDENCE": str(
+                    config["autoRouteMinSpeciesConfidence"]
+                ),
+                "VALIDATE_IMAGES": str(config["validateImages"]).lower(),
+                "NEAR_DUPLICATE_CACHE": str(config["nearDuplicateCache"]).lower(),
+                "NEAR_DUPLICATE_MAX_DISTANCE": str(config["nearDuplicateMaxDistance"]),
+                "NEAR_DUPLICATE_VERIFY_RATE": str(config["nearDuplicateVerifyRate"]),
             },
         )
 
@@ -1036,6 +1154,42 @@ class RekognitionStack(Stack):
                     type=codebuild.BuildEnvironmentVariableType.PLAINTEXT,
                     value=stepfunctions.JsonPath.string_at("$.project_arn"),
                 ),
+                "INFERENCE_UNITS": codebuild.BuildEnvironmentVariable(
+                    type=codebuild.BuildEnvironmentVariableType.PLAINTEXT,
+                    value=str(config["minInferenceUnits"]),
+                ),
+                "DETECT_TPS_PER_INFERENCE_UNIT": codebuild.BuildEnvironmentVariable(
+                    type=codebuild.BuildEnvironmentVariableType.PLAINTEXT,
+                    value=str(config["detectTpsPerInferenceUnit"]),
+                ),
+                "MAX_WORKERS": codebuild.BuildEnvironmentVariable(
+                    type=codebuild.BuildEnvironmentVariableType.PLAINTEXT,
+                    value=str(config["evaluationMaxWorkers"]),
+                ),
+                "COMPARE_PROMOTED": codebuild.BuildEnvironmentVariable(
+                    type=codebuild.BuildEnvironmentVariableType.PLAINTEXT,
+                    value=str(config["evaluationComparePromoted"]).lower(),
+                ),
+                "EARLY_STOPPING": codebuild.BuildEnvironmentVariable(
+                    type=codebuild.BuildEnvironmentVariableType.PLAINTEXT,
+                    value=str(config["evaluationEarlyStopping"]).lower(),
+                ),
+                "EARLY_STOPPING_ALPHA": codebuild.BuildEnvironmentVariable(
+                    type=codebuild.BuildEnvironmentVariableType.PLAINTEXT,
+                    value=str(config["evaluationEarlyStoppingAlpha"]),
+                ),
+                "DOG_ACCURACY": codebuild.BuildEnvironmentVariable(
+                    type=codebuild.BuildEnvironmentVariableType.PLAINTEXT,
+                    value=str(config["dogAccuracy"]),
+                ),
+                "CAT_ACCURACY": codebuild.BuildEnvironmentVariable(
+                    type=codebuild.BuildEnvironmentVariableType.PLAINTEXT,
+                    value=str(config["catAccuracy"]),
+                ),
+                "EVALUATION_SOURCE": codebuild.BuildEnvironmentVariable(
+                    type=codebuild.BuildEnvironmentVariableType.PLAINTEXT,
+                    value=config["evaluationSource"],
+                ),
             },
             result_selector={
                 "parameters": stepfunctions.JsonPath.string_at(
@@ -0,0 +1,373 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+"""
+Predicts every image under an s3 prefix with get_inferred_attributes and
+streams one json line per image to OUTPUT_PATH with a multipart upload,
+gzip compressed when OUTPUT_PATH ends with .gz.
+
+    S3_BUCKET=<bucket> INPUT_PREFIX=listings/ ANIMAL_TYPE=auto \\
+    OUTPUT_PATH=s3://<bucket>/predictions/listings.jsonl.gz \\
+    ANIMAL_ATTRIBUTES_DDB_TBL=<table> python rekognition/scripts/bulk_predict.py
+
+Keys are listed lazily and at most 4 * MAX_WORKERS images are in flight, so
+memory use does not grow with the number of images.  Detect calls wait for
+the rate limiter instead of failing fast like the lambda does, and images
+that are still rate limited, throttled or hit an open circuit are predicted
+again before they are written.
+
+After every uploaded part, and every CHECKPOINT_INTERVAL seconds or
+CHECKPOINT_MAX_RECORDS images in between, a checkpoint with the multipart
+upload and the last key written is saved next to the output; running the
+job again with the same OUTPUT_PATH resumes from it.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir, "../lambda/api"))
+import predict_pet_image_attributes as predict
+from resilience import CIRCUIT_OPEN, RATE_LIMITED, THROTTLED, blocking_guard
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png")
+MIN_PART_SIZE = 5 * 1024 * 1024  # s3 minimum for every part but the last
+DEFAULT_PART_SIZE_MB = 16
+DEFAULT_MAX_WORKERS = 16
+# the records buffered for the next part are saved after this many seconds or
+# records
+CHECKPOINT_INTERVAL = 30  # seconds
+CHECKPOINT_MAX_RECORDS = 500
+# images failing with these are predicted again, waiting RETRY_DELAY * attempt
+RETRY_ERROR_CODES = {RATE_LIMITED, THROTTLED, CIRCUIT_OPEN}
+DEFAULT_IMAGE_ATTEMPTS = 5
+RETRY_DELAY = 10  # seconds
+
+s3 = boto3.client("s3")
+# detect call metrics are sent with PutMetricData, stop_previous_model_inference
+# only sees the calls of a job running outside lambda through them
+cloudwatch = boto3.client("cloudwatch")
+
+
+def iter_image_keys(bucket, prefix, start_after=None):
+    """
+    yields the image keys under the prefix in key order, one page at a time
+    """
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    for page in s3.get_paginator("list_objects_v2").paginate(**kwargs):
+        for obj in page.get("Contents", []):
+            if obj["Key"].lower().endswith(IMAGE_SUFFIXES):
+                yield obj["Key"]
+
+
+def bounded_map(fn, items, max_workers, max_pending):
+    """
+    yields (item, fn(item)) in input order like ThreadPoolExecutor.map, but
+    only reads up to max_pending items ahead of the results
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(fn, item)))
+            if len(pending) >= max_pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def checkpoint_key(output_key):
+    return f"{output_key}.checkpoint.json"
+
+
+def tail_key(output_key):
+    return f"{output_key}.tail"
+
+
+def load_checkpoint(bucket, output_key):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=checkpoint_key(output_key))
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+class MultipartJsonlWriter:
+    """
+    Writes json lines to an s3 object with a multipart upload, uploading a
+    part whenever part_size bytes are buffered.  Compressed parts are each a
+    complete gzip member, which together make a valid gzip file.
+    The checkpoint saved after each part holds the upload id, the parts and
+    the last key written to them, so an interrupted job can carry on with the
+    same upload from the key after it.  Records not in a part yet are saved
+    every interval seconds or max_records records to a tail object next to
+    the output, a gzip member, and buffered again on resume.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        key,
+        part_size,
+        compress,
+        job,
+        checkpoint=None,
+        interval=CHECKPOINT_INTERVAL,
+        max_records=CHECKPOINT_MAX_RECORDS,
+        clock=time.monotonic,
+    ):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.compress = compress
+        self.job = job
+        self.interval = interval
+        self.max_records = max_records
+        self.clock = clock
+        if checkpoint is not None:
+            if checkpoint["job"] != job:
+                raise Exception(
+                    f"checkpoint for {key} is for another job: {checkpoint['job']}"
+                )
+            self.upload_id = checkpoint["upload_id"]
+            self.parts = checkpoint["parts"]
+            self.last_key = checkpoint["last_key"]
+            self.count = checkpoint["count"]
+        else:
+            self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)[
+                "UploadId"
+            ]
+            self.parts = []
+            self.last_key = None
+            self.count = 0
+        self.buffer = bytearray()
+        self.buffered_last_key = self.last_key
+        self.buffered_count = 0
+        self.compressor = self.new_compressor()
+        if checkpoint is not None and checkpoint.get("tail_count"):
+            self.load_tail(checkpoint["tail_last_key"], checkpoint["tail_count"])
+        self.saved_count = self.buffered_count
+        self.saved_at = self.clock()
+
+    @property
+    def resume_after(self):
+        """
+        the last key written to a part or saved in the tail
+        """
+        return self.buffered_last_key
+
+    @property
+    def total_count(self):
+        return self.count + self.buffered_count
+
+    def new_compressor(self):
+        # wbits 31 writes a gzip header and trailer
+        return zlib.compressobj(wbits=31) if self.compress else None
+
+    def buffer_line(self, line):
+        if self.compressor is not None:
+            line = self.compressor.compress(line)
+        self.buffer.extend(line)
+
+    def write(self, image_key, record):
+        """
+        buffers a record, returns True when a checkpoint was saved
+        """
+        self.buffer_line((json.dumps(record) + "\n").encode("utf-8"))
+        self.buffered_last_key = image_key
+        self.buffered_count += 1
+        if len(self.buffer) >= self.part_size:
+            self.upload_part()
+            return True
+        if (
+            self.buffered_count - self.saved_count >= self.max_records
+            or self.clock() - self.saved_at >= self.interval
+        ):
+            self.save_tail()
+            return True
+        return False
+
+    def tail_bytes(self):
+        """
+        the buffer as a complete gzip member, the compressor is left as is
+        """
+        if self.compressor is None:
+            compressor = zlib.compressobj(wbits=31)
+            return compressor.compress(bytes(self.buffer)) + compressor.flush()
+        return bytes(self.buffer) + self.compressor.copy().flush()
+
+    def save_tail(self):
+        # the tail is written before the checkpoint that counts its records
+        s3.put_object(
+            Bucket=self.bucket, Key=tail_key(self.key), Body=self.tail_bytes()
+        )
+        self.save_checkpoint()
+
+    def load_tail(self, tail_last_key, tail_count):
+        response = s3.get_object(Bucket=self.bucket, Key=tail_key(self.key))
+        lines = zlib.decompress(response["Body"].read(), wbits=31).splitlines()
+        for line in lines[:tail_count]:
+            self.buffer_line(line + b"\n")
+        self.buffered_last_key = tail_last_key
+        self.buffered_count = tail_count
+
+    def upload_part(self):
+        if self.compressor is not None:
+            self.buffer.extend(self.compressor.flush())
+            self.compressor = self.new_compressor()
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer),
+        )
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        self.last_key = self.buffered_last_key
+        self.count += self.buffered_count
+        self.buffer = bytearray()
+        self.buffered_count = 0
+        self.save_checkpoint()
+
+    def save_checkpoint(self):
+        self.saved_count = self.buffered_count
+        self.saved_at = self.clock()
+        s3.put_object(
+            Bucket=self.bucket,
+            Key=checkpoint_key(self.key),
+            Body=json.dumps(
+                {
+                    "job": self.job,
+                    "upload_id": self.upload_id,
+                    "parts": self.parts,
+                    "last_key": self.last_key,
+                    "count": self.count,
+                    "tail_last_key": self.buffered_last_key,
+                    "tail_count": self.buffered_count,
+                }
+            ),
+        )
+
+    def close(self):
+        """
+        uploads the rest of the buffer as the last part and completes the upload
+        """
+        if self.buffered_count or not self.parts:
+            self.upload_part()
+        s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+        s3.delete_object(Bucket=self.bucket, Key=checkpoint_key(self.key))
+        s3.delete_object(Bucket=self.bucket, Key=tail_key(self.key))
+
+
+def predict_image(
+    bucket, key, animal_type, min_confidence, top_n, max_attempts=DEFAULT_IMAGE_ATTEMPTS
+):
+    """
+    the record of an image, predicted up to max_attempts times while it fails
+    with one of RETRY_ERROR_CODES
+    """
+    image_path = f"s3://{bucket}/{key}"
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(RETRY_DELAY * attempt)
+        try:
+            result = predict.get_inferred_attributes(
+                bucket, key, animal_type, min_confidence=min_confidence, top_n=top_n
+            )
+        except Exception as e:
+            print(f"{image_path}: {e}")
+            result = {
+                "error_code": predict.prediction_error(e)["Code"],
+                "error": str(e),
+            }
+        if result.get("error_code") not in RETRY_ERROR_CODES:
+            break
+    return {"image_path": image_path, **result}
+
+
+def main(
+    bucket,
+    prefix,
+    output_path,
+    animal_type,
+    max_workers,
+    part_size,
+    min_confidence,
+    top_n,
+):
+    predict.rekognition_guard = blocking_guard(
+        predict.detect_rate, predict.rekognition_guard.max_attempts
+    )
+    # workers beyond the calls the models answer per second only wait for
+    # the limiter
+    max_workers = max(1, min(max_workers, math.ceil(predict.detect_rate)))
+    output_bucket, output_key = predict.parse_s3_path(output_path)
+    job = {"bucket": bucket, "prefix": prefix, "animal_type": animal_type}
+    writer = MultipartJsonlWriter(
+        output_bucket,
+        output_key,
+        part_size,
+        compress=output_key.endswith(".gz"),
+        job=job,
+        checkpoint=load_checkpoint(output_bucket, output_key),
+    )
+    if writer.resume_after:
+        print(f"resuming after {writer.resume_after}, {writer.total_count} images done")
+
+    start = time.time()
+    resumed_count = writer.total_count
+    results = bounded_map(
+        lambda key: predict_image(bucket, key, animal_type, min_confidence, top_n),
+        iter_image_keys(bucket, prefix, start_after=writer.resume_after),
+        max_workers=max_workers,
+        max_pending=max_workers * 4,
+    )
+    for key, record in results:
+        if writer.write(key, record):
+            predict.prediction_cache.wait_for_writes()
+            predict.metrics.publish(cloudwatch)
+            predict.latency.maybe_export()
+            rate = (writer.total_count - resumed_count) / (time.time() - start)
+            print(f"{writer.total_count} images written, {rate:.1f} images/s")
+    writer.close()
+    predict.prediction_cache.wait_for_writes()
+    predict.metrics.publish(cloudwatch)
+    print(f"wrote {writer.count} predictions to {output_path}")
+    return writer.count
+
+
+if __name__ == "__main__":
+
+    main(
+        bucket=os.environ["S3_BUCKET"],
+        prefix=os.environ.get("INPUT_PREFIX", ""),
+        output_path=os.environ["OUTPUT_PATH"],
+        animal_type=os.environ.get("ANIMAL_TYPE", predict.AUTO_ANIMAL_TYPE),
+        max_workers=int(os.environ.get("MAX_WORKERS", DEFAULT_MAX_WORKERS)),
+        part_size=int(os.environ.get("PART_SIZE_MB", DEFAULT_PART_SIZE_MB))
+        * 1024
+        * 1024,
+        min_confidence=int(
+            os.environ.get("MINIMUM_CONFIDENCE", predict.DEFAULT_MINIMUM_CONFIDENCE)
+        ),
+        top_n=int(os.environ.get("TOP_N", predict.DEFAULT_TOP_N)),
+    )
@@ -4,48 +4,663 @@ import os
 import sys
 import time
 import json
-from concurrent.futures import ThreadPoolExecutor
+import math
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import boto3
 import pandas as pd
 import smart_open
-from sklearn.metrics import classification_report
+from botocore.config import Config
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(script_dir, "../lambda/api"))
-
-# default values for environmental variables needed for import
-os.environ.update(
-    {
-        "ATTRIBUTES_TO_SEND": "",
-        "MINIMUM_CONFIDENCE": "1 ",
-        "AWS_DEFAULT_REGION": "us-east-1",
-    }
+from evaluation_metrics import NO_PREDICTION, Evaluation
+from label_codec import LabelCodec, split_name_id
+from prediction_store import save_predictions
+from resilience import GUARDED_CLIENT_RETRIES, blocking_guard
+from training_evaluation import parse_evaluation_line, parse_summary
+from sequential_test import (
+    DEFAULT_ALPHA,
+    DEFAULT_CHECK_EVERY,
+    DEFAULT_MIN_IMAGES,
+    SequentialAccuracyTest,
+    stratified_order,
 )
-from predict_pet_image_attributes import partition_labels, split_name_id
 
-rekognition_client = boto3.client("rekognition")
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_INFERENCE_UNITS = 1
+# detect_custom_labels calls per second one inference unit answers
+DEFAULT_DETECT_TPS_PER_INFERENCE_UNIT = 5
+DEFAULT_DETECT_MAX_ATTEMPTS = 8
+# fraction of test images that may fail after retries, they are left out of
+# the metrics; above it the evaluation fails rather than report them
+DEFAULT_MAX_FAILED_FRACTION = 0.01
+PROGRESS_INTERVAL = 30  # seconds
+# predictions are written to s3 after this many seconds or records
+CHECKPOINT_INTERVAL = 30  # seconds
+CHECKPOINT_MAX_RECORDS = 500
+
+rekognition_client = boto3.client(
+    "rekognition", config=Config(retries=GUARDED_CLIENT_RETRIES)
+)
 ssm = boto3.client("ssm")
 s3 = boto3.client("s3")
 
 
+# detect_custom_labels is limited to what the model's inference units answer
+guard = blocking_guard(
+    int(os.environ.get("INFERENCE_UNITS", DEFAULT_INFERENCE_UNITS))
+    * float(
+        os.environ.get(
+            "DETECT_TPS_PER_INFERENCE_UNIT", DEFAULT_DETECT_TPS_PER_INFERENCE_UNIT
+        )
+    ),
+    int(os.environ.get("DETECT_MAX_ATTEMPTS", DEFAULT_DETECT_MAX_ATTEMPTS)),
+)
+
+
 def get_prediction(bucket, prefix, model_arn, min_confidence=5):  # 5% is arbitrary
-    try:
-        result = rekognition_client.detect_custom_labels(
+    """
+    raises when the image could not be predicted, after retries of throttles
+    """
+    return guard.call(
+        model_arn,
+        lambda: rekognition_client.detect_custom_labels(
             Image={"S3Object": {"Bucket": bucket, "Name": prefix}},
             MinConfidence=min_confidence,
             ProjectVersionArn=model_arn,
-        )
-    except Exception as e:
-        print(e)
-        result = {}
-    return result
+        ),
+    )
 
 
 def predict(tup):
     return get_prediction(*tup)
 
 
+def find_model_arns(project_arn, model_names):
+    """
+    returns {model name: model arn} of versions of the project with one call,
+    "" for names that are not found
+    """
+    model_versions = rekognition_client.describe_project_versions(
+        ProjectArn=project_arn,
+        VersionNames=model_names,
+    )
+    model_arns = {model_name: "" for model_name in model_names}
+    for version in model_versions["ProjectVersionDescriptions"]:
+        for model_name in model_names:
+            if model_name in version["ProjectVersionArn"]:
+                model_arns[model_name] = version["ProjectVersionArn"]
+    return model_arns
+
+
+def model_name(model_arn):
+    """
+    the version name in a model arn,
+    arn:aws:rekognition:<region>:<account>:project/<project>/version/<name>/<id>
+    """
+    if "/version/" in model_arn:
+        return model_arn.split("/version/", 1)[1].split("/")[0]
+    return model_arn.replace(":", "-").replace("/", "-")
+
+
+def env_list(name):
+    return [value for value in os.environ.get(name, "").split(",") if value]
+
+
+def get_true_breed(line):
+    if "label-name" in line:
+        true_breed = line["label-name"]
+    else:
+        true_breed = None
+    for top_key in line.keys():
+        # NB: requires breed label (and no others) to have "breed" in the name
+        if "breed" in top_key and "-metadata" in top_key:
+            true_breed = split_name_id(
+                line[top_key]["class-name"].split("-", maxsplit=1)[-1]
+            )[0]
+            break
+    if true_breed is None:
+        raise Exception("Can't find breed label in manifest")
+    return true_breed
+
+
+def parse_s3_path(s3path):
+    return s3path.replace("s3://", "").split("/", 1)
+
+
+class PredictionCheckpoint:
+    """
+    Append only JSONL log of the responses of one model, keyed by source-ref,
+    so an evaluation that is restarted only predicts the images left.
+    Every record is appended to local_path as it comes in, and when an
+    s3_prefix is given the records since the last upload are written as a
+    new part-*.jsonl object under it every interval seconds or max_records
+    records, which survives the CodeBuild container.
+    Records of other models or minimum confidences are ignored on load.
+    """
+
+    def __init__(
+        self,
+        local_path,
+        model_arn,
+        min_confidence,
+        s3_prefix=None,
+        interval=CHECKPOINT_INTERVAL,
+        max_records=CHECKPOINT_MAX_RECORDS,
+        clock=time.monotonic,
+    ):
+        self.local_path = local_path
+        self.model_arn = model_arn
+        self.min_confidence = min_confidence
+        self.s3_prefix = s3_prefix
+        self.interval = interval
+        self.max_records = max_records
+        self.clock = clock
+        # parts of earlier runs are kept, so each run names its own
+        self.run_id = str(int(time.time() * 1000))
+        self.parts = 0
+        self._pending = []
+        self._uploaded = clock()
+        self._file = None
+        self._lock = threading.Lock()
+
+    def iter_lines(self):
+        if os.path.exists(self.local_path):
+            with open(self.local_path) as ff:
+                yield from ff
+        if self.s3_prefix:
+            bucket, prefix = parse_s3_path(self.s3_prefix)
+            paginator = s3.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    body = s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"]
+                    yield from body.read().decode("utf-8").splitlines()
+
+    def load(self):
+        """
+        returns {source-ref: response} of the images already predicted
+        """
+        responses = {}
+        for line in self.iter_lines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of a run that was killed mid write
+                continue
+            if (
+                record["model_arn"] == self.model_arn
+                and record["min_confidence"] == self.min_confidence
+            ):
+                responses[record["source-ref"]] = record["response"]
+        return responses
+
+    def open_local(self):
+        ends_mid_line = False
+        if os.path.exists(self.local_path) and os.path.getsize(self.local_path):
+            with open(self.local_path, "rb") as ff:
+                ff.seek(-1, os.SEEK_END)
+                ends_mid_line = ff.read(1) != b"\n"
+        local_file = open(self.local_path, "a")
+        if ends_mid_line:
+            local_file.write("\n")
+        return local_file
+
+    def append(self, source_ref, response):
+        line = json.dumps(
+            {
+                "source-ref": source_ref,
+                "model_arn": self.model_arn,
+                "min_confidence": self.min_confidence,
+                "response": {"CustomLabels": response.get("CustomLabels", [])},
+            }
+        )
+        with self._lock:
+            if self._file is None:
+                self._file = self.open_local()
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._pending.append(line)
+            if (
+                len(self._pending) >= self.max_records
+                or self.clock() - self._uploaded >= self.interval
+            ):
+                self._upload()
+
+    def _upload(self):
+        if self.s3_prefix and self._pending:
+            bucket, prefix = parse_s3_path(self.s3_prefix)
+            self.parts += 1
+            s3.put_object(
+                Bucket=bucket,
+                Key=f"{prefix.rstrip('/')}/part-{self.run_id}-{self.parts:05}.jsonl",
+                Body="\n".join(self._pending) + "\n",
+            )
+        self._pending = []
+        self._uploaded = self.clock()
+
+    def close(self):
+        with self._lock:
+            self._upload()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class Progress:
+    """
+    prints the images done, throughput and time left every interval seconds
+    """
+
+    def __init__(
+        self, total, name=None, interval=PROGRESS_INTERVAL, clock=time.monotonic
+    ):
+        self.total = total
+        self.name = name
+        self.interval = interval
+        self.clock = clock
+        self.done = 0
+        self.failed = 0
+        self.start = clock()
+        self._reported = self.start
+        self._lock = threading.Lock()
+
+    def update(self, failed=False):
+        with self._lock:
+            self.done += 1
+            self.failed += failed
+            now = self.clock()
+            if now - self._reported >= self.interval or self.done == self.total:
+                self._reported = now
+                print(self.report())
+
+    @property
+    def seconds(self):
+        return self.clock() - self.start
+
+    @property
+    def rate(self):
+        return self.done / max(self.seconds, 1e-9)
+
+    def report(self):
+        left = (self.total - self.done) / max(self.rate, 1e-9)
+        report = (
+            f"{self.done}/{self.total} images, {self.rate:.1f} images/s, "
+            f"{self.failed} failed, {left:.0f}s left"
+        )
+        return f"{self.name}: {report}" if self.name else report
+
+
+def predict_all(
+    manifest_lines,
+    model_arns,
+    min_confidence,
+    max_workers,
+    checkpoints=None,
+    on_result=None,
+):
+    """
+    predicts every manifest image with every model, each model with its own
+    pool of up to max_workers concurrent calls so a model waiting on its rate
+    limit does not hold up the others.
+    Returns {model arn: responses in manifest order, None for images that
+    failed or were not predicted} and {model arn: Progress}.
+    Images in a model's checkpoint are not predicted again, and new
+    responses are appended to it.
+    on_result(model arn, manifest index, response) is called with every
+    response, in manifest order for the checkpointed ones, and the images
+    left are not predicted once it returns True.
+    """
+    checkpoints = checkpoints or {}
+    responses = {}
+    progress = {}
+    pools = {}
+    todos = {}
+    futures = {}
+    in_flight = Counter()
+    stopped = False
+
+    def submit(model_arn):
+        # keeps two calls per worker queued instead of the whole test set,
+        # so stopping early leaves little in flight
+        while in_flight[model_arn] < 2 * max_workers:
+            i = next(todos[model_arn], None)
+            if i is None:
+                return
+            future = pools[model_arn].submit(
+                get_prediction,
+                *parse_s3_path(manifest_lines[i]["source-ref"]),
+                model_arn,
+                min_confidence,
+            )
+            futures[future] = (model_arn, i)
+            in_flight[model_arn] += 1
+
+    try:
+        for model_arn in model_arns:
+            checkpoint = checkpoints.get(model_arn)
+            done = checkpoint.load() if checkpoint is not None else {}
+            model_responses = [done.get(line["source-ref"]) for line in manifest_lines]
+            todo = [i for i, response in enumerate(model_responses) if response is None]
+            if done:
+                print(
+                    f"{model_name(model_arn)}: {len(manifest_lines) - len(todo)} "
+                    "images already in the checkpoint"
+                )
+            responses[model_arn] = model_responses
+            progress[model_arn] = Progress(len(todo), name=model_name(model_arn))
+            todos[model_arn] = iter(todo)
+            stopped = stopped or (
+                on_result is not None
+                and any(
+                    on_result(model_arn, i, response)
+                    for i, response in enumerate(model_responses)
+                    if response is not None
+                )
+            )
+        if not stopped:
+            for model_arn in model_arns:
+                pools[model_arn] = ThreadPoolExecutor(max_workers=max_workers)
+            for model_arn in model_arns:
+                submit(model_arn)
+
+        while futures and not stopped:
+            finished, pending = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                model_arn, i = futures.pop(future)
+                in_flight[model_arn] -= 1
+                source_ref = manifest_lines[i]["source-ref"]
+                try:
+                    responses[model_arn][i] = future.result()
+                except Exception as e:
+                    print(f"{model_name(model_arn)} {source_ref}: {e}")
+                else:
+                    if checkpoints.get(model_arn) is not None:
+                        checkpoints[model_arn].append(
+                            source_ref, responses[model_arn][i]
+                        )
+                progress[model_arn].update(failed=responses[model_arn][i] is None)
+                if (
+                    on_result is not None
+                    and responses[model_arn][i] is not None
+                    and on_result(model_arn, i, responses[model_arn][i])
+                ):
+                    print(f"{model_name(model_arn)}: stopping early")
+                    stopped = True
+                    break
+                submit(model_arn)
+    finally:
+        # calls still queued are cancelled, the ones in flight finish
+        for pool in pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+        for checkpoint in checkpoints.values():
+            checkpoint.close()
+    return responses, progress
+
+
+def breed_confidences(response, label_codec):
+    return [
+        (label["Name"], label["Confidence"])
+        for label in label_codec.partition(response.get("CustomLabels", []))["breed"]
+    ]
+
+
+def top_breed(response, label_codec):
+    confidences = breed_confidences(response, label_codec)
+    if not confidences:
+        return NO_PREDICTION
+    return max(confidences, key=lambda confidence: confidence[1])[0]
+
+
+def score(y_true_all, responses, label_codec, progress, source_refs=None):
+    """
+    returns (predictions DataFrame, classification metrics) of the images
+    that did not fail, and the top breed of every image, "NAN" when the
+    model found none and None for failed images.
+    The DataFrame has the confidence of each breed, 0 where the model did
+    not return it, and the true breed in y_true, indexed by source-ref.
+    """
+    kept = [i for i, response in enumerate(responses) if response is not None]
+    evaluation = Evaluation(
+        [y_true_all[i] for i in kept],
+        (breed_confidences(responses[i], label_codec) for i in kept),
+    )
+    preds_df = pd.DataFrame(
+        evaluation.confidences,
+        columns=evaluation.classes,
+        index=[source_refs[i] for i in kept] if source_refs is not None else None,
+    )
+    preds_df = preds_df.drop(columns=NO_PREDICTION)
+    preds_df["y_true"] = [y_true_all[i] for i in kept]
+    metrics_dict = evaluation.metrics()
+    metrics_dict["evaluation"] = {
+        "images": len(y_true_all),
+        "predicted": progress.done,
+        "failed": progress.failed,
+        "seconds": round(progress.seconds, 1),
+        "images_per_second": round(progress.rate, 2),
+    }
+    y_pred = [None] * len(responses)
+    for i, name in zip(kept, evaluation.predicted_names()):
+        y_pred[i] = name
+    return (preds_df, metrics_dict), y_pred
+
+
+def mcnemar(b, c):
+    """
+    McNemar's test of b images only the first model got right against c only
+    the second did: the chi-squared statistic with continuity correction and
+    the exact two sided binomial p-value
+    """
+    n = b + c
+    if n == 0:
+        return 0.0, 1.0
+    statistic = (abs(b - c) - 1) ** 2 / n
+    tail = sum(math.comb(n, k) for k in range(min(b, c) + 1))
+    return statistic, min(1.0, 2 * tail / 2**n)
+
+
+def compare(y_true, y_pred_a, y_pred_b):
+    """
+    paired comparison of two models on the images neither failed
+    """
+    paired = [
+        (true, a, b)
+        for true, a, b in zip(y_true, y_pred_a, y_pred_b)
+        if a is not None and b is not None
+    ]
+    counts = Counter((a == true, b == true) for true, a, b in paired)
+    only_a = counts[(True, False)]
+    only_b = counts[(False, True)]
+    statistic, p_value = mcnemar(only_a, only_b)
+    return {
+        "images": len(paired),
+        "same_prediction": sum(a == b for true, a, b in paired),
+        "both_correct": counts[(True, True)],
+        "only_a_correct": only_a,
+        "only_b_correct": only_b,
+        "both_wrong": counts[(False, False)],
+        "mcnemar_statistic": statistic,
+        "mcnemar_p_value": p_value,
+    }
+
+
+def evaluate_models(
+    manifest_lines,
+    model_arns,
+    min_confidence,
+    max_workers,
+    max_failed_fraction,
+    checkpoints=None,
+    sequential_test=None,
+):
+    """
+    evaluates every model in one pass over the manifest.
+    Returns {model arn: (predictions DataFrame, classification metrics)} and
+    the paired comparison of the first model with each of the others.
+    Images that failed are left out; an image the model found no label for
+    is predicted as "NAN".
+    With a SequentialAccuracyTest the first model's results are fed to it
+    and the evaluation stops once it decides, the metrics are of the images
+    predicted until then and its decision is added as "promotion".
+    """
+    label_codec = LabelCodec.from_manifest(manifest_lines)
+    y_true = [get_true_breed(line) for line in manifest_lines]
+    first = model_arns[0]
+
+    def on_result(model_arn, i, response):
+        if model_arn != first:
+            return False
+        correct = top_breed(response, label_codec) == y_true[i]
+        return sequential_test.record(correct) is not None
+
+    responses, progress = predict_all(
+        manifest_lines,
+        model_arns,
+        min_confidence,
+        max_workers,
+        checkpoints,
+        on_result=on_result if sequential_test is not None else None,
+    )
+    for model_arn in model_arns:
+        failed = progress[model_arn].failed
+        tried = failed + sum(response is not None for response in responses[model_arn])
+        if failed > max_failed_fraction * tried:
+            raise Exception(
+                f"{failed} of {tried} test images failed for {model_arn}, "
+                f"over MAX_FAILED_FRACTION {max_failed_fraction}"
+            )
+
+    results = {}
+    y_preds = {}
+    for model_arn in model_arns:
+        results[model_arn], y_preds[model_arn] = score(
+            y_true,
+            responses[model_arn],
+            label_codec,
+            progress[model_arn],
+            [line["source-ref"] for line in manifest_lines],
+        )
+    if sequential_test is not None:
+        sequential_test.finish()
+        results[first][1]["promotion"] = sequential_test.to_dict()
+    comparisons = [
+        {
+            "model_a": first,
+            "model_b": model_arn,
+            **compare(y_true, y_preds[first], y_preds[model_arn]),
+        }
+        for model_arn in model_arns[1:]
+    ]
+    return results, comparisons
+
+
+def evaluate(
+    manifest_lines,
+    model_arn,
+    min_confidence,
+    max_workers,
+    max_failed_fraction,
+    checkpoint=None,
+):
+    """
+    returns (predictions DataFrame, classification metrics) of one model
+    """
+    results, comparisons = evaluate_models(
+        manifest_lines,
+        [model_arn],
+        min_confidence,
+        max_workers,
+        max_failed_fraction,
+        {model_arn: checkpoint} if checkpoint is not None else None,
+    )
+    return results[model_arn]
+
+
+def describe_model(project_arn, model_name):
+    versions = rekognition_client.describe_project_versions(
+        ProjectArn=project_arn, VersionNames=[model_name]
+    )["ProjectVersionDescriptions"]
+    for version in versions:
+        if model_name in version["ProjectVersionArn"]:
+            return version
+    raise Exception(f"Model {model_name} not found in {project_arn}")
+
+
+def find_training_output(description):
+    """
+    returns the s3 (bucket, key) of the evaluation summary and evaluation
+    manifest snapshot Rekognition wrote when it trained the model, both from
+    the model's description
+    """
+    summary = description.get("EvaluationResult", {}).get("Summary", {})
+    summary = summary.get("S3Object")
+    if summary is None:
+        raise Exception("The model has no evaluation result, is it trained?")
+    output = description.get("TestingDataResult", {}).get("Output", {})
+    for asset in output.get("Assets", []):
+        manifest = asset.get("GroundTruthManifest", {}).get("S3Object")
+        if manifest is not None:
+            return (summary["Bucket"], summary["Name"]), (
+                manifest["Bucket"],
+                manifest["Name"],
+            )
+    raise Exception("The model has no testing data result with a manifest")
+
+
+def evaluate_training_output(manifest_lines, summary):
+    """
+    returns (predictions DataFrame, classification metrics) of the labels the
+    model predicted for the test set when it was trained, with the summary of
+    the training evaluation as "training_summary"
+    """
+    parsed = [parse_evaluation_line(line) for line in manifest_lines]
+    parsed = [entry for entry in parsed if entry is not None]
+    if not parsed:
+        raise Exception("No test images found in the evaluation manifest")
+    print(f"{len(parsed)} of {len(manifest_lines)} evaluation manifest lines read")
+    source_refs, y_true, responses = (list(column) for column in zip(*parsed))
+    progress = Progress(len(responses), name="training evaluation")
+    for response in responses:
+        progress.update()
+    (preds_df, metrics_dict), y_pred = score(
+        y_true,
+        responses,
+        LabelCodec.from_manifest(manifest_lines),
+        progress,
+        source_refs,
+    )
+    metrics_dict["evaluation"]["source"] = "training"
+    metrics_dict["training_summary"] = parse_summary(summary)
+    return preds_df, metrics_dict
+
+
+def write_predictions(path, preds_df):
+    breeds = [column for column in preds_df.columns if column != "y_true"]
+    save_predictions(
+        path,
+        preds_df.index,
+        preds_df["y_true"],
+        preds_df[breeds].to_numpy(),
+        breeds,
+    )
+
+
+def get_promoted_model_arn(animal):
+    """
+    the model the predict lambda serves, None before the first promotion
+    """
+    try:
+        parameter = ssm.get_parameter(
+            Name=f"/animal-rekognition/{animal}/model/model-arn"
+        )
+    except ssm.exceptions.ParameterNotFound:
+        return None
+    return parameter["Parameter"]["Value"]
+
+
 if __name__ == "__main__":
 
     ANIMAL = os.environ.get("ANIMAL")
@@ -60,73 +675,131 @@ if __name__ == "__main__":
     )
 
     RESULTS_DIR = os.environ.get("RESULTS_DIR", "./")
-
-    model_versions = rekognition_client.describe_project_versions(
-        ProjectArn=PROJECT_ARN,
-        VersionNames=[
-            MODEL_NAME,
-        ],
+    MAX_WORKERS = int(os.environ.get("MAX_WORKERS", DEFAULT_MAX_WORKERS))
+    MAX_FAILED_FRACTION = float(
+        os.environ.get("MAX_FAILED_FRACTION", DEFAULT_MAX_FAILED_FRACTION)
     )
+    CHECKPOINT_S3_PREFIX = os.environ.get(
+        "CHECKPOINT_S3_PREFIX",
+        f"s3://{S3_BUCKET}/{VERSION}/{ANIMAL}/{UUID}/evaluation/checkpoint/",
+    )
+    # other versions of the project and models of any project, e.g. the
+    # currently promoted one, to evaluate and compare in the same pass
+    COMPARE_MODEL_NAMES = env_list("COMPARE_MODEL_NAMES")
+    COMPARE_MODEL_ARNS = env_list("COMPARE_MODEL_ARNS")
+    COMPARE_PROMOTED = os.environ.get("COMPARE_PROMOTED", "false").lower() == "true"
+    # stop predicting once the accuracy is clearly above or below the
+    # promotion threshold of the animal, DOG_ACCURACY or CAT_ACCURACY
+    EARLY_STOPPING = os.environ.get("EARLY_STOPPING", "false").lower() == "true"
+    PROMOTION_ACCURACY = os.environ.get(f"{ANIMAL.upper()}_ACCURACY")
+    # "training" scores the test set predictions Rekognition made when it
+    # trained the model, so the model does not need to be running
+    EVALUATION_SOURCE = os.environ.get("EVALUATION_SOURCE", "inference")
 
-    model_arn = ""
-    versions = model_versions["ProjectVersionDescriptions"]
-    for version in versions:
-        if MODEL_NAME in version["ProjectVersionArn"]:
-            model_arn = version["ProjectVersionArn"]
+    if EVALUATION_SOURCE == "training":
+        summary_path, manifest_path = find_training_output(
+            describe_model(PROJECT_ARN, MODEL_NAME)
+        )
+        print(f"evaluation manifest: s3://{manifest_path[0]}/{manifest_path[1]}")
+        summary = json.loads(
+            s3.get_object(Bucket=summary_path[0], Key=summary_path[1])["Body"].read()
+        )
+        with smart_open.open(f"s3://{manifest_path[0]}/{manifest_path[1]}") as ff:
+            manifest_lines = [json.loads(line) for line in ff if line.strip()]
+        preds_df, metrics_dict = evaluate_training_output(manifest_lines, summary)
+        print(json.dumps(metrics_dict["training_summary"]))
+        write_predictions(os.path.join(RESULTS_DIR, "predictions.npz"), preds_df)
+        with open(os.path.join(RESULTS_DIR, "classification_metrics.json"), "w") as ff:
+            json.dump(metrics_dict, ff)
+        sys.exit(0)
 
+    model_arns_by_name = find_model_arns(
+        PROJECT_ARN, [MODEL_NAME] + COMPARE_MODEL_NAMES
+    )
+    model_arn = model_arns_by_name[MODEL_NAME]
     print(f"model_arn: {model_arn}")
+    model_arns = [model_arn]
+    model_arns += [model_arns_by_name[name] for name in COMPARE_MODEL_NAMES]
+    model_arns += COMPARE_MODEL_ARNS
+    if COMPARE_PROMOTED:
+        promoted_model_arn = get_promoted_model_arn(ANIMAL)
+        print(f"promoted model_arn: {promoted_model_arn}")
+        if promoted_model_arn is not None:
+            model_arns.append(promoted_model_arn)
+    # the same model given twice is only evaluated once
+    model_arns = list(dict.fromkeys(model_arns))
 
     manifest_lines = []
     with smart_open.open(TEST_MANIFEST) as ff:
         for line in ff:
             manifest_lines.append(json.loads(line))
 
-    filepaths = []
-    predictions = []
-    y_true = []
-    y_pred = []
-    min_confidence = 1  # %
-
-    for line in manifest_lines:
-        if "lable-name" in line:
-            true_breed = line["label-name"]
-        else:
-            true_breed = None
-        for top_key in line.keys():
-            # NB: requires breed label (and no others) to have "breed" in the name
-            if "breed" in top_key and "-metadata" in top_key:
-                true_breed = split_name_id(
-                    line[top_key]["class-name"].split("-", maxsplit=1)[-1]
-                )[0]
-                break
-        if true_breed is None:
-            raise Exception("Can't find breed label in manifest")
-
-        y_true.append(true_breed)
-        s3path = line["source-ref"]
-        bucket, prefix = s3path.replace("s3://", "").split("/", 1)
-        response = get_prediction(bucket, prefix, model_arn, min_confidence)
-
-        try:
-            if len(response["CustomLabels"]) == 0:
-                y_pred.append("NAN")
-                predictions.append({})
-            else:
-                raw_labels = response["CustomLabels"]
-                labels = partition_labels(raw_labels)
-                y_pred.append(labels["breed"][0]["Name"])
-                predictions.append(
-                    {label["Name"]: label["Confidence"] for label in labels["breed"]}
-                )
-
-        except Exception as e:
-            predictions.append({})
-            y_pred.append("NAN")
+    sequential_test = None
+    if EARLY_STOPPING and PROMOTION_ACCURACY is not None:
+        sequential_test = SequentialAccuracyTest(
+            float(PROMOTION_ACCURACY),
+            alpha=float(os.environ.get("EARLY_STOPPING_ALPHA", DEFAULT_ALPHA)),
+            check_every=int(
+                os.environ.get("EARLY_STOPPING_CHECK_EVERY", DEFAULT_CHECK_EVERY)
+            ),
+            min_images=int(
+                os.environ.get("EARLY_STOPPING_MIN_IMAGES", DEFAULT_MIN_IMAGES)
+            ),
+        )
+        # the same order on every run of the job, so a resumed run carries on
+        manifest_lines = stratified_order(
+            manifest_lines, [get_true_breed(line) for line in manifest_lines], UUID
+        )
 
-    preds_df = pd.DataFrame(predictions)
-    preds_df["y_true"] = y_true
-    preds_df.to_csv(os.path.join(RESULTS_DIR, "predictions.csv"))
+    min_confidence = 1  # %
+    # kept between runs of the job, so a failed or timed out run is resumed
+    checkpoints = {
+        arn: PredictionCheckpoint(
+            os.path.join(
+                RESULTS_DIR,
+                (
+                    "predictions.checkpoint.jsonl"
+                    if arn == model_arn
+                    else f"predictions.checkpoint.{model_name(arn)}.jsonl"
+                ),
+            ),
+            arn,
+            min_confidence,
+            s3_prefix=f"{CHECKPOINT_S3_PREFIX.rstrip('/')}/{model_name(arn)}/",
+        )
+        for arn in model_arns
+    }
+    results, comparisons = evaluate_models(
+        manifest_lines,
+        model_arns,
+        min_confidence,
+        MAX_WORKERS,
+        MAX_FAILED_FRACTION,
+        checkpoints,
+        sequential_test,
+    )
 
-    metrics_dict = classification_report(y_true, y_pred, output_dict=True)
+    preds_df, metrics_dict = results[model_arn]
+    print(json.dumps(metrics_dict["evaluation"]))
+    if "promotion" in metrics_dict:
+        print(json.dumps(metrics_dict["promotion"]))
+    write_predictions(os.path.join(RESULTS_DIR, "predictions.npz"), preds_df)
     with open(os.path.join(RESULTS_DIR, "classification_metrics.json"), "w") as ff:
         json.dump(metrics_dict, ff)
+
+    if comparisons:
+        for arn in model_arns[1:]:
+            write_predictions(
+                os.path.join(RESULTS_DIR, f"predictions.{model_name(arn)}.npz"),
+                results[arn][0],
+            )
+        for comparison in comparisons:
+            print(json.dumps(comparison))
+        with open(os.path.join(RESULTS_DIR, "model_comparison.json"), "w") as ff:
+            json.dump(
+                {
+                    "models": {arn: results[arn][1] for arn in model_arns},
+                    "comparisons": comparisons,
+                },
+                ff,
+            )
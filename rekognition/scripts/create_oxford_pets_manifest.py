@@ -3,11 +3,20 @@
 import os
 import sys
 import json
+import queue
+import string
+import threading
 from venv import create
 
 import boto3
 import smart_open
 
+# key ranges listed concurrently
+DEFAULT_SHARDS = 8
+# pages of up to 1000 keys each key range lists ahead of the manifest writer
+MAX_PAGES = 4
+KEY_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
 
 def make_label_metadata(label_name):
     metadata = {
@@ -44,38 +53,110 @@ def create_label_row(s3_path, label_dict):
     return custom_image_label
 
 
-def to_manifest(prefix_list, label_dict_list, bucket, output_path):
-
+def to_manifest(labelled_keys, bucket, output_path):
+    """
+    writes a manifest line for each (key, label dict) as it comes in,
+    returns the number of lines
+    """
     counter = 0
     with smart_open.open(output_path, "wt") as cc:
-        for prefix, label_dict in zip(prefix_list, label_dict_list):
+        for prefix, label_dict in labelled_keys:
             s3_path = f"s3://{bucket}/{prefix}"
             cc.write(json.dumps(create_label_row(s3_path, label_dict)) + "\n")
             counter += 1
     return counter
 
 
-def main(bucket, img_prefix, output_filepath):
-    prefix_list = []
+def shard_bounds(prefix, shards):
+    """
+    keys that split the listing of prefix into shards key ranges, spread over
+    the characters image names usually start with.  The ranges cover every
+    key whatever its name, the bounds only decide how even they are.
+    """
+    directory = prefix if prefix.endswith("/") else prefix + "/"
+    step = len(KEY_ALPHABET) / shards
+    return [directory + KEY_ALPHABET[int(i * step)] for i in range(1, shards)]
+
+
+def list_key_range(s3, bucket, prefix, start_after=None, end=None):
+    """
+    yields the pages of keys under prefix after start_after, up to and
+    including end
+    """
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if start_after is not None:
+        kwargs["StartAfter"] = start_after
+    for page in s3.get_paginator("list_objects_v2").paginate(**kwargs):
+        keys = [obj["Key"] for obj in page.get("Contents", [])]
+        if end is not None and keys and keys[-1] > end:
+            yield [key for key in keys if key <= end]
+            return
+        if keys:
+            yield keys
+
+
+def iter_keys(s3, bucket, prefix, shards=DEFAULT_SHARDS, max_pages=MAX_PAGES):
+    """
+    yields every key under prefix in key order, listing shards key ranges
+    concurrently.  Each range holds at most max_pages listed pages that were
+    not yet yielded, so memory does not grow with the number of keys.
+    """
+    bounds = [None] + shard_bounds(prefix, shards) + [None]
+    queues = [queue.Queue(maxsize=max_pages) for i in range(shards)]
+    stop = threading.Event()
+
+    def put(pages, item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def list_shard(i):
+        try:
+            for keys in list_key_range(s3, bucket, prefix, bounds[i], bounds[i + 1]):
+                put(queues[i], keys)
+                if stop.is_set():
+                    return
+            put(queues[i], None)
+        except Exception as e:
+            put(queues[i], e)
+
+    threads = [
+        threading.Thread(target=list_shard, args=(i,), daemon=True)
+        for i in range(shards)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for pages in queues:
+            while True:
+                keys = pages.get()
+                if keys is None:
+                    break
+                if isinstance(keys, Exception):
+                    raise keys
+                yield from keys
+    finally:
+        stop.set()
+
+
+def label_dict(key):
+    class_name = key.split("/")[-1].rsplit("_", 1)[0]
+    return {
+        "species": "dog" if class_name[0].islower() else "cat",
+        "breed": class_name.replace("_", " ").title(),
+    }
+
 
+def main(bucket, img_prefix, output_filepath, shards=DEFAULT_SHARDS):
     s3 = boto3.client("s3")
-    paginator = s3.get_paginator("list_objects_v2")
-    pages = paginator.paginate(Bucket=bucket, Prefix=img_prefix)
-    for page in pages:
-        for obj in page["Contents"]:
-            prefix = obj["Key"]
-            if prefix.endswith(".jpg"):
-                prefix_list.append(prefix)
-
-    classlist = [ff.split("/")[-1].rsplit("_", 1)[0] for ff in prefix_list]
-    label_dict_list = [
-        {
-            "species": "dog" if cn[0].islower() else "cat",
-            "breed": cn.replace("_", " ").title(),
-        }
-        for cn in classlist
-    ]
-    count = to_manifest(prefix_list, label_dict_list, bucket, output_filepath)
+    keys = iter_keys(s3, bucket, img_prefix, shards)
+    labelled_keys = ((key, label_dict(key)) for key in keys if key.endswith(".jpg"))
+    count = to_manifest(labelled_keys, bucket, output_filepath)
+    print(f"{count} images written to {output_filepath}")
+    return count
 
 
 if __name__ == "__main__":
@@ -84,4 +165,5 @@ if __name__ == "__main__":
     img_prefix = "OxfordPets/images"
 
     output_filepath = os.environ.get("OUTPUT_MANIFEST_PATH", "oxford-pets.manifest")
-    main(bucket, img_prefix, output_filepath)
+    shards = int(os.environ.get("LIST_SHARDS", DEFAULT_SHARDS))
+    main(bucket, img_prefix, output_filepath, shards)
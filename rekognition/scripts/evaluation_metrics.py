@@ -0,0 +1,212 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+"""
+Metrics of a model's predictions on a test set, computed with NumPy on a
+dense (images x classes) confidence matrix instead of per image dicts.
+Class names are encoded to integer ids once; every metric is then a few
+array operations, so tens of thousands of test images take well under a
+second.
+"""
+
+import numpy as np
+
+# top-1 prediction of an image the model found no label for
+NO_PREDICTION = "NAN"
+DEFAULT_TOP_K = (1, 3, 5)
+DEFAULT_CALIBRATION_BINS = 10
+
+
+class LabelEncoder:
+    """
+    maps class names to integer ids in sorted order, NO_PREDICTION included
+    """
+
+    def __init__(self, names):
+        self.classes = sorted(set(names) | {NO_PREDICTION})
+        self.ids = {name: i for i, name in enumerate(self.classes)}
+        self.no_prediction = self.ids[NO_PREDICTION]
+
+    def encode(self, names):
+        return np.fromiter((self.ids[name] for name in names), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.classes)
+
+
+def confidence_matrix(rows, encoder, dtype=np.float32):
+    """
+    dense matrix of the confidence of each class for each image, 0 where the
+    model did not return the class.  rows holds a list of (class name,
+    confidence) per image
+    """
+    image_ids = []
+    class_ids = []
+    values = []
+    for i, row in enumerate(rows):
+        for name, confidence in row:
+            image_ids.append(i)
+            class_ids.append(encoder.ids[name])
+            values.append(confidence)
+    matrix = np.zeros((len(rows), len(encoder)), dtype=dtype)
+    matrix[image_ids, class_ids] = values
+    return matrix
+
+
+def top_predictions(confidences, no_prediction):
+    """
+    class id of the most confident class of each image, no_prediction for
+    images without any
+    """
+    top = confidences.argmax(axis=1).astype(np.int32)
+    top[confidences.max(axis=1, initial=0) <= 0] = no_prediction
+    return top
+
+
+def top_k_accuracy(y_true, confidences, ks=DEFAULT_TOP_K):
+    """
+    fraction of images whose true class is among the k most confident
+    classes the model returned, for each k
+    """
+    max_k = min(max(ks), confidences.shape[1])
+    # argpartition then a sort of the k columns only
+    top = np.argpartition(-confidences, max_k - 1, axis=1)[:, :max_k]
+    top_confidences = np.take_along_axis(confidences, top, axis=1)
+    order = np.argsort(-top_confidences, axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    returned = np.take_along_axis(top_confidences, order, axis=1) > 0
+    hits = np.cumsum((top == y_true[:, None]) & returned, axis=1)
+    return {
+        str(k): float(hits[:, min(k, max_k) - 1].mean()) if len(y_true) else 0.0
+        for k in ks
+    }
+
+
+def confusion_matrix(y_true, y_pred, n_classes):
+    """
+    counts of images of each true class (rows) by predicted class (columns)
+    """
+    counts = np.bincount(
+        y_true.astype(np.int64) * n_classes + y_pred, minlength=n_classes**2
+    )
+    return counts.reshape(n_classes, n_classes)
+
+
+def safe_divide(numerator, denominator):
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.zeros(len(numerator), dtype=np.float64),
+        where=denominator > 0,
+    )
+
+
+def classification_report(confusion, classes):
+    """
+    per class precision, recall, f1-score and support with accuracy and
+    macro and weighted averages, in the format of
+    sklearn.metrics.classification_report(output_dict=True).
+    Only classes that are true or predicted for some image are reported.
+    """
+    true_counts = confusion.sum(axis=1)
+    predicted_counts = confusion.sum(axis=0)
+    present = (true_counts > 0) | (predicted_counts > 0)
+    correct = np.diag(confusion)[present]
+    support = true_counts[present]
+    precision = safe_divide(correct, predicted_counts[present])
+    recall = safe_divide(correct, support)
+    f1 = safe_divide(2 * precision * recall, precision + recall)
+
+    report = {}
+    for i, name in enumerate(np.asarray(classes)[present]):
+        report[str(name)] = {
+            "precision": float(precision[i]),
+            "recall": float(recall[i]),
+            "f1-score": float(f1[i]),
+            "support": float(support[i]),
+        }
+    total = support.sum()
+    report["accuracy"] = float(correct.sum() / total) if total else 0.0
+    for name, weights in [("macro avg", None), ("weighted avg", support)]:
+        if weights is not None and not weights.sum():
+            weights = None
+        report[name] = {
+            "precision": float(np.average(precision, weights=weights)),
+            "recall": float(np.average(recall, weights=weights)),
+            "f1-score": float(np.average(f1, weights=weights)),
+            "support": float(total),
+        }
+    return report
+
+
+def calibration_curve(y_true, y_pred, confidences, bins=DEFAULT_CALIBRATION_BINS):
+    """
+    accuracy of the top-1 predictions by their confidence in equal width
+    bins, and the expected calibration error: the support weighted gap
+    between the two
+    """
+    n_images = len(y_true)
+    top_confidence = confidences.max(axis=1, initial=0).astype(np.float64) / 100.0
+    correct = (y_pred == y_true).astype(np.float64)
+    bin_ids = np.minimum((top_confidence * bins).astype(np.int64), bins - 1)
+    counts = np.bincount(bin_ids, minlength=bins)
+    accuracy = safe_divide(np.bincount(bin_ids, correct, bins), counts)
+    mean_confidence = safe_divide(np.bincount(bin_ids, top_confidence, bins), counts)
+    gaps = np.abs(accuracy - mean_confidence) * counts
+    return {
+        "bins": [
+            {
+                "lower": i / bins,
+                "upper": (i + 1) / bins,
+                "count": int(counts[i]),
+                "accuracy": float(accuracy[i]),
+                "mean_confidence": float(mean_confidence[i]),
+            }
+            for i in range(bins)
+            if counts[i]
+        ],
+        "expected_calibration_error": float(gaps.sum() / n_images) if n_images else 0.0,
+    }
+
+
+class Evaluation:
+    """
+    the true class and the confidence matrix of a set of test images
+    """
+
+    def __init__(self, y_true, rows):
+        rows = list(rows)
+        self.encoder = LabelEncoder(
+            list(y_true) + [name for row in rows for name, confidence in row]
+        )
+        self.y_true = self.encoder.encode(y_true)
+        self.confidences = confidence_matrix(rows, self.encoder)
+        self.y_pred = top_predictions(self.confidences, self.encoder.no_prediction)
+
+    @property
+    def classes(self):
+        return self.encoder.classes
+
+    def predicted_names(self):
+        return [self.encoder.classes[i] for i in self.y_pred]
+
+    def confusion_matrix(self):
+        return confusion_matrix(self.y_true, self.y_pred, len(self.encoder))
+
+    def metrics(self, ks=DEFAULT_TOP_K, bins=DEFAULT_CALIBRATION_BINS):
+        """
+        classification_report of the top-1 predictions with the top-k
+        accuracy, calibration curve and confusion matrix of the classes
+        that are true or predicted for some image
+        """
+        confusion = self.confusion_matrix()
+        report = classification_report(confusion, self.classes)
+        report["top_k_accuracy"] = top_k_accuracy(self.y_true, self.confidences, ks)
+        report["calibration"] = calibration_curve(
+            self.y_true, self.y_pred, self.confidences, bins
+        )
+        present = (confusion.sum(axis=0) > 0) | (confusion.sum(axis=1) > 0)
+        report["confusion_matrix"] = {
+            "labels": [name for name, keep in zip(self.classes, present) if keep],
+            "matrix": confusion[np.ix_(present, present)].tolist(),
+        }
+        return report
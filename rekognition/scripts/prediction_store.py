@@ -0,0 +1,119 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+"""
+Compact storage of an evaluation's predictions: the breed confidences of
+every test image as a sparse (CSR) float32 matrix in a compressed .npz, with
+the breed names, the true breed ids and the source-ref of every image.
+A model returns a few of the breeds for each image, so this is a fraction of
+the size of a dense table and loads without parsing text; each array of the
+file is only read when it is used.
+"""
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+
+
+def save_predictions(file, source_refs, y_true, confidences, breeds):
+    """
+    writes the (images x breeds) confidences, 0 where the model did not
+    return the breed, with the true breed and source-ref of each image
+    """
+    confidences = np.asarray(confidences, dtype=np.float32)
+    breeds = list(breeds)
+    labels = breeds + sorted(set(y_true) - set(breeds))
+    ids = {name: i for i, name in enumerate(labels)}
+    rows, columns = np.nonzero(confidences)
+    indptr = np.zeros(len(confidences) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(confidences)), out=indptr[1:])
+    index_type = np.int16 if len(labels) < np.iinfo(np.int16).max else np.int32
+    np.savez_compressed(
+        file,
+        version=np.array(FORMAT_VERSION),
+        labels=np.array(labels, dtype=str),
+        n_breeds=np.array(len(breeds)),
+        source_refs=np.array(list(source_refs), dtype=str),
+        y_true=np.array([ids[name] for name in y_true], dtype=np.int32),
+        indptr=indptr,
+        indices=columns.astype(index_type),
+        values=confidences[rows, columns],
+    )
+
+
+class Predictions:
+    """
+    read only view of a file written by save_predictions
+    """
+
+    def __init__(self, file):
+        self._npz = np.load(file, allow_pickle=False)
+        version = int(self._npz["version"])
+        if version > FORMAT_VERSION:
+            raise ValueError(f"predictions format {version} is not supported")
+        self._labels = None
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = self._npz["labels"].tolist()
+        return self._labels
+
+    @property
+    def breeds(self):
+        """
+        the breeds the model returned for some image, the confidence columns
+        """
+        return self.labels[: int(self._npz["n_breeds"])]
+
+    @property
+    def source_refs(self):
+        return self._npz["source_refs"].tolist()
+
+    @property
+    def y_true(self):
+        labels = self.labels
+        return [labels[i] for i in self._npz["y_true"]]
+
+    def __len__(self):
+        return len(self._npz["indptr"]) - 1
+
+    def column(self, breed):
+        """
+        the confidence of one breed for every image
+        """
+        column = np.zeros(len(self), dtype=np.float32)
+        hits = np.flatnonzero(self._npz["indices"] == self.labels.index(breed))
+        rows = np.searchsorted(self._npz["indptr"], hits, side="right") - 1
+        column[rows] = self._npz["values"][hits]
+        return column
+
+    def confidences(self):
+        """
+        dense (images x breeds) matrix, 0 where the model did not return the
+        breed
+        """
+        indptr = self._npz["indptr"]
+        matrix = np.zeros((len(indptr) - 1, len(self.breeds)), dtype=np.float32)
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        matrix[rows, self._npz["indices"]] = self._npz["values"]
+        return matrix
+
+    def to_dataframe(self):
+        """
+        a breed per column and the true breed in y_true, indexed by source-ref
+        """
+        preds_df = pd.DataFrame(
+            self.confidences(), columns=self.breeds, index=self.source_refs
+        )
+        preds_df["y_true"] = self.y_true
+        return preds_df
+
+    def close(self):
+        self._npz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,123 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+"""
+Early stopping of a model evaluation once its accuracy is clearly above or
+below the promotion threshold.
+"""
+
+import math
+import random
+from collections import defaultdict
+
+PROMOTE = "promote"
+REJECT = "reject"
+DEFAULT_ALPHA = 0.05
+# images between two looks at the bounds
+DEFAULT_CHECK_EVERY = 50
+# images before the first look
+DEFAULT_MIN_IMAGES = 200
+
+
+def stratified_order(items, strata, seed):
+    """
+    shuffles items so that every prefix holds each stratum in about its
+    share of all items: the members of a stratum are shuffled and spread
+    evenly over the order, from a random offset
+    """
+    rng = random.Random(seed)
+    by_stratum = defaultdict(list)
+    for item, stratum in zip(items, strata):
+        by_stratum[stratum].append(item)
+    keyed = []
+    for stratum in sorted(by_stratum):
+        members = by_stratum[stratum]
+        rng.shuffle(members)
+        offset = rng.random()
+        for j, item in enumerate(members):
+            keyed.append(((j + offset) / len(members), rng.random(), item))
+    keyed.sort(key=lambda entry: entry[:2])
+    return [item for position, tie_break, item in keyed]
+
+
+class SequentialAccuracyTest:
+    """
+    Decides whether a model's accuracy is at least threshold while its test
+    images are still being predicted.
+    Every check_every images after min_images the accuracy so far gets
+    Hoeffding bounds at an error rate of alpha / (k * (k + 1)) for the k-th
+    look.  These add up to alpha, so the chance the bounds ever exclude the
+    true accuracy is at most alpha however long the test runs, and the test
+    stops as soon as they are both above (promote) or below (reject) the
+    threshold.  The images must be in random order, e.g. stratified_order.
+    """
+
+    def __init__(
+        self,
+        threshold,
+        alpha=DEFAULT_ALPHA,
+        check_every=DEFAULT_CHECK_EVERY,
+        min_images=DEFAULT_MIN_IMAGES,
+    ):
+        self.threshold = threshold
+        self.alpha = alpha
+        self.check_every = check_every
+        self.min_images = min_images
+        self.images = 0
+        self.correct = 0
+        self.looks = 0
+        self.lower = 0.0
+        self.upper = 1.0
+        self.decision = None
+        self.stopped_early = False
+
+    @property
+    def accuracy(self):
+        return self.correct / self.images if self.images else 0.0
+
+    def record(self, correct):
+        """
+        adds the result of one image, returns the decision once there is one
+        """
+        if self.decision is not None:
+            return self.decision
+        self.images += 1
+        self.correct += bool(correct)
+        if (
+            self.images >= self.min_images
+            and (self.images - self.min_images) % self.check_every == 0
+        ):
+            self.look()
+        return self.decision
+
+    def look(self):
+        self.looks += 1
+        alpha = self.alpha / (self.looks * (self.looks + 1))
+        half_width = math.sqrt(math.log(2 / alpha) / (2 * self.images))
+        self.lower = max(0.0, self.accuracy - half_width)
+        self.upper = min(1.0, self.accuracy + half_width)
+        if self.lower >= self.threshold:
+            self.decision = PROMOTE
+        elif self.upper < self.threshold:
+            self.decision = REJECT
+        self.stopped_early = self.decision is not None
+
+    def finish(self):
+        """
+        decides on the accuracy of every image when the bounds never did
+        """
+        if self.decision is None:
+            self.decision = PROMOTE if self.accuracy >= self.threshold else REJECT
+        return self.decision
+
+    def to_dict(self):
+        return {
+            "decision": self.decision,
+            "threshold": self.threshold,
+            "confidence": 1 - self.alpha,
+            "stopped_early": self.stopped_early,
+            "images": self.images,
+            "accuracy": self.accuracy,
+            "lower_bound": self.lower,
+            "upper_bound": self.upper,
+            "looks": self.looks,
+        }
@@ -0,0 +1,170 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+"""
+Sweeps the minimum confidence and top_n of the predict lambda over the
+confidences of an evaluation's predictions.npz, without calling the model
+again.
+
+    PREDICTIONS_PATH=s3://<bucket>/<version>/<animal>/<uuid>/evaluation/predictions.npz \\
+    python rekognition/scripts/threshold_sweep.py
+
+For every (min_confidence, top_n) it reports the share of images that get
+any breed (coverage), how often the top breed is right when there is one
+(precision) and overall (accuracy), how often the true breed is among the
+top_n returned (top_n_recall), and the breeds returned per image with their
+size in the response: each of them is also a DynamoDB item the lambda reads.
+The evaluation predicts with a min_confidence of 1, so lower thresholds can
+not be told apart.
+"""
+
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import smart_open
+
+from prediction_store import Predictions
+
+DEFAULT_THRESHOLDS = tuple(range(1, 100))
+DEFAULT_TOP_N = (1, 3, 5)
+
+
+def label_bytes(names):
+    """
+    size of each breed label in the predict lambda's response
+    """
+    return np.array(
+        [
+            len(json.dumps({"Name": name, "Confidence": 99.99999, "Id": "0"})) + 2
+            for name in names
+        ],
+        dtype=np.float64,
+    )
+
+
+class ConfidenceSweep:
+    """
+    the per image quantities every threshold and top_n is computed from:
+    the confidences sorted in descending order, the rank and confidence of
+    the true breed and the cumulative response size of the top k breeds
+    """
+
+    def __init__(self, y_true, confidences, classes):
+        classes = list(classes)
+        ids = {name: i for i, name in enumerate(classes)}
+        confidences = np.asarray(confidences, dtype=np.float64)
+        n_images, n_classes = confidences.shape
+        order = np.argsort(-confidences, axis=1, kind="stable")
+        self.sorted = np.take_along_axis(confidences, order, axis=1)
+        self.n_images = n_images
+        self.n_classes = n_classes
+
+        # true breeds the model does not know are never returned
+        true_ids = np.array([ids.get(name, -1) for name in y_true], dtype=np.int64)
+        known = true_ids >= 0
+        self.true_confidence = np.zeros(n_images)
+        self.true_confidence[known] = confidences[known, true_ids[known]]
+        self.true_rank = np.full(n_images, n_classes, dtype=np.int64)
+        self.true_rank[known] = np.argmax(order[known] == true_ids[known, None], axis=1)
+
+        sizes = np.take(label_bytes(classes), order)
+        self.cumulative_bytes = np.concatenate(
+            [np.zeros((n_images, 1)), np.cumsum(sizes, axis=1)], axis=1
+        )
+
+    def returned(self, threshold):
+        """
+        number of breeds at or above threshold for each image
+        """
+        return ((self.sorted >= threshold) & (self.sorted > 0)).sum(axis=1)
+
+    def rows(self, thresholds=DEFAULT_THRESHOLDS, top_ns=DEFAULT_TOP_N):
+        rows = []
+        n_images = max(self.n_images, 1)
+        true_returned = self.true_confidence > 0
+        for threshold in thresholds:
+            returned = self.returned(threshold)
+            covered = returned > 0
+            true_kept = true_returned & (self.true_confidence >= threshold)
+            correct = int((true_kept & (self.true_rank == 0)).sum())
+            n_covered = int(covered.sum())
+            for top_n in top_ns:
+                sent = np.minimum(returned, top_n)
+                payload = self.cumulative_bytes[np.arange(self.n_images), sent]
+                rows.append(
+                    {
+                        "min_confidence": threshold,
+                        "top_n": top_n,
+                        "coverage": n_covered / n_images,
+                        "precision": correct / n_covered if n_covered else 0.0,
+                        "accuracy": correct / n_images,
+                        "top_n_recall": float(
+                            (true_kept & (self.true_rank < top_n)).sum() / n_images
+                        ),
+                        "mean_breeds": float(sent.mean()) if self.n_images else 0.0,
+                        "mean_breed_bytes": (
+                            float(payload.mean()) if self.n_images else 0.0
+                        ),
+                    }
+                )
+        return rows
+
+
+def best_threshold(rows, min_precision, top_n=None):
+    """
+    the row with the most coverage whose precision is at least min_precision,
+    None when no threshold gets there
+    """
+    candidates = [
+        row
+        for row in rows
+        if row["precision"] >= min_precision and top_n in (None, row["top_n"])
+    ]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda row: (row["coverage"], -row["mean_breeds"]))
+
+
+def load_predictions(file, csv=False):
+    """
+    returns (true breeds, confidence matrix, breed names) of the predictions
+    written by create_evaluation_metrics.py, a predictions.csv of an older
+    evaluation with csv
+    """
+    if not csv:
+        with Predictions(file) as predictions:
+            return predictions.y_true, predictions.confidences(), predictions.breeds
+    preds_df = pd.read_csv(file, index_col=0)
+    classes = [column for column in preds_df.columns if column != "y_true"]
+    confidences = preds_df[classes].fillna(0).to_numpy(dtype=np.float64)
+    return preds_df["y_true"].astype(str).tolist(), confidences, classes
+
+
+def parse_numbers(value, cast):
+    return tuple(cast(number) for number in value.split(",") if number)
+
+
+if __name__ == "__main__":
+
+    PREDICTIONS_PATH = os.environ.get("PREDICTIONS_PATH", "predictions.npz")
+    OUTPUT_PATH = os.environ.get("OUTPUT_PATH", "threshold_sweep.csv")
+    THRESHOLDS = parse_numbers(os.environ.get("THRESHOLDS", ""), float)
+    TOP_N = parse_numbers(os.environ.get("TOP_N", ""), int)
+    # report the threshold with the most coverage at this precision
+    MIN_PRECISION = float(os.environ.get("MIN_PRECISION", 0.9))
+
+    csv = PREDICTIONS_PATH.endswith(".csv")
+    with smart_open.open(PREDICTIONS_PATH, "r" if csv else "rb") as ff:
+        y_true, confidences, classes = load_predictions(ff, csv=csv)
+
+    sweep = ConfidenceSweep(y_true, confidences, classes)
+    rows = sweep.rows(THRESHOLDS or DEFAULT_THRESHOLDS, TOP_N or DEFAULT_TOP_N)
+    pd.DataFrame(rows).to_csv(OUTPUT_PATH, index=False)
+    print(f"{len(rows)} settings of {len(y_true)} images written to {OUTPUT_PATH}")
+
+    best = best_threshold(rows, MIN_PRECISION)
+    if best is None:
+        print(f"no min_confidence reaches a precision of {MIN_PRECISION}")
+    else:
+        print(json.dumps(best))
@@ -0,0 +1,133 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+"""
+Reads the evaluation Rekognition Custom Labels writes to the OutputConfig of
+a training job: the summary file with the test set F1 score, precision and
+recall of every label, and the evaluation manifest snapshot that has the
+ground truth and the labels the model predicted for every test image.
+The manifest is turned into the detect_custom_labels responses the model
+would have given, so the evaluation step scores it like its own predictions.
+Keys and fields that are missing or unexpected are skipped, not fatal.
+"""
+
+from label_codec import parse_label
+
+EVALUATION_KEY = "rekognition-custom-labels-evaluation"
+EVALUATION_DETAILS = "rekognition-custom-labels-evaluation-details"
+
+
+def label_entries(line):
+    """
+    yields (is evaluation, metadata) of every label of a manifest line
+    """
+    for key, value in line.items():
+        if key.endswith("-metadata") and isinstance(value, dict):
+            if "class-name" in value:
+                yield EVALUATION_KEY in key, value
+
+
+def is_predicted(metadata):
+    """
+    whether an evaluation label is one the model returned, false negatives
+    and true negatives are labels of the ground truth it did not return
+    """
+    details = metadata.get(EVALUATION_DETAILS, {})
+    return not (
+        details.get("is-false-negative", False)
+        or details.get("is-true-negative", False)
+    )
+
+
+def percent(confidence):
+    """
+    the manifest has confidences from 0 to 1, detect_custom_labels in percent
+    """
+    confidence = float(confidence)
+    return confidence * 100 if confidence <= 1 else confidence
+
+
+def true_breed(labels):
+    """
+    the breed among the ground truth class names, the only class name when
+    none of them has the breed- prefix
+    """
+    for class_name in labels:
+        kind, name, label_id = parse_label(class_name)
+        if kind == "breed":
+            return name
+    if len(labels) == 1:
+        return labels[0]
+    return None
+
+
+def parse_evaluation_line(line):
+    """
+    returns (source-ref, true breed, detect_custom_labels response) of a line
+    of the evaluation manifest, None for lines without an image, a ground
+    truth breed or an evaluation
+    """
+    source_ref = line.get("source-ref")
+    ground_truth = []
+    custom_labels = {}
+    evaluated = False
+    for is_evaluation, metadata in label_entries(line):
+        if not is_evaluation:
+            ground_truth.append(metadata["class-name"])
+            continue
+        evaluated = True
+        if not is_predicted(metadata):
+            continue
+        try:
+            confidence = percent(metadata.get("confidence", 1))
+        except (TypeError, ValueError):
+            continue
+        name = metadata["class-name"]
+        custom_labels[name] = max(confidence, custom_labels.get(name, 0))
+    breed = true_breed(ground_truth)
+    if source_ref is None or breed is None or not evaluated:
+        return None
+    response = {
+        "CustomLabels": [
+            {"Name": name, "Confidence": confidence}
+            for name, confidence in sorted(
+                custom_labels.items(), key=lambda label: -label[1]
+            )
+        ]
+    }
+    return source_ref, breed, response
+
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_summary(summary):
+    """
+    the test set metrics of the summary file, overall and per label, with the
+    threshold Rekognition picked for each label
+    """
+    aggregated = summary.get("AggregatedEvaluationResults", {})
+    details = summary.get("EvaluationDetails", {})
+    labels = {}
+    for result in summary.get("LabelEvaluationResults", []):
+        if "Label" not in result:
+            continue
+        metrics = result.get("Metrics", {})
+        labels[result["Label"]] = {
+            "f1-score": number(metrics.get("F1Score")),
+            "precision": number(metrics.get("Precision")),
+            "recall": number(metrics.get("Recall")),
+            "threshold": number(metrics.get("Threshold")),
+            "support": result.get("NumberOfTestingImages"),
+        }
+    return {
+        "f1-score": number(aggregated.get("F1Score")),
+        "precision": number(aggregated.get("Precision")),
+        "recall": number(aggregated.get("Recall")),
+        "testing_images": details.get("NumberOfTestingImages"),
+        "training_images": details.get("NumberOfTrainingImages"),
+        "labels": labels,
+    }
@@ -47,6 +47,8 @@ def resource_suffix(resourceType):
         suffix = "ssm"
     if resourceType is _lambda.Function:
         suffix = "lbd"
+    if resourceType is _lambda.LayerVersion:
+        suffix = "lyr"
     if resourceType is stepfunctions.StateMachine:
         suffix = "stm"
     if resourceType is tasks.LambdaInvoke:
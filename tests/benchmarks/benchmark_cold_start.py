@@ -0,0 +1,92 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+"""
+Measures the cold start cost of the predict lambda in fresh interpreters:
+the module import time reported by python -X importtime, and the time to
+create the clients the first request needs.  Exits with status 1 when the
+median import time is over the budget.
+
+    python tests/benchmarks/benchmark_cold_start.py
+
+IMPORT_BUDGET_MS (default 150) sets the budget, ITERATIONS the number of
+interpreters started.
+"""
+
+import os
+import sys
+import statistics
+import subprocess
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+api_dir = os.path.realpath(os.path.join(script_dir, "../../rekognition/lambda/api"))
+
+MODULE = "predict_pet_image_attributes"
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", 150))
+ITERATIONS = int(os.environ.get("ITERATIONS", 5))
+
+ENV = {
+    **os.environ,
+    "ATTRIBUTES_TO_SEND": "attribute_1,attribute_2,attribute_3",
+    "MINIMUM_CONFIDENCE": "5",
+    "ANIMAL_ATTRIBUTES_DDB_TBL": "breed-attributes",
+    "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+}
+
+FIRST_REQUEST = f"""
+import time
+import {MODULE} as predict
+import aws_clients
+start = time.perf_counter()
+for service in ("ssm", "s3", "rekognition"):
+    aws_clients.get_client(service)
+predict.get_dynamo_resource()
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def import_time_ms():
+    """
+    cumulative import time of the module, in ms, from -X importtime output
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {MODULE}"],
+        cwd=api_dir,
+        env=ENV,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == MODULE:
+            return int(fields[1]) / 1000
+    raise Exception(f"{MODULE} not found in importtime output")
+
+
+def first_request_clients_ms():
+    result = subprocess.run(
+        [sys.executable, "-c", FIRST_REQUEST],
+        cwd=api_dir,
+        env=ENV,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    imports = [import_time_ms() for _ in range(ITERATIONS)]
+    clients = [first_request_clients_ms() for _ in range(ITERATIONS)]
+    import_median = statistics.median(imports)
+    print(
+        f"import: median={import_median:.1f}ms max={max(imports):.1f}ms "
+        f"(budget {IMPORT_BUDGET_MS:.0f}ms), {ITERATIONS} interpreters"
+    )
+    print(
+        f"first request client creation: median={statistics.median(clients):.1f}ms "
+        f"max={max(clients):.1f}ms"
+    )
+    if import_median > IMPORT_BUDGET_MS:
+        print(f"import time is over the {IMPORT_BUDGET_MS:.0f}ms budget")
+        sys.exit(1)
@@ -0,0 +1,77 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+"""
+Compares the classification metrics of a test set computed the way
+create_evaluation_metrics.py used to, a DataFrame of per image dicts and
+sklearn's classification_report, with the NumPy Evaluation engine.
+
+    python tests/benchmarks/benchmark_evaluation_metrics.py
+
+IMAGES sets the number of test images (default 20000), CLASSES the number of
+breeds and LABELS the labels returned per image.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import classification_report
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir, "../../rekognition/scripts"))
+from evaluation_metrics import Evaluation
+
+IMAGES = int(os.environ.get("IMAGES", 20000))
+CLASSES = int(os.environ.get("CLASSES", 37))
+LABELS = int(os.environ.get("LABELS", 10))
+
+
+def dataframe_metrics(y_true, rows):
+    predictions = [{name: confidence for name, confidence in row} for row in rows]
+    y_pred = [row[0][0] for row in rows]
+    preds_df = pd.DataFrame(predictions)
+    preds_df["y_true"] = y_true
+    return preds_df, classification_report(y_true, y_pred, output_dict=True)
+
+
+def engine_metrics(y_true, rows):
+    evaluation = Evaluation(y_true, rows)
+    return evaluation.confidences, evaluation.metrics()
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 1024 / 1024
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(7)
+    classes = [f"Breed {i}" for i in range(CLASSES)]
+    y_true = list(rng.choice(classes, IMAGES))
+    rows = []
+    for i in range(IMAGES):
+        names = rng.choice(classes, LABELS, replace=False)
+        confidences = np.sort(rng.uniform(1, 100, LABELS))[::-1]
+        rows.append([(str(n), float(c)) for n, c in zip(names, confidences)])
+
+    (_, expected), df_s, df_mb = measure(dataframe_metrics, y_true, rows)
+    (_, report), np_s, np_mb = measure(engine_metrics, y_true, rows)
+    assert abs(expected["accuracy"] - report["accuracy"]) < 1e-9
+    assert (
+        abs(expected["macro avg"]["f1-score"] - report["macro avg"]["f1-score"]) < 1e-9
+    )
+
+    print(f"{IMAGES} images, {CLASSES} classes, {LABELS} labels per image")
+    print(f"dataframe + classification_report: {df_s:.2f}s, peak {df_mb:.0f}MB")
+    print(
+        f"numpy engine (+ top-k, confusion matrix, calibration): {np_s:.2f}s, "
+        f"peak {np_mb:.0f}MB, {df_s / np_s:.1f}x faster"
+    )
@@ -0,0 +1,63 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+"""
+Compares partitioning Rekognition labels by parsing every label name, as
+partition_labels used to, with the compiled LabelCodec lookup table.
+
+    python tests/benchmarks/benchmark_label_codec.py
+
+LABELS sets the number of labels per response (default 500), ITERATIONS the
+number of responses partitioned.
+"""
+
+import os
+import sys
+import timeit
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir, "../../rekognition/lambda/api"))
+from label_codec import LabelCodec, split_name_id
+
+LABELS = int(os.environ.get("LABELS", 500))
+ITERATIONS = int(os.environ.get("ITERATIONS", 2000))
+
+RAW_LABELS = [f"breed-Breed {i}||{i}" for i in range(LABELS - 2)] + [
+    "species-cat",
+    "species-dog",
+]
+RESPONSE = [
+    {"Name": name, "Confidence": 100.0 * i / LABELS}
+    for i, name in enumerate(RAW_LABELS)
+]
+MANIFEST = [
+    {"classification_breed-metadata": {"class-name": name}} for name in RAW_LABELS
+]
+
+
+def parse_every_label(label_list):
+    labels = {"breed": [], "species": []}
+    for label_dict in label_list:
+        if label_dict["Name"].startswith("species-"):
+            species_name, species_id = split_name_id(label_dict["Name"][8:])
+            labels["species"].append(
+                {**label_dict, "Name": species_name, "Id": species_id}
+            )
+        elif label_dict["Name"].startswith("breed-"):
+            breed_name, breed_id = split_name_id(label_dict["Name"][6:])
+            labels["breed"].append({**label_dict, "Name": breed_name, "Id": breed_id})
+    return labels
+
+
+if __name__ == "__main__":
+    codec = LabelCodec.from_manifest(MANIFEST)
+    assert codec.partition(RESPONSE) == parse_every_label(RESPONSE)
+
+    parse_s = timeit.timeit(lambda: parse_every_label(RESPONSE), number=ITERATIONS)
+    codec_s = timeit.timeit(lambda: codec.partition(RESPONSE), number=ITERATIONS)
+    compile_s = timeit.timeit(lambda: LabelCodec.from_manifest(MANIFEST), number=1)
+    print(f"{LABELS} labels per response, {ITERATIONS} responses")
+    print(f"parse every label: {parse_s / ITERATIONS * 1e6:.1f}us per response")
+    print(
+        f"label codec: {codec_s / ITERATIONS * 1e6:.1f}us per response, "
+        f"{parse_s / codec_s:.2f}x faster, compiled in {compile_s * 1000:.2f}ms"
+    )
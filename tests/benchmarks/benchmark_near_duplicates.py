@@ -0,0 +1,82 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+"""
+Compares a near duplicate lookup in the BKTree with a linear scan of every
+hash, and times dhash of a listing sized JPEG.
+
+    python tests/benchmarks/benchmark_near_duplicates.py
+
+ENTRIES sets the number of hashes cached per model (default 10000), QUERIES
+the number of lookups and MAX_DISTANCE the match threshold in bits.
+"""
+
+import io
+import os
+import sys
+import random
+import timeit
+
+from PIL import Image
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir, "../../rekognition/lambda/api"))
+from near_duplicates import BKTree, dhash, hamming
+
+ENTRIES = int(os.environ.get("ENTRIES", 10000))
+QUERIES = int(os.environ.get("QUERIES", 1000))
+MAX_DISTANCE = int(os.environ.get("MAX_DISTANCE", 4))
+
+
+def linear_nearest(hashes, image_hash, max_distance):
+    best = None
+    for candidate in hashes:
+        distance = hamming(image_hash, candidate)
+        if distance <= max_distance and (best is None or distance < best[0]):
+            best = (distance, candidate)
+    return best
+
+
+def flip_bits(image_hash, bits, rng):
+    for bit in rng.sample(range(64), bits):
+        image_hash ^= 1 << bit
+    return image_hash
+
+
+if __name__ == "__main__":
+    rng = random.Random(7)
+    hashes = [rng.getrandbits(64) for _ in range(ENTRIES)]
+    tree = BKTree()
+    for image_hash in hashes:
+        tree.add(image_hash, None)
+    # half of the queries are near duplicates of a cached image
+    queries = [
+        (
+            flip_bits(rng.choice(hashes), rng.randint(0, MAX_DISTANCE), rng)
+            if i % 2
+            else rng.getrandbits(64)
+        )
+        for i in range(QUERIES)
+    ]
+    for query in queries:
+        expected = linear_nearest(hashes, query, MAX_DISTANCE)
+        found = tree.nearest(query, MAX_DISTANCE)
+        assert (expected and expected[0]) == (found and found[0])
+
+    linear_s = timeit.timeit(
+        lambda: [linear_nearest(hashes, q, MAX_DISTANCE) for q in queries], number=1
+    )
+    tree_s = timeit.timeit(
+        lambda: [tree.nearest(q, MAX_DISTANCE) for q in queries], number=1
+    )
+    print(f"{ENTRIES} hashes, {QUERIES} lookups within {MAX_DISTANCE} bits")
+    print(f"linear scan: {linear_s / QUERIES * 1e6:.1f}us per lookup")
+    print(
+        f"bk-tree: {tree_s / QUERIES * 1e6:.1f}us per lookup, "
+        f"{linear_s / tree_s:.1f}x faster"
+    )
+
+    buffer = io.BytesIO()
+    Image.effect_noise((1280, 960), 64).convert("RGB").save(buffer, format="JPEG")
+    image_bytes = buffer.getvalue()
+    hash_s = timeit.timeit(lambda: dhash(image_bytes), number=20) / 20
+    print(f"dhash of a 1280x960 JPEG: {hash_s * 1000:.2f}ms")
@@ -0,0 +1,167 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+"""
+Measures end to end latency of get_inferred_attributes with and without
+OVERLAP_IO, against stubbed AWS clients that sleep for a fixed time per call.
+
+    python tests/benchmarks/benchmark_predict_pipeline.py
+
+Latencies (ms) can be changed with env vars, e.g. REKOGNITION_LATENCY_MS=300.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import statistics
+
+from PIL import Image
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir, "../../rekognition/lambda/api"))
+
+os.environ.update(
+    {
+        "ATTRIBUTES_TO_SEND": "attribute_1,attribute_2,attribute_3",
+        "MINIMUM_CONFIDENCE": "5",
+        "ANIMAL_ATTRIBUTES_DDB_TBL": "breed-attributes",
+        "PREDICTION_CACHE_DDB_TBL": "prediction-cache",
+        "AWS_DEFAULT_REGION": "us-east-1",
+    }
+)
+import predict_pet_image_attributes as predict
+
+
+def latency(service, default_ms):
+    return float(os.environ.get(f"{service}_LATENCY_MS", default_ms)) / 1000
+
+
+SSM_LATENCY = latency("SSM", 15)
+S3_LATENCY = latency("S3", 20)
+REKOGNITION_LATENCY = latency("REKOGNITION", 150)
+DYNAMODB_LATENCY = latency("DYNAMODB", 10)
+ITERATIONS = int(os.environ.get("ITERATIONS", 20))
+
+with open(os.path.join(script_dir, "../resources/rekognition_response.json")) as ff:
+    REKOGNITION_RESPONSE = json.load(ff)
+IMAGE_BUFFER = io.BytesIO()
+Image.new("RGB", (320, 240), (200, 120, 40)).save(IMAGE_BUFFER, format="JPEG")
+IMAGE = IMAGE_BUFFER.getvalue()
+BREEDS = [
+    {"uuid": label["Name"][6:], "attribute_1": "1", "attribute_2": "2"}
+    for label in REKOGNITION_RESPONSE["CustomLabels"]
+    if label["Name"].startswith("breed-")
+]
+
+
+class FakeSSM:
+    def get_parameter(self, Name):
+        time.sleep(SSM_LATENCY)
+        return {"Parameter": {"Value": "arn:aws:rekognition:model/cat"}}
+
+
+class FakeS3:
+    def head_object(self, Bucket, Key):
+        time.sleep(S3_LATENCY)
+        # a new version every call, so the prediction cache always misses
+        return {"ETag": uuid.uuid4().hex, "VersionId": "1"}
+
+    def get_object(self, Bucket, Key, Range=None, IfNoneMatch=None):
+        time.sleep(S3_LATENCY)
+        start, end = 0, len(IMAGE) - 1
+        if Range is not None:
+            first, last = Range[len("bytes=") :].split("-")
+            if first:
+                end = min(int(last), end)
+                start = int(first)
+            else:
+                start = max(0, len(IMAGE) - int(last))
+        return {
+            "Body": io.BytesIO(IMAGE[start : end + 1]),
+            "ContentRange": f"bytes {start}-{end}/{len(IMAGE)}",
+            "ETag": uuid.uuid4().hex,
+        }
+
+
+class FakeRekognition:
+    def detect_custom_labels(self, **kwargs):
+        time.sleep(REKOGNITION_LATENCY)
+        return json.loads(json.dumps(REKOGNITION_RESPONSE))
+
+
+class FakeTable:
+    def scan(self, **kwargs):
+        time.sleep(DYNAMODB_LATENCY)
+        return {"Items": BREEDS}
+
+    def get_item(self, Key):
+        time.sleep(DYNAMODB_LATENCY)
+        return {}
+
+    def put_item(self, Item):
+        time.sleep(DYNAMODB_LATENCY)
+
+
+class FakeDynamoResource:
+    def Table(self, name):
+        return FakeTable()
+
+    def batch_get_item(self, RequestItems):
+        time.sleep(DYNAMODB_LATENCY)
+        ((table_name, request),) = RequestItems.items()
+        names = {key["uuid"] for key in request["Keys"]}
+        return {
+            "Responses": {
+                table_name: [breed for breed in BREEDS if breed["uuid"] in names]
+            }
+        }
+
+
+def reset_container_state():
+    predict.model_arn_cache.clear()
+    predict.breed_data_cache.clear()
+    predict.missing_breed_cache.clear()
+    predict.prediction_cache.memory_cache.clear()
+    predict.breed_cache_warm_until = 0.0
+
+
+def run(overlap_io, cold):
+    predict.overlap_io = overlap_io
+    predict.prediction_cache.executor = predict.pipeline_pool if overlap_io else None
+    timings = []
+    for _ in range(ITERATIONS):
+        if cold:
+            reset_container_state()
+        start = time.perf_counter()
+        predict.get_inferred_attributes("bucket", "cat.jpg", "cat")
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.mean(timings), statistics.median(timings)
+
+
+if __name__ == "__main__":
+    predict.ssm = FakeSSM()
+    predict.s3 = FakeS3()
+    predict.rekognition_client = FakeRekognition()
+    predict.get_dynamo_resource = lambda: FakeDynamoResource()
+    predict.prediction_cache.get_dynamo_resource = predict.get_dynamo_resource
+    predict.metrics.write = lambda line: None
+    # measure the pipeline, not the client side rate limit
+    predict.rekognition_guard.rate = 0
+
+    print(
+        f"latencies (ms): ssm={SSM_LATENCY * 1000:.0f} s3={S3_LATENCY * 1000:.0f} "
+        f"rekognition={REKOGNITION_LATENCY * 1000:.0f} "
+        f"dynamodb={DYNAMODB_LATENCY * 1000:.0f}, {ITERATIONS} requests each"
+    )
+    for cold in (True, False):
+        sequential = run(overlap_io=False, cold=cold)
+        overlapped = run(overlap_io=True, cold=cold)
+        reduction = 100 * (1 - overlapped[0] / sequential[0])
+        print(
+            f"{'cold caches' if cold else 'warm caches'}: "
+            f"sequential mean={sequential[0]:.1f}ms p50={sequential[1]:.1f}ms, "
+            f"overlapped mean={overlapped[0]:.1f}ms p50={overlapped[1]:.1f}ms, "
+            f"reduction={reduction:.1f}%"
+        )
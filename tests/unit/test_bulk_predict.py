@@ -0,0 +1,187 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import os
+import sys
+import gzip
+import json
+import unittest
+
+import boto3
+import mock
+from botocore.config import Config
+from moto import mock_s3
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.append(os.path.join(script_dir, "../../rekognition/scripts"))
+import bulk_predict
+from resilience import PredictionError
+
+S3_BUCKET_NAME = "s3-bucket"
+IMAGE_KEYS = [f"listings/{i:03}.jpg" for i in range(30)]
+try:
+    # moto stores upload_part bodies sent with checksum trailers as is
+    S3_CONFIG = Config(request_checksum_calculation="when_required")
+except TypeError:
+    # botocore before 1.36 does not send them
+    S3_CONFIG = None
+
+
+@mock_s3
+@mock.patch("moto.s3.models.S3_UPLOAD_PART_MIN_SIZE", 64)
+@mock.patch("bulk_predict.MIN_PART_SIZE", 64)
+@mock.patch("bulk_predict.RETRY_DELAY", 0)
+# main replaces the lambda's guard, restored after each test
+@mock.patch(
+    "bulk_predict.predict.rekognition_guard", bulk_predict.predict.rekognition_guard
+)
+@mock.patch("bulk_predict.predict.get_inferred_attributes")
+class TestBulkPredict(unittest.TestCase):
+    def setUp(self):
+        bulk_predict.s3 = boto3.client("s3", config=S3_CONFIG)
+        bulk_predict.cloudwatch = mock.Mock()
+        s3_bucket = boto3.resource("s3").create_bucket(Bucket=S3_BUCKET_NAME)
+        for key in IMAGE_KEYS + ["listings/readme.txt"]:
+            s3_bucket.put_object(Key=key, Body=b"image")
+
+    def run_job(self, output_key):
+        return bulk_predict.main(
+            bucket=S3_BUCKET_NAME,
+            prefix="listings/",
+            output_path=f"s3://{S3_BUCKET_NAME}/{output_key}",
+            animal_type="auto",
+            max_workers=4,
+            part_size=64,
+            min_confidence=5,
+            top_n=3,
+        )
+
+    def read_output(self, output_key):
+        body = bulk_predict.s3.get_object(Bucket=S3_BUCKET_NAME, Key=output_key)[
+            "Body"
+        ].read()
+        if output_key.endswith(".gz"):
+            body = gzip.decompress(body)
+        return [json.loads(line) for line in body.splitlines()]
+
+    def assert_all_images(self, records):
+        self.assertEqual(
+            [f"s3://{S3_BUCKET_NAME}/{key}" for key in IMAGE_KEYS],
+            [record["image_path"] for record in records],
+        )
+
+    def test_resume_after_interruption(self, gia_patch):
+        interrupt = [True]
+
+        def get_inferred_attributes(bucket, key, animal_type, **kwargs):
+            if key == "listings/020.jpg" and interrupt[0]:
+                raise KeyboardInterrupt()
+            return {"breed": [{"Name": "Beagle"}], "animal_type": "dog"}
+
+        gia_patch.side_effect = get_inferred_attributes
+        output_key = "predictions/listings.jsonl"
+        with self.assertRaises(KeyboardInterrupt):
+            self.run_job(output_key)
+        checkpoint = bulk_predict.load_checkpoint(S3_BUCKET_NAME, output_key)
+        self.assertLess(checkpoint["last_key"], "listings/020.jpg")
+
+        interrupt[0] = False
+        self.assertEqual(30, self.run_job(output_key))
+        self.assert_all_images(self.read_output(output_key))
+        self.assertIsNone(bulk_predict.load_checkpoint(S3_BUCKET_NAME, output_key))
+
+    def test_gzip_output(self, gia_patch):
+        gia_patch.return_value = {"breed": [], "error_code": "MODEL_NOT_RUNNING"}
+        output_key = "predictions/listings.jsonl.gz"
+        self.assertEqual(30, self.run_job(output_key))
+        records = self.read_output(output_key)
+        self.assert_all_images(records)
+        self.assertEqual("MODEL_NOT_RUNNING", records[0]["error_code"])
+
+    def test_rate_limited_images_retried(self, gia_patch):
+        gia_patch.side_effect = [
+            {"breed": [], "error_code": "RATE_LIMITED"},
+            PredictionError("THROTTLED", "throttled"),
+        ] + [{"breed": [{"Name": "Beagle"}], "animal_type": "dog"}] * 30
+        output_key = "predictions/listings.jsonl"
+        with mock.patch("bulk_predict.predict.detect_rate", 2.0):
+            self.assertEqual(30, self.run_job(output_key))
+        records = self.read_output(output_key)
+        self.assert_all_images(records)
+        self.assertFalse([record for record in records if "error_code" in record])
+        self.assertEqual(32, gia_patch.call_count)
+        self.assertEqual(600, bulk_predict.predict.rekognition_guard.acquire_timeout)
+        self.assertEqual(2.0, bulk_predict.predict.rekognition_guard.rate)
+
+    def test_detect_calls_published(self, gia_patch):
+        model_arn = "arn:aws:rekognition:us-east-1:123456789012:project/dogs"
+
+        def detect(*args, **kwargs):
+            bulk_predict.predict.metrics.increment(
+                "RekognitionDetectCustomLabelsCalls", {"ModelArn": model_arn}
+            )
+            return {"breed": [{"Name": "Beagle"}], "animal_type": "dog"}
+
+        gia_patch.side_effect = detect
+        recorder = bulk_predict.predict.MetricsRecorder()
+        with mock.patch("bulk_predict.predict.metrics", recorder):
+            self.run_job("predictions/listings.jsonl")
+        calls = sum(
+            [
+                call.kwargs["MetricData"]
+                for call in bulk_predict.cloudwatch.put_metric_data.call_args_list
+            ],
+            [],
+        )
+        for data in calls:
+            self.assertEqual("RekognitionDetectCustomLabelsCalls", data["MetricName"])
+            self.assertEqual(
+                [{"Name": "ModelArn", "Value": model_arn}], data["Dimensions"]
+            )
+        self.assertEqual(30, sum(data["Value"] for data in calls))
+        bulk_predict.cloudwatch.put_metric_data.assert_called_with(
+            Namespace=recorder.namespace, MetricData=mock.ANY
+        )
+
+    def test_give_up_after_attempts(self, gia_patch):
+        gia_patch.return_value = {"breed": [], "error_code": "CIRCUIT_OPEN"}
+        record = bulk_predict.predict_image(
+            S3_BUCKET_NAME, IMAGE_KEYS[0], "dog", 5, 3, max_attempts=2
+        )
+        self.assertEqual("CIRCUIT_OPEN", record["error_code"])
+        self.assertEqual(2, gia_patch.call_count)
+
+    def test_tail_checkpoint_between_parts(self, gia_patch):
+        for output_key in ["predictions/tail.jsonl", "predictions/tail.jsonl.gz"]:
+            job = {"bucket": S3_BUCKET_NAME}
+
+            def writer():
+                return bulk_predict.MultipartJsonlWriter(
+                    S3_BUCKET_NAME,
+                    output_key,
+                    part_size=1024 * 1024,
+                    compress=output_key.endswith(".gz"),
+                    job=job,
+                    checkpoint=bulk_predict.load_checkpoint(S3_BUCKET_NAME, output_key),
+                    max_records=5,
+                )
+
+            interrupted = writer()
+            for key in IMAGE_KEYS[:12]:
+                interrupted.write(key, {"image_path": key})
+            # no part was uploaded, the first 10 records are in the tail
+            resumed = writer()
+            self.assertEqual([], resumed.parts)
+            self.assertEqual(IMAGE_KEYS[9], resumed.resume_after)
+            self.assertEqual(10, resumed.total_count)
+            for key in IMAGE_KEYS[10:]:
+                resumed.write(key, {"image_path": key})
+            resumed.close()
+            self.assertEqual(
+                IMAGE_KEYS,
+                [record["image_path"] for record in self.read_output(output_key)],
+            )
+            with self.assertRaises(bulk_predict.ClientError):
+                bulk_predict.s3.head_object(
+                    Bucket=S3_BUCKET_NAME, Key=bulk_predict.tail_key(output_key)
+                )
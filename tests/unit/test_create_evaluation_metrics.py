@@ -0,0 +1,321 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import os
+import sys
+import tempfile
+import unittest
+
+import boto3
+import mock
+from botocore.exceptions import ClientError
+from moto import mock_s3
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.append(os.path.join(script_dir, "../../rekognition/scripts"))
+import create_evaluation_metrics
+from resilience import RekognitionGuard
+from sequential_test import PROMOTE, REJECT, SequentialAccuracyTest, stratified_order
+
+BREEDS = ["Bengal", "Bombay", "Persian"]
+MANIFEST_LINES = [
+    {
+        "source-ref": f"s3://bucket/images/{breed}_{i}.jpg",
+        "classification_breed-metadata": {"class-name": f"breed-{breed}||{j}"},
+    }
+    for j, breed in enumerate(BREEDS)
+    for i in range(4)
+]
+
+
+def detect_response(Image, **kwargs):
+    breed = Image["S3Object"]["Name"].split("/")[-1].split("_")[0]
+    return {"CustomLabels": [{"Name": f"breed-{breed}||0", "Confidence": 90.0}]}
+
+
+def throttle():
+    return ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "slow down"}},
+        "DetectCustomLabels",
+    )
+
+
+@mock.patch("create_evaluation_metrics.rekognition_client")
+class TestCreateEvaluationMetrics(unittest.TestCase):
+    def setUp(self):
+        self.guard = create_evaluation_metrics.guard
+        create_evaluation_metrics.guard = RekognitionGuard(
+            rate=0, capacity=1, max_attempts=3, sleep=lambda seconds: None
+        )
+
+    def tearDown(self):
+        create_evaluation_metrics.guard = self.guard
+
+    def evaluate(self, manifest_lines=MANIFEST_LINES, max_failed_fraction=0.0):
+        return create_evaluation_metrics.evaluate(
+            manifest_lines,
+            "model-arn",
+            min_confidence=1,
+            max_workers=4,
+            max_failed_fraction=max_failed_fraction,
+        )
+
+    def test_throttles_are_retried(self, rekognition_patch):
+        throttled = set()
+
+        def detect_custom_labels(Image, **kwargs):
+            # every image is throttled once
+            if Image["S3Object"]["Name"] not in throttled:
+                throttled.add(Image["S3Object"]["Name"])
+                raise throttle()
+            return detect_response(Image)
+
+        rekognition_patch.detect_custom_labels.side_effect = detect_custom_labels
+        preds_df, metrics = self.evaluate()
+        self.assertEqual(1.0, metrics["accuracy"])
+        self.assertEqual(0, metrics["evaluation"]["failed"])
+        self.assertEqual(12, metrics["evaluation"]["images"])
+        self.assertEqual(24, rekognition_patch.detect_custom_labels.call_count)
+        # predictions stay in manifest order
+        self.assertEqual(
+            [breed for breed in BREEDS for i in range(4)], list(preds_df["y_true"])
+        )
+        self.assertEqual(
+            [line["source-ref"] for line in MANIFEST_LINES], list(preds_df.index)
+        )
+
+    def test_failed_images_left_out(self, rekognition_patch):
+        def detect_custom_labels(Image, **kwargs):
+            if Image["S3Object"]["Name"] == "images/Bombay_0.jpg":
+                raise throttle()
+            return detect_response(Image)
+
+        rekognition_patch.detect_custom_labels.side_effect = detect_custom_labels
+        with self.assertRaises(Exception):
+            self.evaluate()
+
+        preds_df, metrics = self.evaluate(max_failed_fraction=0.1)
+        self.assertEqual(1.0, metrics["accuracy"])
+        self.assertEqual(1, metrics["evaluation"]["failed"])
+        self.assertEqual(11, len(preds_df))
+
+    def test_no_label_is_a_wrong_prediction(self, rekognition_patch):
+        rekognition_patch.detect_custom_labels.return_value = {"CustomLabels": []}
+        manifest_lines = [
+            {"source-ref": "s3://bucket/images/1.jpg", "label-name": "Bengal"}
+        ]
+        preds_df, metrics = self.evaluate(manifest_lines)
+        self.assertEqual(0.0, metrics["accuracy"])
+        self.assertIn("NAN", metrics)
+
+    def test_models_compared_in_one_pass(self, rekognition_patch):
+        def detect_custom_labels(Image, ProjectVersionArn, **kwargs):
+            response = detect_response(Image)
+            if (
+                ProjectVersionArn == "candidate-arn"
+                and "Bombay" in Image["S3Object"]["Name"]
+            ):
+                response["CustomLabels"][0]["Name"] = "breed-Bengal||0"
+            return response
+
+        rekognition_patch.detect_custom_labels.side_effect = detect_custom_labels
+        results, comparisons = create_evaluation_metrics.evaluate_models(
+            MANIFEST_LINES,
+            ["promoted-arn", "candidate-arn"],
+            min_confidence=1,
+            max_workers=2,
+            max_failed_fraction=0.0,
+        )
+        self.assertEqual(24, rekognition_patch.detect_custom_labels.call_count)
+        self.assertEqual(1.0, results["promoted-arn"][1]["accuracy"])
+        self.assertAlmostEqual(8 / 12, results["candidate-arn"][1]["accuracy"])
+        self.assertEqual(
+            {
+                "model_a": "promoted-arn",
+                "model_b": "candidate-arn",
+                "images": 12,
+                "same_prediction": 8,
+                "both_correct": 8,
+                "only_a_correct": 4,
+                "only_b_correct": 0,
+                "both_wrong": 0,
+                "mcnemar_statistic": 2.25,
+                "mcnemar_p_value": 0.125,
+            },
+            comparisons[0],
+        )
+
+    def test_mcnemar(self, rekognition_patch):
+        self.assertEqual((0.0, 1.0), create_evaluation_metrics.mcnemar(0, 0))
+        statistic, p_value = create_evaluation_metrics.mcnemar(10, 2)
+        self.assertAlmostEqual(49 / 12, statistic)
+        self.assertAlmostEqual(0.0386, p_value, places=4)
+
+
+def manifest_lines(images_per_breed):
+    return [
+        {
+            "source-ref": f"s3://bucket/images/{breed}_{i}.jpg",
+            "classification_breed-metadata": {"class-name": f"breed-{breed}||{j}"},
+        }
+        for j, breed in enumerate(BREEDS)
+        for i in range(images_per_breed)
+    ]
+
+
+@mock.patch("create_evaluation_metrics.rekognition_client")
+class TestSequentialEvaluation(unittest.TestCase):
+    def setUp(self):
+        self.guard = create_evaluation_metrics.guard
+        create_evaluation_metrics.guard = RekognitionGuard(
+            rate=0, capacity=1, max_attempts=1, sleep=lambda seconds: None
+        )
+        lines = manifest_lines(100)
+        self.manifest_lines = stratified_order(
+            lines,
+            [create_evaluation_metrics.get_true_breed(line) for line in lines],
+            seed="9dfb55a8",
+        )
+
+    def tearDown(self):
+        create_evaluation_metrics.guard = self.guard
+
+    def evaluate(self, threshold):
+        sequential_test = SequentialAccuracyTest(
+            threshold, alpha=0.05, check_every=10, min_images=20
+        )
+        results, comparisons = create_evaluation_metrics.evaluate_models(
+            self.manifest_lines,
+            ["model-arn"],
+            min_confidence=1,
+            max_workers=1,
+            max_failed_fraction=0.0,
+            sequential_test=sequential_test,
+        )
+        return results["model-arn"][1]
+
+    def test_stratified_order(self, rekognition_patch):
+        breeds = [
+            create_evaluation_metrics.get_true_breed(line)
+            for line in self.manifest_lines
+        ]
+        self.assertEqual(
+            300, len(set(line["source-ref"] for line in self.manifest_lines))
+        )
+        for prefix in (30, 60, 150):
+            for breed in BREEDS:
+                self.assertAlmostEqual(
+                    prefix / 3, breeds[:prefix].count(breed), delta=1
+                )
+        # the same seed gives the same order, so a resumed run carries on
+        self.assertEqual(
+            self.manifest_lines,
+            stratified_order(manifest_lines(100), breeds_of(100), seed="9dfb55a8"),
+        )
+
+    def test_good_model_promoted_early(self, rekognition_patch):
+        rekognition_patch.detect_custom_labels.side_effect = detect_response
+        metrics = self.evaluate(threshold=0.5)
+        self.assertEqual(PROMOTE, metrics["promotion"]["decision"])
+        self.assertTrue(metrics["promotion"]["stopped_early"])
+        self.assertEqual(20, metrics["promotion"]["images"])
+        self.assertLess(rekognition_patch.detect_custom_labels.call_count, 30)
+        self.assertLess(metrics["evaluation"]["predicted"], 30)
+
+    def test_bad_model_rejected_early(self, rekognition_patch):
+        def detect_custom_labels(Image, **kwargs):
+            # only the Bengal images are right
+            response = detect_response(Image)
+            response["CustomLabels"][0]["Name"] = "breed-Bengal||0"
+            return response
+
+        rekognition_patch.detect_custom_labels.side_effect = detect_custom_labels
+        metrics = self.evaluate(threshold=0.9)
+        self.assertEqual(REJECT, metrics["promotion"]["decision"])
+        self.assertTrue(metrics["promotion"]["stopped_early"])
+        self.assertLess(rekognition_patch.detect_custom_labels.call_count, 300)
+
+    def test_undecided_falls_back_to_accuracy(self, rekognition_patch):
+        sequential_test = SequentialAccuracyTest(0.5, check_every=10, min_images=20)
+        for i in range(100):
+            self.assertIsNone(sequential_test.record(i % 2 == 0))
+        self.assertEqual(PROMOTE, sequential_test.finish())
+        self.assertFalse(sequential_test.to_dict()["stopped_early"])
+        self.assertEqual(9, sequential_test.to_dict()["looks"])
+
+
+def breeds_of(images_per_breed):
+    return [breed for breed in BREEDS for i in range(images_per_breed)]
+
+
+@mock_s3
+@mock.patch("create_evaluation_metrics.rekognition_client")
+class TestEvaluationCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.guard = create_evaluation_metrics.guard
+        create_evaluation_metrics.guard = RekognitionGuard(
+            rate=0, capacity=1, max_attempts=1, sleep=lambda seconds: None
+        )
+        self.s3_client = create_evaluation_metrics.s3
+        create_evaluation_metrics.s3 = boto3.client("s3")
+        boto3.resource("s3").create_bucket(Bucket="bucket")
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        create_evaluation_metrics.guard = self.guard
+        create_evaluation_metrics.s3 = self.s3_client
+        self.tmp_dir.cleanup()
+
+    def checkpoint(self, local_name, model_arn="model-arn"):
+        return create_evaluation_metrics.PredictionCheckpoint(
+            os.path.join(self.tmp_dir.name, local_name),
+            model_arn,
+            1,
+            s3_prefix="s3://bucket/evaluation/checkpoint/",
+            max_records=5,
+        )
+
+    def evaluate(self, checkpoint):
+        return create_evaluation_metrics.evaluate(
+            MANIFEST_LINES,
+            "model-arn",
+            min_confidence=1,
+            max_workers=1,
+            max_failed_fraction=1.0,
+            checkpoint=checkpoint,
+        )
+
+    def test_resume_from_s3(self, rekognition_patch):
+        def detect_custom_labels(Image, **kwargs):
+            if Image["S3Object"]["Name"].startswith("images/Persian"):
+                raise throttle()
+            return detect_response(Image)
+
+        rekognition_patch.detect_custom_labels.side_effect = detect_custom_labels
+        preds_df, metrics = self.evaluate(self.checkpoint("first.jsonl"))
+        self.assertEqual(4, metrics["evaluation"]["failed"])
+
+        # a new container, only the s3 parts are left
+        rekognition_patch.detect_custom_labels.reset_mock()
+        rekognition_patch.detect_custom_labels.side_effect = detect_response
+        preds_df, metrics = self.evaluate(self.checkpoint("second.jsonl"))
+        self.assertEqual(1.0, metrics["accuracy"])
+        self.assertEqual(4, metrics["evaluation"]["predicted"])
+        self.assertEqual(4, rekognition_patch.detect_custom_labels.call_count)
+
+        # responses of another model are not reused
+        self.assertEqual({}, self.checkpoint("third.jsonl", "other-arn").load())
+
+    def test_partial_local_line_skipped(self, rekognition_patch):
+        checkpoint = self.checkpoint("local.jsonl")
+        checkpoint.s3_prefix = None
+        checkpoint.append("s3://bucket/images/Bengal_0.jpg", {"CustomLabels": []})
+        checkpoint.close()
+        with open(checkpoint.local_path, "a") as ff:
+            ff.write('{"source-ref": "s3://bucket/im')
+        checkpoint.append("s3://bucket/images/Bengal_1.jpg", {"CustomLabels": []})
+        checkpoint.close()
+        self.assertEqual(
+            ["s3://bucket/images/Bengal_0.jpg", "s3://bucket/images/Bengal_1.jpg"],
+            sorted(checkpoint.load()),
+        )
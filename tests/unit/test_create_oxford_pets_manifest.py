@@ -0,0 +1,84 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import boto3
+from moto import mock_s3
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.append(os.path.join(script_dir, "../../rekognition/scripts"))
+import create_oxford_pets_manifest
+
+PREFIX = "OxfordPets/images"
+NAMES = ["Abyssinian", "Bengal", "Siamese", "beagle", "great_pyrenees", "pug"]
+
+
+@mock_s3
+class TestCreateOxfordPetsManifest(unittest.TestCase):
+    def setUp(self):
+        self.s3 = boto3.client("s3")
+        self.s3.create_bucket(Bucket="bucket")
+        self.keys = sorted(
+            f"{PREFIX}/{name}_{i}.jpg" for name in NAMES for i in range(1, 6)
+        )
+        for key in self.keys + [f"{PREFIX}/Bengal_1.mat", "other/pug_1.jpg"]:
+            self.s3.put_object(Bucket="bucket", Key=key, Body=b"")
+
+    def list_keys(self, shards, max_pages=2):
+        return list(
+            create_oxford_pets_manifest.iter_keys(
+                self.s3, "bucket", PREFIX, shards, max_pages
+            )
+        )
+
+    def test_sharded_listing_in_key_order(self):
+        with_mat = sorted(self.keys + [f"{PREFIX}/Bengal_1.mat"])
+        # most of the 16 ranges are empty
+        for shards in (1, 3, 16):
+            self.assertEqual(with_mat, self.list_keys(shards))
+
+    def test_pages_split_at_range_end(self):
+        pages = list(
+            create_oxford_pets_manifest.list_key_range(
+                self.s3, "bucket", PREFIX, f"{PREFIX}/B", f"{PREFIX}/S"
+            )
+        )
+        self.assertEqual(
+            sorted(
+                [key for key in self.keys if "/Bengal" in key]
+                + [f"{PREFIX}/Bengal_1.mat"]
+            ),
+            [key for keys in pages for key in keys],
+        )
+
+    def test_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, "oxford-pets.manifest")
+            count = create_oxford_pets_manifest.main(
+                "bucket", PREFIX, output_path, shards=4
+            )
+            with open(output_path) as ff:
+                lines = [json.loads(line) for line in ff]
+        self.assertEqual(len(self.keys), count)
+        self.assertEqual(
+            [f"s3://bucket/{key}" for key in self.keys],
+            [line["source-ref"] for line in lines],
+        )
+        line = lines[self.keys.index(f"{PREFIX}/great_pyrenees_3.jpg")]
+        self.assertEqual(["breed-Great Pyrenees", "species-dog"], line["label-names"])
+        self.assertEqual(
+            "breed-Great Pyrenees", line["classification_breed-metadata"]["class-name"]
+        )
+
+    def test_listing_error_raised(self):
+        with self.assertRaises(Exception):
+            list(
+                create_oxford_pets_manifest.iter_keys(
+                    self.s3, "missing-bucket", PREFIX, shards=2
+                )
+            )
@@ -0,0 +1,107 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import os
+import sys
+import unittest
+
+import numpy as np
+from sklearn import metrics as sklearn_metrics
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir, "../../rekognition/scripts"))
+from evaluation_metrics import NO_PREDICTION, Evaluation
+
+BREEDS = ["Bengal", "Bombay", "Persian", "Ragdoll", "Siamese"]
+
+
+def random_rows(rng, y_true, skill=0.6):
+    """
+    up to 3 labels per image, the true breed most confident with probability
+    skill and some images without any label
+    """
+    rows = []
+    for true_breed in y_true:
+        if rng.random() < 0.05:
+            rows.append([])
+            continue
+        breeds = list(rng.permutation(BREEDS)[:3])
+        if rng.random() < skill:
+            breeds = [true_breed] + [b for b in breeds if b != true_breed][:2]
+        confidences = sorted(rng.uniform(1, 100, len(breeds)), reverse=True)
+        rows.append(list(zip(breeds, confidences)))
+    return rows
+
+
+class TestEvaluationMetrics(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.y_true = list(rng.choice(BREEDS, 500))
+        self.rows = random_rows(rng, self.y_true)
+        self.evaluation = Evaluation(self.y_true, self.rows)
+        self.y_pred = [row[0][0] if row else NO_PREDICTION for row in self.rows]
+
+    def assert_report_equal(self, expected, actual):
+        self.assertEqual(set(expected), set(actual))
+        for key, value in expected.items():
+            if isinstance(value, dict):
+                for name, number in value.items():
+                    self.assertAlmostEqual(number, actual[key][name], msg=key)
+            else:
+                self.assertAlmostEqual(value, actual[key], msg=key)
+
+    def test_matches_sklearn(self):
+        report = self.evaluation.metrics()
+        self.assertEqual(self.y_pred, self.evaluation.predicted_names())
+        expected = sklearn_metrics.classification_report(
+            self.y_true, self.y_pred, output_dict=True, zero_division=0
+        )
+        self.assert_report_equal(
+            expected,
+            {
+                key: value
+                for key, value in report.items()
+                if key not in ("top_k_accuracy", "calibration", "confusion_matrix")
+            },
+        )
+        labels = report["confusion_matrix"]["labels"]
+        np.testing.assert_array_equal(
+            sklearn_metrics.confusion_matrix(self.y_true, self.y_pred, labels=labels),
+            report["confusion_matrix"]["matrix"],
+        )
+
+    def test_top_k_accuracy(self):
+        top_k = self.evaluation.metrics()["top_k_accuracy"]
+        for k in (1, 3, 5):
+            expected = np.mean(
+                [
+                    true_breed in [name for name, confidence in row[:k]]
+                    for true_breed, row in zip(self.y_true, self.rows)
+                ]
+            )
+            self.assertAlmostEqual(expected, top_k[str(k)])
+        self.assertAlmostEqual(
+            self.evaluation.metrics()["accuracy"], top_k["1"], places=6
+        )
+
+    def test_calibration(self):
+        calibration = self.evaluation.metrics(bins=4)["calibration"]
+        self.assertEqual(500, sum(b["count"] for b in calibration["bins"]))
+        evaluation = Evaluation(
+            ["Bengal", "Bengal", "Bombay", "Bombay"],
+            [[("Bengal", 90.0)], [("Bombay", 90.0)], [("Bombay", 30.0)], []],
+        )
+        calibration = evaluation.metrics(bins=2)["calibration"]
+        self.assertEqual(
+            [(0.0, 0.5, 2, 0.5, 0.15), (0.5, 1.0, 2, 0.5, 0.9)],
+            [
+                (
+                    b["lower"],
+                    b["upper"],
+                    b["count"],
+                    b["accuracy"],
+                    b["mean_confidence"],
+                )
+                for b in calibration["bins"]
+            ],
+        )
+        self.assertAlmostEqual(0.375, calibration["expected_calibration_error"])
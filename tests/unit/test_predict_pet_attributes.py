@@ -5,12 +5,19 @@ import sys
 import json
 import os
 import unittest
+import io
+import base64
+import time
+import random
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 import mock
+from PIL import Image, ImageDraw, ImageFilter
 from mock import patch
 from moto import mock_s3, mock_dynamodb, mock_rekognition
 
-
 script_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(script_dir, "../../rekognition/utils/"))
 from constants import *
@@ -26,7 +33,19 @@ os.environ["MINIMUM_CONFIDENCE"] = f"{config['minConfidence']}"
 # necessary because the lambda function resources are not a python module and lambda is a keyword
 script_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(script_dir, "../../rekognition/lambda/api"))
+from botocore.exceptions import ClientError, EndpointConnectionError
+import predict_pet_image_attributes
 from predict_pet_image_attributes import lambda_handler, partition_labels
+from latency import LatencyHistogram, LatencyRecorder
+from resilience import PredictionError, RekognitionGuard, TokenBucket
+from single_flight import SingleFlight
+from label_codec import LabelCodec
+import image_validation
+from image_validation import check_image, missing_end_marker
+from near_duplicates import BKTree, NearDuplicateCache, dhash, hamming
+
+# the tests below send placeholder bytes as images, TestImageValidation checks them
+predict_pet_image_attributes.validate_images = False
 
 
 S3_BUCKET_NAME = "s3-bucket"
@@ -61,6 +80,13 @@ class TestLambdaFunction(unittest.TestCase):
         labels = partition_labels(rekognition_response()["CustomLabels"])
         self.assertEqual("British Shorthair", labels["breed"][0]["Name"])
 
+    def test_partition_labels_leaves_response_unchanged(self, gbp_patch, bd_patch):
+        response = rekognition_response()
+        first = predict_pet_image_attributes.get_labels(response)
+        second = predict_pet_image_attributes.get_labels(response)
+        self.assertEqual(first, second)
+        self.assertEqual("breed-British Shorthair", response["CustomLabels"][0]["Name"])
+
     def test_handler(self, gbp_patch, bd_patch):
         gbp_patch.return_value = rekognition_response()
         event = {
@@ -69,3 +95,816 @@ class TestLambdaFunction(unittest.TestCase):
         }
         output = lambda_handler(event, {})
         self.assertEqual("British Shorthair", output["breed"][0]["Name"])
+
+    def test_handler_image_bytes(self, gbp_patch, bd_patch):
+        gbp_patch.return_value = rekognition_response()
+        large_image = io.BytesIO()
+        Image.new("RGB", (3000, 2000)).save(large_image, format="PNG")
+        event = {
+            "animal_type": "cat",
+            "image_bytes": base64.b64encode(large_image.getvalue()).decode(),
+        }
+        output = lambda_handler(event, {})
+        self.assertEqual("British Shorthair", output["breed"][0]["Name"])
+
+        image = gbp_patch.call_args[1]["image"]
+        downscaled = Image.open(io.BytesIO(image["Bytes"]))
+        self.assertEqual("JPEG", downscaled.format)
+        self.assertEqual(1280, max(downscaled.size))
+
+    @mock.patch("predict_pet_image_attributes.debug_timings", True)
+    def test_handler_debug_timings(self, gbp_patch, bd_patch):
+        gbp_patch.return_value = rekognition_response()
+        small_image = io.BytesIO()
+        Image.new("RGB", (64, 64)).save(small_image, format="JPEG")
+        event = {
+            "animal_type": "cat",
+            "image_bytes": base64.b64encode(small_image.getvalue()).decode(),
+        }
+        output = lambda_handler(event, {})
+        self.assertEqual({"image_prepare", "request"}, set(output["timings_ms"]))
+        self.assertGreaterEqual(
+            output["timings_ms"]["request"], output["timings_ms"]["image_prepare"]
+        )
+
+    def test_handler_invalid_image_bytes(self, gbp_patch, bd_patch):
+        event = {"animal_type": "cat", "image_bytes": "not an image"}
+        output = lambda_handler(event, {})
+        self.assertEqual("INVALID_IMAGE", output["error_code"])
+        self.assertIn("base64", output["error"])
+        self.assertEqual([], output["breed"])
+        gbp_patch.assert_not_called()
+
+    @mock.patch("predict_pet_image_attributes.get_breeds_data")
+    @mock.patch("predict_pet_image_attributes.detect_breed_labels")
+    @mock.patch("predict_pet_image_attributes.get_model_arn")
+    def test_batch_handler(self, arn_patch, dbl_patch, bsd_patch, gbp_patch, bd_patch):
+        bsd_patch.side_effect = lambda breed_names: {
+            name: {"uuid": name, "attribute_1": "2"} for name in breed_names
+        }
+        arn_patch.side_effect = lambda animal_type: f"{animal_type}-model-arn"
+
+        def detect(model_arn, image, min_confidence):
+            if image["S3Object"]["Name"] == "missing.jpg":
+                raise Exception("InvalidS3ObjectException")
+            return rekognition_response()
+
+        dbl_patch.side_effect = detect
+        event = {
+            "animal_type": "cat",
+            "images": [
+                {"image_path": f"s3://{S3_BUCKET_NAME}/{S3_TEST_FILE_KEY}"},
+                {"image_path": f"s3://{S3_BUCKET_NAME}/missing.jpg"},
+                {
+                    "image_path": f"s3://{S3_BUCKET_NAME}/dog.jpg",
+                    "animal_type": "dog",
+                },
+            ],
+        }
+        output = lambda_handler(event, {})["results"]
+        self.assertEqual(3, len(output))
+        self.assertEqual("British Shorthair", output[0]["breed"][0]["Name"])
+        self.assertIn("error", output[1])
+        self.assertEqual(f"s3://{S3_BUCKET_NAME}/dog.jpg", output[2]["image_path"])
+        self.assertEqual(2, output[0]["attribute_1"])
+        # one ssm lookup per animal type and one attribute lookup per batch
+        self.assertEqual(2, arn_patch.call_count)
+        self.assertEqual(1, bsd_patch.call_count)
+        self.assertEqual(["British Shorthair"] * 2, bsd_patch.call_args[0][0])
+
+        for event in [{"images": []}, {"image_paths": [], "animal_type": "cat"}]:
+            self.assertEqual({"results": []}, lambda_handler(event, {}))
+
+
+@mock_dynamodb
+@mock.patch.dict(os.environ, {"ANIMAL_ATTRIBUTES_DDB_TBL": "breed-attributes"})
+class TestBreedDataCache(unittest.TestCase):
+    def setUp(self):
+        predict_pet_image_attributes.breed_data_cache.clear()
+        predict_pet_image_attributes.missing_breed_cache.clear()
+        predict_pet_image_attributes.breed_cache_warm_until = 0.0
+        predict_pet_image_attributes.dynamo_resources = threading.local()
+        dynamodb = boto3.resource("dynamodb", region_name=DEFAULT_REGION)
+        self.table = dynamodb.create_table(
+            TableName="breed-attributes",
+            KeySchema=[{"AttributeName": "uuid", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "uuid", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        self.table.put_item(Item={"uuid": "Bombay", "attribute_1": "1"})
+        self.table.put_item(Item={"uuid": "Siamese", "attribute_1": "3"})
+
+    def tearDown(self):
+        predict_pet_image_attributes.dynamo_resources = threading.local()
+        predict_pet_image_attributes.breed_cache_warm_until = 0.0
+
+    def test_breed_data_cached(self):
+        breeds_data = predict_pet_image_attributes.get_breeds_data(
+            ["Bombay", "Siamese", "Unknown"]
+        )
+        self.assertEqual("3", breeds_data["Siamese"]["attribute_1"])
+        self.assertIsNone(breeds_data["Unknown"])
+
+        self.table.delete_item(Key={"uuid": "Bombay"})
+        with mock.patch(
+            "predict_pet_image_attributes.batch_get_breed_items"
+        ) as batch_get_patch:
+            response = predict_pet_image_attributes.get_breed_data(
+                "Bombay", ["Unknown"]
+            )
+            batch_get_patch.assert_not_called()
+        self.assertEqual("1", response["Items"][0]["attribute_1"])
+
+    def test_warm_breed_cache(self):
+        predict_pet_image_attributes.wait_for_warmup(
+            predict_pet_image_attributes.start_breed_cache_warmup()
+        )
+        self.assertIsNone(predict_pet_image_attributes.start_breed_cache_warmup())
+        with mock.patch(
+            "predict_pet_image_attributes.batch_get_breed_items"
+        ) as batch_get_patch:
+            breeds_data = predict_pet_image_attributes.get_breeds_data(["Siamese"])
+            batch_get_patch.assert_not_called()
+        self.assertEqual("3", breeds_data["Siamese"]["attribute_1"])
+
+
+def ssm_parameter(value):
+    return {"Parameter": {"Value": value}}
+
+
+@mock.patch("predict_pet_image_attributes.get_image_version", return_value=None)
+@mock.patch("predict_pet_image_attributes.detect_breed_labels")
+@mock.patch("predict_pet_image_attributes.ssm")
+class TestModelArnCache(unittest.TestCase):
+    def setUp(self):
+        predict_pet_image_attributes.model_arn_cache.clear()
+
+    def test_model_arn_cached(self, ssm_patch, dbl_patch, giv_patch):
+        ssm_patch.get_parameter.return_value = ssm_parameter("cat-model-arn")
+        dbl_patch.return_value = rekognition_response()
+        predict_pet_image_attributes.get_breed_prediction("cat", "bucket", "cat.jpg")
+        predict_pet_image_attributes.get_breed_prediction("cat", "bucket", "cat.jpg")
+        self.assertEqual(1, ssm_patch.get_parameter.call_count)
+
+    def test_refresh_on_stale_model(self, ssm_patch, dbl_patch, giv_patch):
+        ssm_patch.get_parameter.side_effect = [
+            ssm_parameter("old-model-arn"),
+            ssm_parameter("new-model-arn"),
+        ]
+
+        def detect(model_arn, image, min_confidence):
+            if model_arn == "old-model-arn":
+                raise ClientError(
+                    {"Error": {"Code": "ResourceNotFoundException"}},
+                    "DetectCustomLabels",
+                )
+            return rekognition_response()
+
+        dbl_patch.side_effect = detect
+        result = predict_pet_image_attributes.get_breed_prediction(
+            "dog", "bucket", "dog.jpg"
+        )
+        self.assertIn("CustomLabels", result)
+        self.assertEqual(
+            "new-model-arn", predict_pet_image_attributes.model_arn_cache.get("dog")
+        )
+
+
+@mock_s3
+@mock_dynamodb
+@mock.patch("predict_pet_image_attributes.detect_breed_labels")
+class TestPredictionCache(unittest.TestCase):
+    def setUp(self):
+        predict_pet_image_attributes.dynamo_resources = threading.local()
+        self.s3_client = predict_pet_image_attributes.s3
+        predict_pet_image_attributes.s3 = boto3.client("s3", region_name=DEFAULT_REGION)
+        self.s3 = boto3.resource("s3", region_name=DEFAULT_REGION)
+        self.s3_bucket = self.s3.create_bucket(Bucket=S3_BUCKET_NAME)
+        self.s3_bucket.put_object(Key=S3_TEST_FILE_KEY, Body=b"cat")
+        boto3.resource("dynamodb", region_name=DEFAULT_REGION).create_table(
+            TableName="prediction-cache",
+            KeySchema=[{"AttributeName": "cache_key", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "cache_key", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        self.cache = predict_pet_image_attributes.prediction_cache
+        self.cache.memory_cache.clear()
+        self.table_name = self.cache.table_name
+        self.cache.table_name = "prediction-cache"
+        self.executor = self.cache.executor
+        self.cache.executor = None
+
+    def tearDown(self):
+        self.cache.table_name = self.table_name
+        self.cache.executor = self.executor
+        predict_pet_image_attributes.s3 = self.s3_client
+        predict_pet_image_attributes.dynamo_resources = threading.local()
+
+    def get_breed_labels(self, model_arn):
+        return predict_pet_image_attributes.get_breed_labels(
+            "cat",
+            model_arn,
+            predict_pet_image_attributes.s3_image(S3_BUCKET_NAME, S3_TEST_FILE_KEY),
+            5,
+        )
+
+    def test_repeat_image_served_from_cache(self, dbl_patch):
+        dbl_patch.return_value = rekognition_response()
+        self.get_breed_labels("cat-model-arn")
+        # a new container only has the shared table
+        self.cache.memory_cache.clear()
+        labels = self.get_breed_labels("cat-model-arn")
+        self.assertEqual(1, dbl_patch.call_count)
+        self.assertEqual(rekognition_response()["CustomLabels"], labels["CustomLabels"])
+
+    def test_cache_invalidated_by_new_object_or_model(self, dbl_patch):
+        dbl_patch.return_value = rekognition_response()
+        self.get_breed_labels("cat-model-arn")
+        self.get_breed_labels("promoted-cat-model-arn")
+        self.s3_bucket.put_object(Key=S3_TEST_FILE_KEY, Body=b"another cat")
+        self.get_breed_labels("promoted-cat-model-arn")
+        self.assertEqual(3, dbl_patch.call_count)
+
+    def test_table_writes_awaited(self, dbl_patch):
+        dbl_patch.return_value = rekognition_response()
+        release = threading.Event()
+        put_item = self.cache.put_item
+
+        def slow_put_item(*args):
+            release.wait()
+            put_item(*args)
+
+        self.cache.executor = ThreadPoolExecutor(max_workers=1)
+        with mock.patch.object(self.cache, "put_item", slow_put_item):
+            self.get_breed_labels("cat-model-arn")
+            self.assertEqual(1, len(self.cache._writes))
+            release.set()
+            self.cache.wait_for_writes()
+        self.assertEqual([], self.cache._writes)
+        self.cache.memory_cache.clear()
+        self.get_breed_labels("cat-model-arn")
+        self.assertEqual(1, dbl_patch.call_count)
+
+
+@mock.patch("predict_pet_image_attributes.rekognition_client")
+class TestMetrics(unittest.TestCase):
+    def test_detect_calls_emitted_as_emf(self, rekognition_patch):
+        rekognition_patch.detect_custom_labels.return_value = rekognition_response()
+        lines = []
+        recorder = predict_pet_image_attributes.metrics
+        recorder.flush()
+        with mock.patch.object(recorder, "write", lines.append):
+            for _ in range(2):
+                predict_pet_image_attributes.detect_breed_labels(
+                    "cat-model-arn", {"Bytes": b"cat"}, 5
+                )
+            recorder.flush()
+
+        document = json.loads(lines[0])
+        metric = document["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(
+            "Petfinder/Rekognition/Model/DetectCustomLabels", metric["Namespace"]
+        )
+        self.assertEqual([["ModelArn"]], metric["Dimensions"])
+        self.assertEqual("cat-model-arn", document["ModelArn"])
+        self.assertEqual(2, document["RekognitionDetectCustomLabelsCalls"])
+
+
+class TestColdStart(unittest.TestCase):
+    def test_import_creates_no_clients(self):
+        check = (
+            "import sys, aws_clients, predict_pet_image_attributes; "
+            "assert 'boto3' not in sys.modules, 'boto3 imported'; "
+            "assert not aws_clients._clients, 'clients created'"
+        )
+        subprocess.run(
+            [sys.executable, "-c", check],
+            cwd=os.path.join(script_dir, "../../rekognition/lambda/api"),
+            env=os.environ.copy(),
+            check=True,
+        )
+
+
+class TestLatency(unittest.TestCase):
+    def test_histogram_percentiles(self):
+        histogram = LatencyHistogram()
+        for elapsed_ms in range(1, 101):
+            histogram.record(elapsed_ms, error=elapsed_ms > 98)
+        summary = histogram.summary()
+        self.assertEqual(100, summary["count"])
+        self.assertEqual(2, summary["errors"])
+        # percentiles are bucket bounds, within 10% of the exact value
+        self.assertAlmostEqual(50, summary["p50_ms"], delta=5)
+        self.assertAlmostEqual(90, summary["p90_ms"], delta=9)
+        self.assertAlmostEqual(99, summary["p99_ms"], delta=9.9)
+        self.assertEqual(100, summary["max_ms"])
+
+    def test_export_per_stage_and_model(self):
+        now = [0.0]
+        lines = []
+        recorder = LatencyRecorder(
+            export_interval=60, write=lines.append, clock=lambda: now[0]
+        )
+        with recorder.timer("rekognition_detect_custom_labels", model_arn="cat-arn"):
+            pass
+        with self.assertRaises(ValueError):
+            with recorder.timer("ssm_get_parameter"):
+                raise ValueError("ssm down")
+
+        self.assertEqual(0, recorder.maybe_export())
+        now[0] = 61.0
+        self.assertEqual(3, recorder.maybe_export())
+
+        histograms = json.loads(lines[0])["LatencyHistograms"]
+        keys = {(h["stage"], h["model_arn"]): h for h in histograms}
+        self.assertIn(("rekognition_detect_custom_labels", "cat-arn"), keys)
+        self.assertIn(("rekognition_detect_custom_labels", None), keys)
+        self.assertEqual(1, keys[("ssm_get_parameter", None)]["errors"])
+        self.assertEqual([], recorder.snapshot())
+
+
+def throttle():
+    return ClientError({"Error": {"Code": "ThrottlingException"}}, "DetectCustomLabels")
+
+
+class TestResilience(unittest.TestCase):
+    def setUp(self):
+        self.now = [0.0]
+        self.sleeps = []
+
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now[0] += seconds
+
+        self.sleep = sleep
+        self.clock = lambda: self.now[0]
+
+    def guard(self, **kwargs):
+        return RekognitionGuard(
+            rate=kwargs.pop("rate", 0),
+            capacity=kwargs.pop("capacity", 1),
+            clock=self.clock,
+            sleep=self.sleep,
+            **kwargs,
+        )
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=2, clock=self.clock, sleep=self.sleep)
+        self.assertTrue(bucket.acquire(timeout=0))
+        self.assertTrue(bucket.acquire(timeout=0))
+        self.assertFalse(bucket.acquire(timeout=0.1))
+        self.assertTrue(bucket.acquire(timeout=1))
+        self.assertAlmostEqual(0.5, sum(self.sleeps))
+
+    def test_throttles_retried(self):
+        calls = mock.Mock(side_effect=[throttle(), throttle(), {"CustomLabels": []}])
+        guard = self.guard(max_attempts=3)
+        self.assertEqual({"CustomLabels": []}, guard.call("cat-arn", calls))
+        self.assertEqual(3, calls.call_count)
+        self.assertEqual(2, len(self.sleeps))
+
+    def test_transient_errors_retried(self):
+        server_error = ClientError(
+            {"Error": {"Code": "InternalServerError"}}, "DetectCustomLabels"
+        )
+        connection_error = EndpointConnectionError(endpoint_url="https://rekognition")
+        calls = mock.Mock(side_effect=[server_error, connection_error, "ok"])
+        guard = self.guard(max_attempts=3, failure_threshold=1)
+        self.assertEqual("ok", guard.call("cat-arn", calls))
+        self.assertEqual(2, len(self.sleeps))
+        self.assertFalse(guard.breaker("cat-arn").is_open)
+
+        failing = mock.Mock(side_effect=connection_error)
+        with self.assertRaises(EndpointConnectionError):
+            guard.call("cat-arn", failing)
+        self.assertEqual(3, failing.call_count)
+        self.assertTrue(guard.breaker("cat-arn").is_open)
+
+    def test_circuit_opens_and_recovers(self):
+        guard = self.guard(max_attempts=1, failure_threshold=2, reset_timeout=30)
+        failing = mock.Mock(side_effect=throttle())
+        for _ in range(2):
+            with self.assertRaises(PredictionError) as raised:
+                guard.call("cat-arn", failing)
+            self.assertEqual("THROTTLED", raised.exception.code)
+
+        with self.assertRaises(PredictionError) as raised:
+            guard.call("cat-arn", failing)
+        self.assertEqual("CIRCUIT_OPEN", raised.exception.code)
+        self.assertEqual(2, failing.call_count)
+        # other models are not affected
+        self.assertEqual("ok", guard.call("dog-arn", lambda: "ok"))
+
+        self.now[0] += 30
+        self.assertEqual("ok", guard.call("cat-arn", lambda: "ok"))
+        self.assertFalse(guard.breaker("cat-arn").is_open)
+
+    @mock.patch("predict_pet_image_attributes.get_breed_data")
+    @mock.patch("predict_pet_image_attributes.get_model_arn", return_value="cat-arn")
+    @mock.patch("predict_pet_image_attributes.rekognition_client")
+    def test_error_code_in_response(self, rekognition_patch, gma_patch, bd_patch):
+        rekognition_patch.detect_custom_labels.side_effect = ClientError(
+            {"Error": {"Code": "ResourceNotReadyException"}}, "DetectCustomLabels"
+        )
+        output = predict_pet_image_attributes.get_inferred_attributes(
+            "bucket", "cat.jpg", "cat", image={"Bytes": b"cat"}
+        )
+        self.assertEqual("MODEL_NOT_RUNNING", output["error_code"])
+        self.assertEqual([], output["breed"])
+
+    @mock.patch("predict_pet_image_attributes.detect_rate", 40.0)
+    @mock.patch(
+        "predict_pet_image_attributes.prediction_cache_enabled", return_value=False
+    )
+    @mock.patch("predict_pet_image_attributes.get_breeds_data")
+    @mock.patch("predict_pet_image_attributes.get_model_arn", return_value="cat-arn")
+    @mock.patch("predict_pet_image_attributes.rekognition_client")
+    def test_batch_waits_for_rate_limit(
+        self, rekognition_patch, gma_patch, bsd_patch, *patches
+    ):
+        bsd_patch.side_effect = lambda breed_names: {name: None for name in breed_names}
+
+        def detect_custom_labels(**kwargs):
+            time.sleep(0.01)
+            return rekognition_response()
+
+        rekognition_patch.detect_custom_labels.side_effect = detect_custom_labels
+        guard = RekognitionGuard(rate=40.0, capacity=1.0)
+        images = [
+            {"animal_type": "cat", "image_path": f"s3://bucket/{i}.jpg"}
+            for i in range(60)
+        ]
+        with mock.patch("predict_pet_image_attributes.rekognition_guard", guard):
+            results = predict_pet_image_attributes.get_batch_inferred_attributes(images)
+        self.assertEqual([], [result for result in results if "error_code" in result])
+        self.assertEqual(60, rekognition_patch.detect_custom_labels.call_count)
+
+
+def dog_response(species_confidence=99.0):
+    return {
+        "CustomLabels": [
+            {"Name": "breed-Beagle", "Confidence": 88.0},
+            {"Name": "species-dog", "Confidence": species_confidence},
+        ]
+    }
+
+
+@mock.patch("predict_pet_image_attributes.prediction_cache_enabled", return_value=False)
+@mock.patch("predict_pet_image_attributes.detect_breed_labels")
+@mock.patch("predict_pet_image_attributes.get_model_arn")
+class TestAutoRouting(unittest.TestCase):
+    def test_confident_species_wins_without_waiting(
+        self, arn_patch, dbl_patch, pce_patch
+    ):
+        arn_patch.side_effect = lambda animal_type: f"{animal_type}-model-arn"
+        release_cat_model = threading.Event()
+
+        def detect(model_arn, image, min_confidence):
+            if model_arn == "cat-model-arn":
+                release_cat_model.wait(5)
+                return rekognition_response()
+            return dog_response()
+
+        dbl_patch.side_effect = detect
+        try:
+            animal_type, response = predict_pet_image_attributes.get_auto_breed_labels(
+                {"Bytes": b"dog"}, 5
+            )
+        finally:
+            release_cat_model.set()
+        self.assertEqual("dog", animal_type)
+        self.assertEqual("breed-Beagle", response["CustomLabels"][0]["Name"])
+
+    def test_unsure_species_scored_by_own_model(self, arn_patch, dbl_patch, pce_patch):
+        arn_patch.side_effect = lambda animal_type: f"{animal_type}-model-arn"
+
+        def detect(model_arn, image, min_confidence):
+            if model_arn == "cat-model-arn":
+                return {
+                    "CustomLabels": [
+                        {"Name": "breed-Bombay", "Confidence": 70.0},
+                        {"Name": "species-dog", "Confidence": 80.0},
+                        {"Name": "species-cat", "Confidence": 60.0},
+                    ]
+                }
+            return {
+                "CustomLabels": [
+                    {"Name": "breed-Beagle", "Confidence": 40.0},
+                    {"Name": "species-cat", "Confidence": 70.0},
+                    {"Name": "species-dog", "Confidence": 50.0},
+                ]
+            }
+
+        dbl_patch.side_effect = detect
+        animal_type, response = predict_pet_image_attributes.get_auto_breed_labels(
+            {"Bytes": b"pet"}, 5
+        )
+        # the highest vote overall is the cat model's species-dog
+        self.assertEqual("cat", animal_type)
+        self.assertEqual("breed-Bombay", response["CustomLabels"][0]["Name"])
+
+    @mock.patch("predict_pet_image_attributes.get_breed_data")
+    def test_handler_without_animal_type(
+        self, bd_patch, arn_patch, dbl_patch, pce_patch
+    ):
+        arn_patch.side_effect = lambda animal_type: f"{animal_type}-model-arn"
+        dbl_patch.side_effect = lambda model_arn, image, min_confidence: (
+            rekognition_response()
+            if model_arn == "cat-model-arn"
+            else dog_response(species_confidence=40.0)
+        )
+        output = lambda_handler({"image_path": "s3://bucket/cat.jpg"}, {})
+        self.assertEqual("cat", output["animal_type"])
+        self.assertEqual("British Shorthair", output["breed"][0]["Name"])
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_coalesced(self):
+        recorder = mock.Mock()
+        flights = SingleFlight("detect_custom_labels", metrics=recorder)
+        release = threading.Event()
+        calls = []
+
+        def detect():
+            calls.append(1)
+            release.wait(5)
+            return {"CustomLabels": []}
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(flights.do(("arn", "cat.jpg"), detect))
+            )
+            for _ in range(3)
+        ]
+        threads[0].start()
+        while not calls:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        while recorder.increment.call_count < 2:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([{"CustomLabels": []}] * 3, results)
+        recorder.increment.assert_called_with(
+            "CoalescedCalls", {"Call": "detect_custom_labels"}
+        )
+        # finished calls are not cached
+        flights.do(("arn", "cat.jpg"), detect)
+        self.assertEqual(2, len(calls))
+
+    def test_failed_call_not_kept(self):
+        flights = SingleFlight("ssm_get_parameter")
+
+        def fail():
+            raise ValueError("ssm down")
+
+        with self.assertRaises(ValueError):
+            flights.do("cat", fail)
+        self.assertEqual("cat-model-arn", flights.do("cat", lambda: "cat-model-arn"))
+
+
+class TestLabelCodec(unittest.TestCase):
+    def test_compiled_from_manifest(self):
+        codec = LabelCodec.from_manifest(
+            [
+                json.dumps(
+                    {
+                        "source-ref": "s3://bucket/cat.jpg",
+                        "classification_species-metadata": {
+                            "class-name": "species-cat"
+                        },
+                        "classification_breed-metadata": {
+                            "class-name": "breed-Tiger||137"
+                        },
+                    }
+                )
+            ]
+        )
+        self.assertEqual(("breed", "Tiger", "137"), codec.decode("breed-Tiger||137"))
+        self.assertEqual(("species", "cat", ""), codec.decode("species-cat"))
+        self.assertEqual((None, "coat-tabby", ""), codec.decode("coat-tabby"))
+
+        with mock.patch("label_codec.parse_label") as parse_patch:
+            parse_patch.return_value = ("breed", "Bombay", "")
+            codec.decode("breed-Bombay")
+            codec.decode("breed-Bombay")
+            codec.decode("breed-Tiger||137")
+            parse_patch.assert_called_once_with("breed-Bombay")
+
+    def test_partition(self):
+        labels = LabelCodec().partition(rekognition_response()["CustomLabels"])
+        self.assertEqual(4, len(labels["breed"]))
+        self.assertEqual("cat", labels["species"][0]["Name"])
+
+
+def image_bytes(size=(128, 96), image_format="JPEG"):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (200, 120, 40)).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def check(data):
+    return check_image(data[: image_validation.HEADER_BYTES], len(data))
+
+
+@mock_s3
+@mock.patch("predict_pet_image_attributes.validate_images", True)
+@mock.patch("predict_pet_image_attributes.prediction_cache_enabled", return_value=False)
+@mock.patch("predict_pet_image_attributes.detect_breed_labels")
+class TestImageValidation(unittest.TestCase):
+    def setUp(self):
+        self.s3_client = predict_pet_image_attributes.s3
+        predict_pet_image_attributes.s3 = boto3.client("s3", region_name=DEFAULT_REGION)
+        self.s3_bucket = boto3.resource("s3", region_name=DEFAULT_REGION).create_bucket(
+            Bucket=S3_BUCKET_NAME
+        )
+        predict_pet_image_attributes.validation_cache.clear()
+
+    def tearDown(self):
+        predict_pet_image_attributes.s3 = self.s3_client
+
+    def test_check_image(self, *patches):
+        jpeg = image_bytes()
+        self.assertIsNone(check(jpeg))
+        self.assertIsNone(check(image_bytes(image_format="PNG")))
+        self.assertEqual("IMAGE_TRUNCATED", check(jpeg[:20])[0])
+        self.assertEqual(
+            "IMAGE_TRUNCATED", check(image_bytes(image_format="PNG")[:20])[0]
+        )
+        # data after the end of image marker
+        self.assertIsNone(check(jpeg + b"trailer" * 10))
+        self.assertTrue(missing_end_marker(jpeg, jpeg[:-2] + b"trailer"))
+        self.assertFalse(missing_end_marker(jpeg, jpeg[-20:] + b"\x00" * 4))
+        self.assertEqual("IMAGE_TOO_SMALL", check(image_bytes((32, 32)))[0])
+        self.assertEqual("IMAGE_TOO_LARGE", check(image_bytes((5000, 64), "PNG"))[0])
+        self.assertEqual("UNSUPPORTED_FORMAT", check(b"not an image")[0])
+        self.assertEqual("IMAGE_TRUNCATED", check(b"")[0])
+
+    def get_breed_labels(self, key):
+        return predict_pet_image_attributes.get_breed_labels(
+            "cat",
+            "cat-model-arn",
+            predict_pet_image_attributes.s3_image(S3_BUCKET_NAME, key),
+            5,
+        )
+
+    def test_invalid_image_not_sent_to_model(self, dbl_patch, *patches):
+        dbl_patch.return_value = rekognition_response()
+        self.s3_bucket.put_object(Key="cat.jpg", Body=image_bytes())
+        self.s3_bucket.put_object(Key="cat.txt", Body=b"not an image")
+
+        self.assertEqual(rekognition_response(), self.get_breed_labels("cat.jpg"))
+        for key, code in [
+            ("cat.txt", "UNSUPPORTED_FORMAT"),
+            ("dog.jpg", "IMAGE_NOT_FOUND"),
+        ]:
+            with self.assertRaises(PredictionError) as context:
+                self.get_breed_labels(key)
+            self.assertEqual(code, context.exception.code)
+        dbl_patch.assert_called_once()
+
+    def test_verdict_cached_by_etag(self, *patches):
+        self.s3_bucket.put_object(Key="cat.txt", Body=b"not an image")
+        validate = predict_pet_image_attributes.validate_s3_image
+        s3_client = predict_pet_image_attributes.s3
+        with mock.patch.object(
+            s3_client, "get_object", wraps=s3_client.get_object
+        ) as get_patch:
+            self.assertEqual(
+                "UNSUPPORTED_FORMAT", validate(S3_BUCKET_NAME, "cat.txt")[0]
+            )
+            etag = get_patch.call_args[1].get("IfNoneMatch")
+            self.assertIsNone(etag)
+            # not modified, the cached verdict is used
+            self.assertEqual(
+                "UNSUPPORTED_FORMAT", validate(S3_BUCKET_NAME, "cat.txt")[0]
+            )
+            etag = get_patch.call_args[1]["IfNoneMatch"]
+            # the etag of the prediction cache address needs no request
+            validate(S3_BUCKET_NAME, "cat.txt", etag)
+            self.assertEqual(2, get_patch.call_count)
+
+            self.s3_bucket.put_object(Key="cat.txt", Body=image_bytes())
+            self.assertIsNone(validate(S3_BUCKET_NAME, "cat.txt"))
+            self.assertEqual(3, get_patch.call_count)
+        # only the header is read
+        for call in get_patch.call_args_list:
+            self.assertEqual(
+                f"bytes=0-{image_validation.HEADER_BYTES - 1}", call[1]["Range"]
+            )
+
+    @mock.patch("predict_pet_image_attributes.read_image_header")
+    def test_unreadable_image_let_through(self, rie_patch, dbl_patch, *patches):
+        dbl_patch.return_value = rekognition_response()
+        rie_patch.side_effect = EndpointConnectionError(endpoint_url="https://s3")
+        self.assertEqual(rekognition_response(), self.get_breed_labels("cat.jpg"))
+        rie_patch.side_effect = ClientError(
+            {"Error": {"Code": "AccessDenied"}}, "GetObject"
+        )
+        self.assertEqual(rekognition_response(), self.get_breed_labels("dog.jpg"))
+        self.assertEqual(2, dbl_patch.call_count)
+
+    @mock.patch(
+        "predict_pet_image_attributes.get_model_arn", return_value="cat-model-arn"
+    )
+    def test_invalid_bytes_in_response(self, gma_patch, dbl_patch, *patches):
+        result = predict_pet_image_attributes.get_breed_prediction(
+            "cat", None, None, 5, image={"Bytes": image_bytes((32, 32))}
+        )
+        self.assertEqual("IMAGE_TOO_SMALL", result["Error"]["Code"])
+        dbl_patch.assert_not_called()
+
+
+def photo_bytes(size=(320, 240), quality=90, seed=0):
+    """
+    a blurred picture of random shapes, seed changes the picture
+    """
+    rng = random.Random(seed)
+    image = Image.new("RGB", (320, 240), (90, 140, 200))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(320), rng.randrange(240)
+        fill = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x, y, x + rng.randint(20, 120), y + rng.randint(20, 120)), fill)
+    image = image.filter(ImageFilter.GaussianBlur(4)).resize(size)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+@mock.patch("predict_pet_image_attributes.near_duplicate_cache_enabled", True)
+@mock.patch("predict_pet_image_attributes.prediction_cache_enabled", return_value=False)
+@mock.patch("predict_pet_image_attributes.detect_breed_labels")
+class TestNearDuplicates(unittest.TestCase):
+    def setUp(self):
+        self.cache = predict_pet_image_attributes.near_duplicate_cache
+        predict_pet_image_attributes.near_duplicate_cache = NearDuplicateCache(
+            max_distance=4, verify_rate=0.0
+        )
+
+    def tearDown(self):
+        predict_pet_image_attributes.near_duplicate_cache = self.cache
+
+    def test_dhash(self, *patches):
+        original = dhash(photo_bytes())
+        self.assertLessEqual(
+            hamming(original, dhash(photo_bytes((640, 480), quality=30))), 4
+        )
+        self.assertGreater(hamming(original, dhash(photo_bytes(seed=1))), 4)
+        self.assertIsNone(dhash(b"not an image"))
+
+    def test_bk_tree_nearest(self, *patches):
+        tree = BKTree()
+        for image_hash in [0b0000, 0b1111, 0b0111, 0b1000_0000]:
+            tree.add(image_hash, image_hash)
+        self.assertEqual((1, 0b0111, 0b0111), tree.nearest(0b0110, 1))
+        self.assertEqual((1, 0b1111, 0b1111), tree.nearest(0b1_1111, 1))
+        self.assertIsNone(tree.nearest(0b1111_0000, 2))
+        self.assertEqual(4, len(tree))
+
+    def get_breed_labels(self, image_bytes):
+        return predict_pet_image_attributes.get_breed_labels(
+            "cat", "cat-model-arn", {"Bytes": image_bytes}, 5
+        )
+
+    def test_near_duplicate_served_from_cache(self, dbl_patch, *patches):
+        dbl_patch.return_value = rekognition_response()
+        self.get_breed_labels(photo_bytes())
+        self.assertEqual(
+            rekognition_response()["CustomLabels"],
+            self.get_breed_labels(photo_bytes((640, 480), quality=30))["CustomLabels"],
+        )
+        self.get_breed_labels(photo_bytes(seed=1))
+        self.assertEqual(2, dbl_patch.call_count)
+
+    @mock.patch("predict_pet_image_attributes.can_hash", return_value=False)
+    def test_no_download_without_pillow(self, ch_patch, dbl_patch, *patches):
+        dbl_patch.return_value = rekognition_response()
+        with mock.patch("predict_pet_image_attributes.s3") as s3_patch:
+            predict_pet_image_attributes.get_breed_labels(
+                "cat",
+                "cat-model-arn",
+                predict_pet_image_attributes.s3_image(S3_BUCKET_NAME, "cat.jpg"),
+                5,
+            )
+        s3_patch.get_object.assert_not_called()
+        dbl_patch.assert_called_once()
+
+    def test_false_match_counted(self, dbl_patch, *patches):
+        metrics = mock.Mock()
+        predict_pet_image_attributes.near_duplicate_cache = NearDuplicateCache(
+            max_distance=4, verify_rate=1.0, metrics=metrics
+        )
+        dbl_patch.return_value = rekognition_response()
+        self.get_breed_labels(photo_bytes())
+        dbl_patch.return_value = {
+            "CustomLabels": [{"Name": "breed-Bombay||1", "Confidence": 99.0}]
+        }
+        result = self.get_breed_labels(photo_bytes(quality=30))
+        self.assertEqual("breed-Bombay||1", result["CustomLabels"][0]["Name"])
+        metrics.increment.assert_any_call("NearDuplicateFalseMatches", {})
@@ -0,0 +1,49 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import io
+import os
+import sys
+import unittest
+
+import numpy as np
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir, "../../rekognition/scripts"))
+from prediction_store import Predictions, save_predictions
+
+BREEDS = ["Bengal", "Bombay", "Persian", "Ragdoll", "Siamese"]
+
+
+class TestPredictionStore(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        self.source_refs = [f"s3://bucket/images/{i}.jpg" for i in range(200)]
+        # a breed the model never returns is only a true breed
+        self.y_true = list(rng.choice(BREEDS + ["Sphynx"], 200))
+        self.confidences = rng.uniform(1, 100, (200, 5)).astype(np.float32)
+        self.confidences[rng.random((200, 5)) < 0.7] = 0
+        self.confidences[3] = 0
+        self.file = io.BytesIO()
+        save_predictions(
+            self.file, self.source_refs, self.y_true, self.confidences, BREEDS
+        )
+        self.file.seek(0)
+
+    def test_round_trip(self):
+        with Predictions(self.file) as predictions:
+            self.assertEqual(200, len(predictions))
+            self.assertEqual(BREEDS, predictions.breeds)
+            self.assertEqual(self.y_true, predictions.y_true)
+            self.assertEqual(self.source_refs, predictions.source_refs)
+            np.testing.assert_array_equal(self.confidences, predictions.confidences())
+            np.testing.assert_array_equal(
+                self.confidences[:, 2], predictions.column("Persian")
+            )
+            preds_df = predictions.to_dataframe()
+        self.assertEqual(BREEDS + ["y_true"], list(preds_df.columns))
+        self.assertEqual(self.y_true[7], preds_df.loc[self.source_refs[7], "y_true"])
+
+    def test_smaller_than_csv(self):
+        with Predictions(self.file) as predictions:
+            csv = predictions.to_dataframe().to_csv()
+        self.assertLess(len(self.file.getvalue()), len(csv) / 2)
@@ -15,7 +15,8 @@ from rekognition.utils.constants import *
 
 def test_rekognition_lambdas_created():
     # Given
-    app = core.App()
+    # layers are not bundled, that needs pip or docker
+    app = core.App(context={"aws:cdk:bundling-stacks": []})
 
     # When
     stack = RekognitionStack(
@@ -34,3 +35,9 @@ def test_rekognition_lambdas_created():
     ]
 
     assert len(projects) == 14
+    # the predict lambda gets Pillow from a layer
+    assert [
+        resource["Properties"]["Handler"]
+        for resource in projects
+        if resource["Properties"].get("Layers")
+    ] == ["predict_pet_image_attributes.lambda_handler"]
@@ -0,0 +1,111 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import io
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir, "../../rekognition/scripts"))
+from prediction_store import save_predictions
+from threshold_sweep import (
+    ConfidenceSweep,
+    best_threshold,
+    label_bytes,
+    load_predictions,
+)
+
+BREEDS = ["Bengal", "Bombay", "Persian", "Ragdoll", "Siamese"]
+
+
+def expected_row(y_true, confidences, threshold, top_n):
+    """
+    the predict lambda's view of each image, one at a time
+    """
+    sizes = dict(zip(BREEDS, label_bytes(BREEDS)))
+    covered = correct = recalled = breeds = payload = 0
+    for true_breed, row in zip(y_true, confidences):
+        labels = sorted(
+            (
+                (confidence, name)
+                for name, confidence in zip(BREEDS, row)
+                if confidence > 0 and confidence >= threshold
+            ),
+            reverse=True,
+        )
+        names = [name for confidence, name in labels][:top_n]
+        covered += bool(names)
+        correct += bool(names) and names[0] == true_breed
+        recalled += true_breed in names
+        breeds += len(names)
+        payload += sum(sizes[name] for name in names)
+    n_images = len(y_true)
+    return {
+        "min_confidence": threshold,
+        "top_n": top_n,
+        "coverage": covered / n_images,
+        "precision": correct / covered if covered else 0.0,
+        "accuracy": correct / n_images,
+        "top_n_recall": recalled / n_images,
+        "mean_breeds": breeds / n_images,
+        "mean_breed_bytes": payload / n_images,
+    }
+
+
+class TestThresholdSweep(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(11)
+        self.y_true = list(rng.choice(BREEDS + ["Sphynx"], 300))
+        # distinct confidences, about half the breeds missing per image
+        self.confidences = rng.permutation(300 * 5).reshape(300, 5) / 15.0
+        self.confidences[rng.random((300, 5)) < 0.5] = 0
+
+    def test_matches_per_image_filtering(self):
+        sweep = ConfidenceSweep(self.y_true, self.confidences, BREEDS)
+        rows = sweep.rows(thresholds=(1, 20, 50.5, 99), top_ns=(1, 3))
+        self.assertEqual(8, len(rows))
+        for row in rows:
+            expected = expected_row(
+                self.y_true, self.confidences, row["min_confidence"], row["top_n"]
+            )
+            self.assertEqual(set(expected), set(row))
+            for key, value in expected.items():
+                self.assertAlmostEqual(value, row[key], msg=key)
+
+    def test_best_threshold(self):
+        rows = ConfidenceSweep(self.y_true, self.confidences, BREEDS).rows()
+        best = best_threshold(rows, min_precision=0.2, top_n=3)
+        self.assertEqual(3, best["top_n"])
+        self.assertGreaterEqual(best["precision"], 0.2)
+        self.assertTrue(
+            all(
+                row["coverage"] <= best["coverage"]
+                for row in rows
+                if row["precision"] >= 0.2
+            )
+        )
+        self.assertIsNone(best_threshold(rows, min_precision=1.1))
+
+    def test_load_csv_predictions(self):
+        preds_df = pd.DataFrame(self.confidences, columns=BREEDS)
+        preds_df["y_true"] = self.y_true
+        y_true, confidences, classes = load_predictions(
+            io.StringIO(preds_df.to_csv()), csv=True
+        )
+        self.assertEqual(self.y_true, y_true)
+        self.assertEqual(BREEDS, classes)
+        np.testing.assert_allclose(self.confidences, confidences)
+
+    def test_load_stored_predictions(self):
+        ff = io.BytesIO()
+        save_predictions(
+            ff, range(len(self.y_true)), self.y_true, self.confidences, BREEDS
+        )
+        ff.seek(0)
+        y_true, confidences, classes = load_predictions(ff)
+        self.assertEqual(self.y_true, y_true)
+        self.assertEqual(BREEDS, classes)
+        np.testing.assert_allclose(self.confidences, confidences, rtol=1e-6)
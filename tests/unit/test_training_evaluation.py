@@ -0,0 +1,175 @@
+## Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: MIT-0
+import os
+import sys
+import unittest
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.append(os.path.join(script_dir, "../../rekognition/scripts"))
+import create_evaluation_metrics
+from training_evaluation import parse_evaluation_line, parse_summary
+
+SUMMARY = {
+    "Version": 1,
+    "AggregatedEvaluationResults": {
+        "F1Score": 0.8,
+        "Precision": 0.75,
+        "Recall": 0.9,
+    },
+    "EvaluationDetails": {
+        "NumberOfTestingImages": 3,
+        "NumberOfTrainingImages": 12,
+    },
+    "LabelEvaluationResults": [
+        {
+            "Label": "breed-Bengal||0",
+            "Metrics": {"F1Score": 1.0, "Precision": 1.0, "Recall": 1.0},
+            "NumberOfTestingImages": 2,
+        },
+        {"NumberOfTestingImages": 1},
+    ],
+}
+
+
+def ground_truth(class_name, index=0):
+    return {
+        f"rekognition-custom-labels-training-{index}": 0,
+        f"rekognition-custom-labels-training-{index}-metadata": {
+            "class-name": class_name,
+            "confidence": 1,
+            "human-annotated": "yes",
+            "job-name": "rekognition-custom-labels-training-job",
+        },
+    }
+
+
+def evaluation(class_name, confidence, index=0, **flags):
+    return {
+        f"rekognition-custom-labels-evaluation-{index}": 0,
+        f"rekognition-custom-labels-evaluation-{index}-metadata": {
+            "class-name": class_name,
+            "confidence": confidence,
+            "human-annotated": "no",
+            "job-name": "rekognition-custom-labels-evaluation-job",
+            "rekognition-custom-labels-evaluation-details": {
+                "version": 1,
+                "is-true-positive": flags.get("true_positive", False),
+                "is-false-positive": flags.get("false_positive", False),
+                "is-false-negative": flags.get("false_negative", False),
+            },
+        },
+    }
+
+
+EVALUATION_MANIFEST = [
+    {
+        "source-ref": "s3://bucket/images/Bengal_0.jpg",
+        **ground_truth("breed-Bengal||0"),
+        **ground_truth("species-cat||0", 1),
+        **evaluation("breed-Bengal||0", 0.91, true_positive=True),
+        **evaluation("breed-Bombay||1", 0.42, 1, false_positive=True),
+    },
+    {
+        "source-ref": "s3://bucket/images/Bengal_1.jpg",
+        **ground_truth("breed-Bengal||0"),
+        **evaluation("breed-Bengal||0", "0.88"),
+    },
+    {
+        # missed, the model returned nothing above its threshold
+        "source-ref": "s3://bucket/images/Bombay_0.jpg",
+        **ground_truth("breed-Bombay||1"),
+        **evaluation("breed-Bombay||1", 0.2, false_negative=True),
+    },
+    # no evaluation and no image
+    {
+        "source-ref": "s3://bucket/images/Bombay_1.jpg",
+        **ground_truth("breed-Bombay||1"),
+    },
+    {"rekognition-custom-labels-training-0-metadata": "unexpected"},
+]
+
+
+class TestTrainingEvaluation(unittest.TestCase):
+    def test_parse_evaluation_line(self):
+        self.assertEqual(
+            (
+                "s3://bucket/images/Bengal_0.jpg",
+                "Bengal",
+                {
+                    "CustomLabels": [
+                        {"Name": "breed-Bengal||0", "Confidence": 91.0},
+                        {"Name": "breed-Bombay||1", "Confidence": 42.0},
+                    ]
+                },
+            ),
+            parse_evaluation_line(EVALUATION_MANIFEST[0]),
+        )
+        self.assertEqual(
+            {"CustomLabels": []}, parse_evaluation_line(EVALUATION_MANIFEST[2])[2]
+        )
+        self.assertIsNone(parse_evaluation_line(EVALUATION_MANIFEST[3]))
+        self.assertIsNone(parse_evaluation_line(EVALUATION_MANIFEST[4]))
+
+    def test_parse_summary(self):
+        summary = parse_summary(SUMMARY)
+        self.assertEqual(0.8, summary["f1-score"])
+        self.assertEqual(3, summary["testing_images"])
+        self.assertEqual(["breed-Bengal||0"], list(summary["labels"]))
+        self.assertIsNone(summary["labels"]["breed-Bengal||0"]["threshold"])
+        self.assertIsNone(parse_summary({})["f1-score"])
+
+    def test_metrics_from_training_output(self):
+        preds_df, metrics = create_evaluation_metrics.evaluate_training_output(
+            EVALUATION_MANIFEST, SUMMARY
+        )
+        self.assertAlmostEqual(2 / 3, metrics["accuracy"])
+        self.assertEqual(3, metrics["evaluation"]["images"])
+        self.assertEqual("training", metrics["evaluation"]["source"])
+        self.assertEqual(0.75, metrics["training_summary"]["precision"])
+        self.assertEqual(
+            [line["source-ref"] for line in EVALUATION_MANIFEST[:3]],
+            list(preds_df.index),
+        )
+        self.assertEqual(
+            42.0, preds_df.loc["s3://bucket/images/Bengal_0.jpg", "Bombay"]
+        )
+
+    def test_find_training_output(self):
+        description = {
+            "EvaluationResult": {
+                "Summary": {
+                    "S3Object": {
+                        "Bucket": "bucket",
+                        "Name": "0.0.1/cat/abc/output/EvaluationResultSummary-cat.json",
+                    }
+                }
+            },
+            "TestingDataResult": {
+                "Output": {
+                    "Assets": [
+                        {
+                            "GroundTruthManifest": {
+                                "S3Object": {
+                                    "Bucket": "bucket",
+                                    "Name": "0.0.1/cat/abc/output/TestingGroundTruth-cat.manifest",
+                                }
+                            }
+                        }
+                    ],
+                    "AutoCreate": False,
+                }
+            },
+        }
+        self.assertEqual(
+            (
+                ("bucket", "0.0.1/cat/abc/output/EvaluationResultSummary-cat.json"),
+                ("bucket", "0.0.1/cat/abc/output/TestingGroundTruth-cat.manifest"),
+            ),
+            create_evaluation_metrics.find_training_output(description),
+        )
+        del description["TestingDataResult"]
+        with self.assertRaises(Exception):
+            create_evaluation_metrics.find_training_output(description)
+        with self.assertRaises(Exception):
+            create_evaluation_metrics.find_training_output({})